@@ -0,0 +1,296 @@
+"""
+Regression checks on small synthetic inputs; exits with status 1 if one fails,
+so that it can run as a check in CI next to benchmarks.import_budget:
+
+    python -m benchmarks.checks
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import gps_traces
+
+
+def check_cache_roundtrip():
+    """
+    preprocess_mobile_data() returns the same frame (columns, dtypes and values)
+    on a cache miss and on the following cache hit.
+    """
+    from satmobfusion.mobile_data_processing import MOBILE_DTYPES, preprocess_mobile_data
+    df = gps_traces(20_000, n_users=100, seed=1).astype(MOBILE_DTYPES)
+    with tempfile.TemporaryDirectory() as folder:
+        miss = preprocess_mobile_data(df, crs="EPSG:4326", cache=folder)
+        hit = preprocess_mobile_data(df, crs="EPSG:4326", cache=folder)
+    pd.testing.assert_frame_equal(pd.DataFrame(miss), pd.DataFrame(hit))
+
+
+def check_cache_time_zone():
+    """
+    A cache-backed mobiledatamodule returns the same time window for naive
+    (UTC) and tz-aware bounds.
+    """
+    from satmobfusion.cache import TrajectoryCache
+    from satmobfusion.mobile_data_processing import MOBILE_DTYPES, mobiledatamodule, preprocess_mobile_data
+    df = gps_traces(20_000, n_users=100, seed=1).astype(MOBILE_DTYPES)
+    with tempfile.TemporaryDirectory() as folder:
+        gdf = preprocess_mobile_data(df, crs="EPSG:4326", cache=folder)
+        cache = TrajectoryCache(folder)
+        module = mobiledatamodule(cache=cache, cache_key=cache.entries()[0][0])
+        start = gdf["datetime"].min() + pd.Timedelta("5h")
+        end = start + pd.Timedelta("1D")
+        naive = module.subset_by_time(start, end)
+        aware = module.subset_by_time(start.tz_localize("UTC").tz_convert("America/Chicago"),
+                                      end.tz_localize("UTC").tz_convert("America/Chicago"))
+    assert len(naive) == ((gdf["datetime"] >= start) & (gdf["datetime"] <= end)).sum()
+    pd.testing.assert_frame_equal(pd.DataFrame(naive), pd.DataFrame(aware))
+
+
+def check_large_band_difference():
+    """
+    Band differences of uint16 scenes beyond the int16 range saturate at
+    +-32767 in the "diff" product instead of wrapping around.
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+    from satmobfusion.satellite_data import DIFF_NODATA, compute_difference_rasters
+    with tempfile.TemporaryDirectory() as folder:
+        fns = []
+        for name, value in [("pre", 100), ("post", 60000)]:
+            bands = np.full((4, 64, 64), value, dtype="uint16")
+            bands[:, :32] = 60100 - value #the upper half changes the other way
+            fn = os.path.join(folder, f"{name}.tif")
+            with rasterio.open(fn, "w", driver="GTiff", count=4, dtype="uint16", width=64, height=64,
+                               crs="EPSG:32615", transform=from_origin(226000., 3944000., 3., 3.)) as dst:
+                dst.write(bands)
+            fns.append(fn)
+        paths = compute_difference_rasters(*fns, os.path.join(folder, "products"), products=("diff",), block_size=32)
+        with rasterio.open(paths["diff"]) as src:
+            diff = src.read()
+    assert (diff[:, 32:] == 32767).all(), np.unique(diff[:, 32:])
+    assert (diff[:, :32] == -32767).all() and DIFF_NODATA not in diff, np.unique(diff[:, :32])
+
+
+class _PlanetStub(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in for the Planet Data API, for the PlanetClient checks.
+    `self.server.state` holds its configuration and collects the requests:
+
+    - "features": results of /quick-search, served in pages of "page_size"
+      features linked by _links._next; the first "throttle" searches get a
+      429 with Retry-After: 0.
+    - "active_after": number of polls of /status/<ID> after which the asset is active.
+    - "download": bytes served at /download/<name>; the first response is cut
+      off after "truncate_at" bytes, a Range request gets the rest (206).
+    """
+    def log_message(self, *args):
+        pass
+
+    def _json(self, obj, code=200, headers=()):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _page(self, page_no):
+        state = self.server.state
+        size = state["page_size"]
+        page = {"features": state["features"][page_no*size:(page_no + 1)*size], "_links": {}}
+        if (page_no + 1)*size < len(state["features"]):
+            page["_links"]["_next"] = f"http://127.0.0.1:{self.server.server_port}/searches/{page_no + 1}"
+        return page
+
+    def _asset(self, ID):
+        base = f"http://127.0.0.1:{self.server.server_port}"
+        state = self.server.state
+        asset = {"status": "inactive", "_links": {"_self": f"{base}/status/{ID}", "activate": f"{base}/activate/{ID}"}}
+        if state["polls"].get(ID, 0) >= state["active_after"]:
+            asset.update(status="active", location=f"{base}/download/{ID}")
+        return asset
+
+    def do_POST(self):
+        state = self.server.state
+        state["requests"].append(("POST", self.path, None))
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/quick-search":
+            if state.get("throttle", 0) > 0:
+                state["throttle"] -= 1
+                return self._json({"message": "Too many requests"}, 429, [("Retry-After", "0")])
+            return self._json(self._page(0))
+        self.send_error(404)
+
+    def do_GET(self):
+        state = self.server.state
+        state["requests"].append(("GET", self.path, self.headers.get("Range")))
+        path = self.path.strip("/").split("/")
+        if path[0] == "searches":
+            return self._json(self._page(int(path[1])))
+        if path[0] == "item-types":
+            return self._json({"ortho_visual": self._asset(path[3]), "ortho_analytic_4b": {"status": "inactive", "_links": {}}})
+        if path[0] == "activate":
+            state["polls"].setdefault(path[1], 0)
+            return self._json({}, 202)
+        if path[0] == "status":
+            state["polls"][path[1]] += 1
+            return self._json(self._asset(path[1]))
+        if path[0] == "download":
+            data = state["download"]
+            byte_range = self.headers.get("Range")
+            start = int(byte_range.split("=")[1].rstrip("-")) if byte_range else 0
+            self.send_response(206 if byte_range else 200)
+            self.send_header("Content-Disposition", f'attachment; filename="{self.path.rsplit("/", 1)[1]}"')
+            self.send_header("Content-Length", str(len(data) - start))
+            self.end_headers()
+            truncate_at = None if byte_range else state.pop("truncate_at", None)
+            if truncate_at is not None:
+                self.wfile.write(data[:truncate_at]) #Content-Length promised more; the client sees a short read
+                self.close_connection = True
+                return
+            try:
+                self.wfile.write(data[start:])
+            except ConnectionError: #the client only read the headers, e.g. to find the file name of a .part file
+                pass
+        else:
+            self.send_error(404)
+
+
+@contextmanager
+def _planet_stub(**state):
+    """
+    Runs _PlanetStub on a free local port; yields (base URL, state).
+    """
+    state["requests"] = []
+    state["polls"] = {}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _PlanetStub)
+    server.state = state
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}", state
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def check_planet_pagination():
+    """
+    PlanetClient.search() follows the _links._next pages of a quick search
+    and returns every feature once.
+    """
+    from satmobfusion.satellite_data import PlanetClient
+    features = [{"id": f"scene_{i}"} for i in range(7)]
+    with _planet_stub(features=features, page_size=3) as (url, state):
+        with PlanetClient("key", base_url=url, cache_dir=None) as client:
+            geojson = client.quick_search({"item_types": ["PSScene"]})
+    assert geojson["features"] == features, geojson["features"]
+    assert [request[1] for request in state["requests"]] == ["/quick-search", "/searches/1", "/searches/2"], state["requests"]
+
+
+def check_planet_retry():
+    """
+    PlanetClient retries a quick search that is answered with 429 Too Many
+    Requests, honoring Retry-After.
+    """
+    from satmobfusion.satellite_data import PlanetClient
+    features = [{"id": "scene_0"}]
+    with _planet_stub(features=features, page_size=3, throttle=2) as (url, state):
+        with PlanetClient("key", base_url=url, cache_dir=None, max_retries=3) as client:
+            geojson = client.quick_search({"item_types": ["PSScene"]})
+    assert geojson["features"] == features, geojson["features"]
+    assert [request[1] for request in state["requests"]] == ["/quick-search"]*3, state["requests"]
+
+
+def check_planet_activation():
+    """
+    PlanetClient.wait_until_active() polls until the asset is active and
+    caches it for asset(); it gives up with a TimeoutError at the deadline.
+    """
+    from satmobfusion.satellite_data import PlanetClient
+    with _planet_stub(active_after=2) as (url, state), tempfile.TemporaryDirectory() as folder:
+        with PlanetClient("key", base_url=url, cache_dir=folder) as client:
+            asset = client.activate("PSScene", "A", "ortho_visual")
+            asset = client.wait_until_active(asset, time.monotonic() + 10, poll_interval=0.01, item=("PSScene", "A", "ortho_visual"))
+            assert asset["status"] == "active" and state["polls"]["A"] == 2, (asset, state["polls"])
+            n_requests = len(state["requests"])
+            assert client.activate("PSScene", "A", "ortho_visual")["location"] == asset["location"]
+            assert len(state["requests"]) == n_requests, state["requests"][n_requests:] #served from the cache
+
+            asset = client.activate("PSScene", "B", "ortho_visual")
+            try:
+                client.wait_until_active(asset, time.monotonic() + 0.05, poll_interval=0.02)
+            except TimeoutError:
+                pass
+            else:
+                raise AssertionError("waiting past the deadline did not raise")
+
+
+def check_planet_download_resume():
+    """
+    PlanetClient.download() resumes a download that was cut off from its
+    ".part" file with an HTTP Range request instead of starting over.
+    """
+    from satmobfusion.satellite_data import PlanetClient
+    data = os.urandom(3 * 2**20)
+    with _planet_stub(download=data, truncate_at=len(data)//3) as (url, state), tempfile.TemporaryDirectory() as folder:
+        with PlanetClient("key", base_url=url, cache_dir=None) as client:
+            try:
+                client.download(f"{url}/download/scene.tif", folder, chunk_size=2**16)
+            except IOError:
+                pass
+            else:
+                raise AssertionError("a truncated download did not raise")
+            part = os.path.getsize(os.path.join(folder, "scene.tif.part"))
+            assert 0 < part < len(data), part
+            assert client.download(f"{url}/download/scene.tif", folder) == "scene.tif"
+        with open(os.path.join(folder, "scene.tif"), "rb") as f:
+            assert f.read() == data
+        assert not os.path.exists(os.path.join(folder, "scene.tif.part"))
+    assert ("GET", "/download/scene.tif", f"bytes={part}-") in state["requests"], state["requests"]
+
+
+CHECKS = {
+    "cache_roundtrip": check_cache_roundtrip,
+    "cache_time_zone": check_cache_time_zone,
+    "large_band_difference": check_large_band_difference,
+    "planet_pagination": check_planet_pagination,
+    "planet_retry": check_planet_retry,
+    "planet_activation": check_planet_activation,
+    "planet_download_resume": check_planet_download_resume,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--checks", nargs="+", choices=list(CHECKS), default=list(CHECKS))
+    args = parser.parse_args(argv)
+
+    failed = []
+    for name in args.checks:
+        try:
+            CHECKS[name]()
+        except Exception:
+            failed.append(name)
+            print(f"{name:>30} FAILED\n{traceback.format_exc()}", flush=True)
+        else:
+            print(f"{name:>30} ok", flush=True)
+    if failed:
+        print(f"Failed checks: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""
+Import-time budget of the satmobfusion modules; exits with status 1 if a
+module exceeds its budget, so that it can run as a check in CI:
+
+    python -m benchmarks.import_budget
+
+Every module is imported in fresh interpreters. Its time is measured on top
+of numpy and pandas (imported first), which every module needs anyway, and
+the median of `--repeat` runs is compared with the budget. Independently of
+the time, a module must not load the heavy backends listed in BUDGETS for
+it; these are only imported by the functions that use them.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+HEAVY = ["skmob", "geopandas", "shapely", "matplotlib", "requests", "scipy", "sklearn", "api_keys"]
+
+#module -> (budget in ms on top of numpy/pandas, backends it must not load)
+BUDGETS = {
+    "satmobfusion": (5, HEAVY + ["rasterio", "pyproj", "pyarrow.dataset"]),
+    "satmobfusion.mobile_data_processing": (60, HEAVY),
+    "satmobfusion.satellite_data": (250, HEAVY),
+    "satmobfusion.runner": (150, HEAVY + ["rasterio"]),
+    "satmobfusion.streaming": (60, HEAVY),
+    "satmobfusion.instrumentation": (20, HEAVY + ["rasterio", "pyproj"]),
+    "satmobfusion.convenience": (30, HEAVY),
+}
+
+_PROBE = """
+import json, sys, time
+import numpy, pandas
+t0 = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - t0
+print(json.dumps({{"seconds": seconds, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(module, heavy, repeat=5):
+    """
+    Median import time of `module` in seconds (on top of numpy and pandas) and
+    the modules of `heavy` that it loaded.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+    times, loaded = [], set()
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", _PROBE.format(module=module, heavy=heavy)],
+                             capture_output=True, text=True, env=env, check=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        times.append(result["seconds"])
+        loaded.update(result["loaded"])
+    return float(np.median(times)), sorted(loaded)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modules", nargs="+", choices=list(BUDGETS), default=list(BUDGETS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1., help="factor on all time budgets, e.g. for slow CI machines")
+    args = parser.parse_args(argv)
+
+    failed = []
+    for module in args.modules:
+        budget_ms, forbidden = BUDGETS[module]
+        seconds, loaded = measure(module, forbidden, repeat=args.repeat)
+        problems = []
+        if seconds * 1e3 > budget_ms * args.scale:
+            problems.append(f"over budget of {budget_ms * args.scale:.0f} ms")
+        if loaded:
+            problems.append(f"loads {', '.join(loaded)}")
+        print(f"{module:>40} {seconds * 1e3:>8.1f} ms  {'; '.join(problems) if problems else 'ok'}", flush=True)
+        if problems:
+            failed.append(module)
+    if failed:
+        print(f"Import budget exceeded: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
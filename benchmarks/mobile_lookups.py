@@ -0,0 +1,70 @@
+"""
+Times repeated window and user lookups on mobiledatamodule: full boolean scans
+(the previous implementation) against the sorted time / uid-range indices.
+
+Run from the repository root:
+
+    python -m benchmarks.mobile_lookups --points 1e6
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import gps_traces
+from satmobfusion.mobile_data_processing import mobiledatamodule
+
+
+def scan_subset_by_time(data, starttime, endtime, datetime="datetime"):
+    return data[(data[datetime] >= starttime) & (data[datetime] <= endtime)].reset_index()
+
+
+def scan_choose_user(data, uid):
+    return data[data.uid == uid]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--points", type=float, default=1e6)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    data = gps_traces(int(args.points), n_users=args.users, seed=args.seed) #May 1-22, 2020
+    mdm = mobiledatamodule(data=data)
+    mdm.add_datetime()
+
+    #hourly windows over the whole period, as in the visits-per-hour analysis
+    hours = pd.date_range("2020-05-01", "2020-05-22", freq="1h")
+    windows = list(zip(hours[:-1], hours[1:] - pd.Timedelta("1ns")))
+    uids = rng.choice(args.users, 200, replace=False)
+
+    t0 = time.perf_counter()
+    scanned = [len(scan_subset_by_time(mdm.data, s, e)) for s, e in windows]
+    t_scan = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    mdm.build_time_index()
+    t_build = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    indexed = [len(mdm.subset_by_time(s, e)) for s, e in windows]
+    t_index = time.perf_counter() - t0
+    assert scanned == indexed
+    print(f"subset_by_time x{len(windows)}: scan {t_scan:.3f} s, index {t_index:.3f} s (+{t_build:.3f} s build)")
+
+    t0 = time.perf_counter()
+    scanned = [len(scan_choose_user(mdm.data, uid)) for uid in uids]
+    t_scan = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    mdm.build_uid_index()
+    t_build = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    indexed = [len(mdm.choose_user(uid)) for uid in uids]
+    t_index = time.perf_counter() - t0
+    assert scanned == indexed
+    print(f"choose_user x{len(uids)}: scan {t_scan:.3f} s, index {t_index:.3f} s (+{t_build:.3f} s build)")
+
+
+if __name__ == "__main__":
+    main()
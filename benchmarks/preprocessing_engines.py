@@ -0,0 +1,71 @@
+"""
+Compares the 'numpy' and 'skmob' engines of the filter + compress stages.
+
+Run from the repository root:
+
+    python -m benchmarks.preprocessing_engines --sizes 1e5 1e6 1e7
+
+The skmob engine needs several hours at 1e7 points; use --skmob-max-points to
+skip it above a given size.
+"""
+import argparse
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+import skmob
+from skmob.preprocessing import compression, filtering
+
+import satmobfusion.trajectory as trajectory
+from benchmarks.synthetic import synthetic_traces
+
+
+def run_numpy(tdf, max_speed_kmh, spatial_radius_km):
+    f_tdf = trajectory.filter_trajectories(tdf, max_speed_kmh=max_speed_kmh)
+    return trajectory.compress_trajectories(f_tdf, spatial_radius_km=spatial_radius_km)
+
+
+def run_skmob(tdf, max_speed_kmh, spatial_radius_km):
+    f_tdf = filtering.filter(tdf, max_speed_kmh=max_speed_kmh, include_loops=False)
+    return compression.compress(f_tdf, spatial_radius_km=spatial_radius_km)
+
+
+def same_output(a, b):
+    cols = ["uid", "lat", "lng", "datetime"]
+    a, b = pd.DataFrame(a)[cols], pd.DataFrame(b)[cols]
+    return (len(a) == len(b)
+            and np.array_equal(a["lat"].astype(float).values, b["lat"].astype(float).values)
+            and np.array_equal(a["lng"].astype(float).values, b["lng"].astype(float).values)
+            and np.array_equal(a["datetime"].values, b["datetime"].values))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", type=float, default=[1e5, 1e6, 1e7])
+    parser.add_argument("--skmob-max-points", type=float, default=np.inf)
+    parser.add_argument("--max-speed-kmh", type=float, default=400)
+    parser.add_argument("--spatial-radius-km", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    print(f"{'points':>10} {'engine':>6} {'seconds':>10} {'points/s':>12} {'kept':>10}")
+    for size in args.sizes:
+        n_points = int(size)
+        tdf = skmob.TrajDataFrame(synthetic_traces(n_points), user_id="uid")
+        results = {}
+        for engine, func in [("numpy", run_numpy), ("skmob", run_skmob)]:
+            if engine == "skmob" and n_points > args.skmob_max_points:
+                print(f"{n_points:>10} {engine:>6} {'skipped':>10}")
+                continue
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                t0 = time.perf_counter()
+                results[engine] = func(tdf, args.max_speed_kmh, args.spatial_radius_km)
+                elapsed = time.perf_counter() - t0
+            print(f"{n_points:>10} {engine:>6} {elapsed:>10.2f} {n_points/elapsed:>12.0f} {len(results[engine]):>10}")
+        if len(results) == 2:
+            print(f"{'':>10} outputs identical: {same_output(results['numpy'], results['skmob'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Times and memory-profiles the pipeline stages on seeded synthetic inputs.
+
+Run from the repository root:
+
+    python -m benchmarks.run --scales small medium --output benchmarks/results/
+
+Every stage runs `--repeat` times at every scale; the fastest run is kept as
+its time, and one extra run under tracemalloc gives the peak of the memory
+allocated through Python (numpy included, GDAL's own buffers not). The results
+are written as JSON together with the git commit, so that two commits can be
+compared with
+
+    python -m benchmarks.run --compare benchmarks/results/<before>.json benchmarks/results/<after>.json
+"""
+import argparse
+import datetime
+import functools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import geotiff_pair, gps_traces
+
+#pings, users and raster side length (pixels) per scale
+SCALES = {
+    "small": dict(n_pings=100_000, n_users=500, raster_px=1024),
+    "medium": dict(n_pings=1_000_000, n_users=5_000, raster_px=4096),
+    "large": dict(n_pings=10_000_000, n_users=50_000, raster_px=10_000),
+}
+GRID_RESOLUTION = 17
+
+
+class Inputs():
+    """
+    Synthetic inputs of one scale, generated on first use and shared by the
+    stages (outside of the timed part).
+    """
+    def __init__(self, folder, n_pings, n_users, raster_px, seed=0):
+        self.folder = folder
+        self.n_pings, self.n_users, self.raster_px = n_pings, n_users, raster_px
+        self.seed = seed
+
+    @functools.cached_property
+    def pings(self):
+        return gps_traces(self.n_pings, n_users=self.n_users, seed=self.seed)
+
+    @functools.cached_property
+    def preprocessed(self):
+        from satmobfusion.mobile_data_processing import preprocess_mobile_data
+        return preprocess_mobile_data(self.pings, crs="EPSG:4326")
+
+    @functools.cached_property
+    def scenes(self):
+        return geotiff_pair(os.path.join(self.folder, "scenes"), width=self.raster_px, height=self.raster_px,
+                            shift_px=(3, -2), seed=self.seed)
+
+    @functools.cached_property
+    def products(self):
+        from satmobfusion.satellite_data import compute_difference_rasters
+        return compute_difference_rasters(*self.scenes, os.path.join(self.folder, "products"))
+
+
+#every stage takes the Inputs and returns the function to time
+def stage_preprocess(inputs):
+    from satmobfusion.mobile_data_processing import preprocess_mobile_data
+    df = inputs.pings
+    return lambda: preprocess_mobile_data(df, crs="EPSG:4326")
+
+
+def stage_metrics(inputs):
+    from satmobfusion.metrics import compute_metrics
+    import satmobfusion.grid as grid
+    points = pd.DataFrame(inputs.preprocessed.drop(columns="geometry"))
+    points["cell"] = grid.cell_ids(points["lng"].values, points["lat"].values, GRID_RESOLUTION)
+    return lambda: compute_metrics(points, bin_width="1h", region_col="cell")
+
+
+def stage_grid_index(inputs):
+    import satmobfusion.grid as grid
+    df = inputs.pings
+    return lambda: grid.CellIndex(df["lon"].values, df["lat"].values, resolution=18).counts(GRID_RESOLUTION)
+
+
+def stage_streaming(inputs):
+    import satmobfusion.grid as grid
+    from satmobfusion.streaming import StreamingAnomalyDetector, run_replay
+    df = inputs.pings
+    def run():
+        detector = StreamingAnomalyDetector(cell_func=functools.partial(grid.cell_ids, resolution=14))
+        return run_replay(detector, df, batch_seconds=600)
+    return run
+
+
+def stage_stays(inputs):
+    from satmobfusion.stays import compute_stays
+    gdf = inputs.preprocessed
+    return lambda: compute_stays(gdf)
+
+
+def stage_raster_diff(inputs):
+    from satmobfusion.satellite_data import compute_difference_rasters
+    fn_pre, fn_post = inputs.scenes
+    folder = os.path.join(inputs.folder, "raster_diff")
+    return lambda: compute_difference_rasters(fn_pre, fn_post, folder)
+
+
+def stage_fusion(inputs):
+    from satmobfusion.fusion import fuse_event
+    gdf = inputs.preprocessed
+    product_fns = [inputs.products["gray"], inputs.products["ndvi"]]
+    return lambda: fuse_event(gdf, product_fns, resolution=GRID_RESOLUTION)
+
+
+STAGES = {
+    "preprocess": stage_preprocess,
+    "metrics": stage_metrics,
+    "grid_index": stage_grid_index,
+    "streaming": stage_streaming,
+    "stays": stage_stays,
+    "raster_diff": stage_raster_diff,
+    "fusion": stage_fusion,
+}
+
+
+def measure(func, repeat=3):
+    """
+    Fastest wall-clock time of `repeat` runs of `func` and the peak of the
+    memory traced by tracemalloc during one more run, in MB.
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": min(times), "seconds_all": times, "peak_mb": peak / 1e6}
+
+
+def git_commit():
+    """
+    (commit hash, True if the working tree has uncommitted changes); (None, None) outside of git.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def run_suite(scales, stages, repeat=3, seed=0, verbose=True):
+    """
+    Runs the benchmark and returns the results as a JSON-serializable dict.
+    """
+    commit, dirty = git_commit()
+    results = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "seed": seed,
+        "stages": [],
+    }
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as folder:
+            inputs = Inputs(folder, seed=seed, **SCALES[scale])
+            for stage in stages:
+                func = STAGES[stage](inputs)
+                result = {"stage": stage, "scale": scale, **SCALES[scale], **measure(func, repeat=repeat)}
+                results["stages"].append(result)
+                if verbose:
+                    print(f"{scale:>8} {stage:>12} {result['seconds']:>10.3f} s {result['peak_mb']:>10.1f} MB", flush=True)
+    return results
+
+
+def compare(before, after):
+    """
+    Table of the time and peak memory ratios (after / before) of the stages in both result files.
+    """
+    def frame(results):
+        return pd.DataFrame(results["stages"]).set_index(["scale", "stage"])[["seconds", "peak_mb"]]
+    table = frame(before).join(frame(after), lsuffix="_before", rsuffix="_after", how="inner")
+    table["time_ratio"] = table["seconds_after"] / table["seconds_before"]
+    table["memory_ratio"] = table["peak_mb_after"] / table["peak_mb_before"]
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=["small"])
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=os.path.join("benchmarks", "results"),
+                        help="JSON file or folder (then named after the commit and time)")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="compare two result files instead of running the benchmark")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        with open(args.compare[1]) as f:
+            after = json.load(f)
+        print(f"{before['commit']} -> {after['commit']}")
+        print(compare(before, after).to_string(float_format="{:.3f}".format))
+        return
+
+    results = run_suite(args.scales, args.stages, repeat=args.repeat, seed=args.seed)
+    fn = args.output
+    if not fn.endswith(".json"):
+        os.makedirs(fn, exist_ok=True)
+        stamp = results["timestamp"].replace(":", "").replace("-", "")[:15]
+        fn = os.path.join(fn, f"{(results['commit'] or 'nocommit')[:10]}_{stamp}.json")
+    elif os.path.dirname(fn):
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(fn, "w") as f:
+        json.dump(results, f, indent=1)
+    print(f"Results written to {fn}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
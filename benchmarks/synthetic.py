@@ -0,0 +1,133 @@
+"""
+Seeded synthetic inputs for the benchmarks: GPS traces with a disaster-induced
+anomaly, and 4-band (R, G, B, NIR) GeoTIFF pairs before/after an event.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+#Tulsa, OK and the tornado of May 15, 2020 (see config/locations.csv)
+CENTER = (36.15, -95.99)
+START = pd.Timestamp("2020-05-01")
+EVENT = pd.Timestamp("2020-05-15 12:38:00") #UTC
+
+
+def synthetic_traces(n_points, n_users=None, seed=0):
+    """
+    Random walks around Tulsa with 5 % GPS outliers, in the column layout of a
+    skmob TrajDataFrame (uid, lat, lng, datetime) and in random row order.
+    """
+    rng = np.random.default_rng(seed)
+    n_users = n_users or max(1, n_points // 500)
+    uid = np.sort(rng.integers(0, n_users, n_points))
+    step = rng.integers(0, 300, n_points)
+    t = 1588291200 + np.cumsum(step)
+    lat = CENTER[0] + np.cumsum(rng.normal(0, 1e-3, n_points))
+    lng = CENTER[1] + np.cumsum(rng.normal(0, 1e-3, n_points))
+    outliers = rng.random(n_points) < 0.05
+    lat[outliers] += rng.normal(0, 1, outliers.sum())
+    df = pd.DataFrame({"uid": uid, "lat": lat, "lng": lng, "datetime": pd.to_datetime(t, unit="s")})
+    return df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def gps_traces(n_pings, n_users=1000, days=21, spread_deg=0.05, outlier_share=0.02,
+               anomaly_time=EVENT, anomaly_hours=6, anomaly_center=(36.16, -95.98), anomaly_radius_deg=0.005,
+               anomaly_share=0.3, seed=0):
+    """
+    Pings of a Spectus-like export (uid, lat, lon, timestamp in unix seconds).
+
+    Every user has a home location and pings around it with a daily rhythm
+    (more pings during the day). During `anomaly_hours` after `anomaly_time`,
+    `anomaly_share` of the users' pings move into a small area around
+    `anomaly_center`, i.e. a spike of visits there, as after a disaster.
+    Set `anomaly_time` to None for traces without anomaly.
+
+    Returns
+    -------
+    DataFrame sorted by timestamp.
+    """
+    rng = np.random.default_rng(seed)
+    home_lat = CENTER[0] + rng.normal(0, spread_deg, n_users)
+    home_lon = CENTER[1] + rng.normal(0, spread_deg, n_users)
+    uid = rng.integers(0, n_users, n_pings)
+
+    #daily rhythm: draw the hour of day with a day-heavy profile
+    hour_weights = np.array([1, 1, 1, 1, 1, 2, 4, 6, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 6, 5, 4, 3, 2, 1], dtype=float)
+    day = rng.integers(0, days, n_pings)
+    hour = rng.choice(24, n_pings, p=hour_weights/hour_weights.sum())
+    seconds = rng.integers(0, 3600, n_pings)
+    timestamp = (START.value // 10**9 + day.astype(np.int64)*86400 + hour*3600 + seconds).astype(np.int64)
+
+    lat = home_lat[uid] + rng.normal(0, 0.01, n_pings)
+    lon = home_lon[uid] + rng.normal(0, 0.01, n_pings)
+    if anomaly_time is not None:
+        t0 = pd.Timestamp(anomaly_time).value // 10**9
+        during = (timestamp >= t0) & (timestamp < t0 + anomaly_hours*3600) & (rng.random(n_pings) < anomaly_share)
+        lat[during] = anomaly_center[0] + rng.normal(0, anomaly_radius_deg, during.sum())
+        lon[during] = anomaly_center[1] + rng.normal(0, anomaly_radius_deg, during.sum())
+    outliers = rng.random(n_pings) < outlier_share
+    lat[outliers] += rng.normal(0, 1, outliers.sum())
+
+    df = pd.DataFrame({"uid": uid, "lat": lat, "lon": lon, "timestamp": timestamp})
+    return df.sort_values("timestamp", kind="mergesort", ignore_index=True)
+
+
+def _smooth_noise(rng, shape, scale):
+    #sum of a few upsampled random fields: texture with structure at several scales
+    out = np.zeros(shape, dtype=np.float32)
+    for cells, weight in [(8, 1.), (32, 0.5), (128, 0.25)]:
+        coarse = rng.random((max(2, shape[0]*cells//max(shape)), max(2, shape[1]*cells//max(shape))), dtype=np.float32)
+        rows = np.arange(shape[0]) * coarse.shape[0] // shape[0]
+        cols = np.arange(shape[1]) * coarse.shape[1] // shape[1]
+        out += weight * coarse[rows][:, cols]
+    return out / 1.75 * scale
+
+
+def geotiff_pair(folder, width=2048, height=2048, crs="EPSG:32615", origin=(226000., 3944000.), res=3.,
+                 damage_center=None, damage_radius_px=None, shift_px=(0, 0), block_size=256, seed=0):
+    """
+    Writes a pre/post pair of 4-band (R, G, B, NIR) uint16 GeoTIFFs.
+
+    Both scenes share the land-cover texture plus independent sensor noise.
+    In the post scene, a disk of `damage_radius_px` around `damage_center`
+    (row, col; default: the image center) loses vegetation: NIR drops and
+    the visible bands brighten, so NDVI and grayscale differences show it.
+    The post scene can be shifted by `shift_px` (rows, cols) to exercise the
+    window alignment.
+
+    Returns
+    -------
+    fn_pre, fn_post : string
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(seed)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    vegetation = _smooth_noise(rng, (height, width), 1.)
+    damage_center = damage_center or (height // 2, width // 2)
+    damage_radius_px = damage_radius_px or min(width, height) // 8
+    rows, cols = np.ogrid[:height, :width]
+
+    fns = []
+    for name, (dr, dc) in [("pre", (0, 0)), ("post", shift_px)]:
+        veg = np.roll(vegetation, (-dr, -dc), axis=(0, 1)) #same land cover at the same place
+        if name == "post":
+            damaged = (rows - damage_center[0] + dr)**2 + (cols - damage_center[1] + dc)**2 < damage_radius_px**2
+            veg[damaged] *= 0.2
+        bands = np.stack([
+            800 + 600*(1 - veg), #red
+            900 + 500*(1 - veg), #green
+            700 + 400*(1 - veg), #blue
+            1200 + 2500*veg,     #NIR
+        ]) + rng.normal(0, 30, (4, height, width)).astype(np.float32)
+        profile = dict(driver="GTiff", count=4, dtype="uint16", crs=crs, width=width, height=height,
+                       transform=from_origin(origin[0] + dc*res, origin[1] - dr*res, res, res),
+                       tiled=True, blockxsize=block_size, blockysize=block_size, compress="deflate")
+        fn = os.path.join(folder, f"{name}.tif")
+        with rasterio.open(fn, "w", **profile) as dst:
+            dst.write(np.clip(bands, 1, 65535).astype("uint16"))
+        fns.append(fn)
+    return tuple(fns)
@@ -0,0 +1,35 @@
+"""
+Fusion of satellite imagery with mobile sensor data for event identification.
+
+The submodules are imported on first access (`satmobfusion.satellite_data`,
+...), so that importing the package, or one of its modules, only loads the
+backends (skmob, geopandas, matplotlib, requests, ...) that are actually used.
+"""
+import importlib
+
+__all__ = [
+    "cache",
+    "convenience",
+    "cube",
+    "fusion",
+    "grid",
+    "instrumentation",
+    "metrics",
+    "mobile_data_processing",
+    "projection",
+    "runner",
+    "satellite_data",
+    "stays",
+    "streaming",
+    "trajectory",
+]
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+import satmobfusion.projection as projection
+
+# marker written last; an entry without it is incomplete and ignored
+MANIFEST = "_manifest.json"
+# categories of the categorical columns, restored on read (Parquet partitions return their codes' values as plain columns)
+CATEGORIES = "_categories_{}.parquet"
+
+
+def file_hash(file_path, block_size=2**20):
+    """
+    sha256 of a file's content, read in blocks of `block_size` bytes.
+    """
+    h = hashlib.sha256()
+    with open(file_path, "rb") as fd:
+        for block in iter(lambda: fd.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _column_time(timestamp, tz):
+    """
+    `timestamp` in the representation of a datetime column with time zone `tz`:
+    naive UTC for naive columns (pyarrow cannot compare naive with tz-aware
+    timestamps), converted to `tz` otherwise, so that its date matches the
+    "date" partitions.
+    """
+    timestamp = pd.Timestamp(timestamp)
+    if tz is None:
+        return timestamp if timestamp.tz is None else timestamp.tz_convert("UTC").tz_localize(None)
+    return (timestamp.tz_localize("UTC") if timestamp.tz is None else timestamp).tz_convert(tz)
+
+
+def uid_bucket(uid, n_buckets):
+    """
+    Bucket number of every uid; hashed on the string value so that it does not depend on the dtype.
+    """
+    uid = pd.Series(np.atleast_1d(uid)).astype(str)
+    return (pd.util.hash_pandas_object(uid, index=False).values % n_buckets).astype(np.int32)
+
+
+class TrajectoryCache():
+    """
+    On-disk cache of preprocessed trajectories.
+
+    Every entry is a Parquet dataset partitioned by date and uid bucket
+    (`date=YYYY-MM-DD/uid_bucket=k/`), so time windows and single users are read
+    through partition pruning and predicate pushdown instead of loading the whole
+    entry. Entries are keyed by a hash of the input data and the preprocessing
+    parameters (see key()); the least recently used entries are evicted once the
+    cache grows beyond `max_bytes`.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Folder holding the cache entries.
+    max_bytes : int
+        Size limit of the whole cache.
+    n_uid_buckets : int
+        Number of uid partitions per date.
+    """
+    def __init__(self, cache_dir, max_bytes=10*2**30, n_uid_buckets=16):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.n_uid_buckets = n_uid_buckets
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, source, crs, max_speed_kmh, spatial_radius_km, region_df=None, region_cols=None):
+        """
+        Cache key of a preprocessing run.
+
+        Parameters
+        ----------
+        source : str or DataFrame
+            Path of the raw export (hashed by content) or the raw DataFrame itself.
+        region_df : GeoDataFrame or None
+            Clipping polygons; their geometry and CRS are part of the key.
+        """
+        h = hashlib.sha256()
+        if isinstance(source, pd.DataFrame):
+            h.update(pd.util.hash_pandas_object(source, index=False).values.tobytes())
+        else:
+            h.update(file_hash(source).encode())
+        h.update(json.dumps([str(crs), float(max_speed_kmh), float(spatial_radius_km), region_cols]).encode())
+        if region_df is not None:
+            h.update(str(region_df.crs).encode())
+            for wkb in region_df.geometry.to_wkb():
+                h.update(wkb)
+        return h.hexdigest()[:32]
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def __contains__(self, key):
+        return os.path.isfile(os.path.join(self.path(key), MANIFEST))
+
+    def write(self, key, gdf, datetime="datetime", crs=None):
+        """
+        Stores preprocessed points (a GeoDataFrame, or a DataFrame with the CRS
+        of its 'lng'/'lat' columns in `crs`); the geometry is rebuilt on read.
+        `gdf` itself is left unchanged.
+        """
+        import geopandas as gpd
+        path = self.path(key)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        if isinstance(gdf, gpd.GeoDataFrame):
+            crs = crs if crs is not None else gdf.crs
+            df = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+        else:
+            df = pd.DataFrame(gdf)
+        #assign() returns a new frame, so the partition columns are not added to the caller's frame
+        df = df.assign(date=df[datetime].dt.strftime("%Y-%m-%d"), uid_bucket=uid_bucket(df["uid"], self.n_uid_buckets))
+        pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), path, partition_cols=["date", "uid_bucket"])
+
+        categorical = {col: bool(dtype.ordered) for col, dtype in df.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)}
+        for col in categorical:
+            pq.write_table(pa.table({"categories": df[col].cat.categories.values}), os.path.join(path, CATEGORIES.format(col)))
+        manifest = {"crs": str(crs) if crs is not None else None, "datetime": datetime,
+                    "n_uid_buckets": self.n_uid_buckets, "rows": len(df), "categorical": categorical,
+                    "columns": list(gdf.columns)}
+        with open(os.path.join(path, MANIFEST), "w") as fd:
+            json.dump(manifest, fd)
+        self.evict(keep=key)
+
+    def read(self, key, starttime=None, endtime=None, uid=None, columns=None, out_crs=None):
+        """
+        Reads a cache entry, optionally restricted to a time window and/or a single user.
+
+        Only the partitions of the dates in [starttime, endtime] and of the uid's
+        bucket are opened; row groups are memory-mapped. The geometry is built
+        in `out_crs` if given (see projection.points_gdf()).
+
+        Returns
+        -------
+        GeoDataFrame sorted by uid and datetime, like the output of preprocess_mobile_data().
+        """
+        path = self.path(key)
+        with open(os.path.join(path, MANIFEST)) as fd:
+            manifest = json.load(fd)
+        os.utime(os.path.join(path, MANIFEST)) #mark as recently used
+        datetime = manifest["datetime"]
+
+        #files starting with "_" (the manifest) are skipped by the dataset discovery
+        dataset = ds.dataset(path, format="parquet", partitioning="hive", filesystem=pafs.LocalFileSystem(use_mmap=True))
+        tz = dataset.schema.field(datetime).type.tz
+
+        expr = None
+        def add(e):
+            return e if expr is None else expr & e
+        if starttime is not None:
+            starttime = _column_time(starttime, tz)
+            expr = add((pc.field("date") >= starttime.strftime("%Y-%m-%d")) & (pc.field(datetime) >= starttime))
+        if endtime is not None:
+            endtime = _column_time(endtime, tz)
+            expr = add((pc.field("date") <= endtime.strftime("%Y-%m-%d")) & (pc.field(datetime) <= endtime))
+        if uid is not None:
+            bucket = int(uid_bucket(uid, manifest["n_uid_buckets"])[0])
+            expr = add((pc.field("uid_bucket") == bucket) & (pc.field("uid") == uid))
+
+        table = dataset.to_table(filter=expr, columns=columns)
+        df = table.to_pandas().drop(columns=["date", "uid_bucket"], errors="ignore")
+        for col, ordered in manifest.get("categorical", {}).items():
+            if col in df.columns:
+                categories = pq.read_table(os.path.join(path, CATEGORIES.format(col))).column("categories").to_numpy()
+                df[col] = pd.Categorical(df[col], categories=categories, ordered=ordered)
+        #partitions come back in directory order
+        df = df.sort_values([c for c in ["uid", datetime] if c in df.columns], kind="mergesort", ignore_index=True)
+        if {"lng", "lat"}.issubset(df.columns):
+            df = projection.points_gdf(df, manifest["crs"], out_crs=out_crs)
+        #column order of the written frame
+        written = manifest.get("columns", [])
+        order = [col for col in written if col in df.columns] + [col for col in df.columns if col not in written]
+        return df if order == list(df.columns) else df[order]
+
+    def entries(self):
+        """
+        (key, size in bytes, last use) of every complete entry, least recently used first.
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            if key in self:
+                size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(self.path(key)) for f in files)
+                entries.append((key, size, os.path.getmtime(os.path.join(self.path(key), MANIFEST))))
+        return sorted(entries, key=lambda e: e[2])
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries until the cache fits into `max_bytes`.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.path(key))
+            total -= size
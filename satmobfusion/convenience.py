@@ -1,10 +1,9 @@
 import os
-import matplotlib
-import matplotlib.pyplot as plt
+import warnings
 import numpy as np
+import pandas as pd
 
-f_size = matplotlib.rcParams['font.size'] #used as fontsize
-t_size = matplotlib.rcParams['font.size'] #used as ticksize
+#matplotlib is imported by the plotting functions only, so that read_locations() & co. stay cheap to import
 t_rotation = "horizontal" #used as tick rotation
 l_scilim = -5 #10^(l_scilim) used as left scilimit
 r_scilim = 5 #10^(r_scilim) used as right scilimit
@@ -16,6 +15,13 @@ yr_scilim = r_scilim
 pad_inches = 0.05
 
 
+def __getattr__(name):
+    if name in ("f_size", "t_size"): #used as fontsize and ticksize
+        import matplotlib
+        return matplotlib.rcParams['font.size']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 ## Add reverse geocoding functions here
 
 def bounding_box(points):
@@ -26,10 +32,31 @@ def get_rectangular_polygon_from_bounding_box(lon_min, lon_max, lat_min, lat_max
     # return [(minx,maxy),(maxx,maxy),(maxx,miny),(minx,miny),(minx,maxy)]
     return [(lon_min,lat_max),(lon_max,lat_max),(lon_max,lat_min),(lon_min,lat_min),(lon_min,lat_max)]
 
+def read_locations(filename="config/locations.csv"):
+    """
+    Reads the event configuration file.
+
+    The tz-aware columns "date_event_begin", "date_event_end", "date_min" and
+    "date_max" are (re)built from their "*_local" counterparts and the
+    "timezone" column of each location.
+
+    Parameters
+    ----------
+    filename : string
+        Path to the locations file.
+        Default is "config/locations.csv".
+    """
+    locs = pd.read_csv(filename, index_col="location")
+    for col in ["date_event_begin", "date_event_end", "date_min", "date_max"]:
+        local = pd.to_datetime(locs[col+"_local"])
+        locs[col] = pd.Series([t.tz_localize(tz) if not pd.isna(t) else pd.NaT for t,tz in zip(local, locs["timezone"])],
+                              index=locs.index, dtype=object)
+    return locs
+
 
 def plot(x, y, ey=[], ex=[], frame=[], kind="scatter", marker_option=".",
          ls="-", lw=1, label="", color="royalblue", zorder=1, alpha=1.,
-         output_folder="", filename=""):
+         output_folder="", filename="", max_points=None):
     """
     Erstellt einen Plot (plot, scatter oder errorbar).
 
@@ -55,6 +82,9 @@ def plot(x, y, ey=[], ex=[], frame=[], kind="scatter", marker_option=".",
         linewidth
     zorder : int
         Die "Ebene" der zu plottenden Daten
+    max_points : int or None
+        Scatter plots of more points are drawn as a density raster (see density_raster()),
+        e.g. 200_000 for large datasets. None (default) always draws the points.
 
     return frame
     """
@@ -67,9 +97,12 @@ def plot(x, y, ey=[], ex=[], frame=[], kind="scatter", marker_option=".",
         ey = np.ones(len(y))*ey[0]
 
     #plotting
+    import matplotlib.pyplot as plt
     fig, plot = plt.subplots(1,1) if frame == [] else frame
     if kind=="plot":
         plot.plot(x, y, color=color, marker=marker_option, ls=ls, lw=lw, label=label, zorder=zorder, alpha=alpha)
+    elif kind=="scatter" and max_points is not None and len(x) > max_points:
+        _draw_density(plot, x, y, color=color, zorder=zorder, alpha=alpha, label=label)
     elif kind=="scatter":
         plot.scatter(x, y, color=color, marker=marker_option, lw=lw, label=label, zorder=zorder, alpha=alpha)
     elif kind=="errorbar":
@@ -139,6 +172,8 @@ def fig_ax_setup(fig, suptitle=None, title=None,
     y_axis_formatting : bool
         Boolean whether to do axis_formatter commands on the y axis or not.
     """
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker
 
     #frame of figure
     if type(fig) is list or type(fig) is tuple:
@@ -285,3 +320,238 @@ def save_figure(fig, filename="figure.png", dpi=None, transparent=0):
 
             # If we don't specify the edgecolor and facecolor for the figure when
             # saving with savefig, it will override the value we set earlier!
+
+
+## Batch rendering
+
+def density_raster(x, y, extent=None, shape=(512, 512)):
+    """
+    Counts of points per pixel of a (rows, cols) raster, to draw dense point
+    layers as an image instead of one marker per point.
+
+    Parameters
+    ----------
+    extent : list or None
+        [x_min, x_max, y_min, y_max] of the raster; default is the extent of the points.
+
+    Returns
+    -------
+    counts : (rows, cols) ndarray, first row at the top (as for imshow)
+    extent : list
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if extent is None:
+        extent = [np.nanmin(x), np.nanmax(x), np.nanmin(y), np.nanmax(y)]
+    counts, _, _ = np.histogram2d(y, x, bins=shape, range=[extent[2:], extent[:2]])
+    return counts[::-1], list(extent)
+
+
+def _draw_density(ax, x, y, color="royalblue", extent=None, shape=(512, 512), zorder=1, alpha=1., label=""):
+    #single-color map from transparent to `color`, so that the density looks like the scatter it replaces
+    import matplotlib.colors
+    counts, extent = density_raster(x, y, extent=extent, shape=shape)
+    cmap = matplotlib.colors.LinearSegmentedColormap.from_list("density", [matplotlib.colors.to_rgba(color, 0.), matplotlib.colors.to_rgba(color, 1.)])
+    norm = matplotlib.colors.LogNorm(vmin=1, vmax=max(counts.max(), 1))
+    image = ax.imshow(np.ma.masked_equal(counts, 0), extent=extent, cmap=cmap, norm=norm, interpolation="nearest",
+                      aspect="auto", zorder=zorder, alpha=alpha)
+    if label:
+        ax.scatter([], [], color=color, marker=".", label=label) #legend entry
+    return image
+
+
+def downsample(img, max_size):
+    """
+    Block average of an image (..., rows, cols) to at most `max_size` pixels
+    along its longer side; NaNs and masked pixels are left out of the averages.
+    """
+    factor = int(np.ceil(max(img.shape[-2:]) / max_size))
+    if factor <= 1:
+        return img
+    values = np.ma.filled(np.ma.asarray(img).astype(float), np.nan)
+    rows, cols = (values.shape[-2] // factor) * factor, (values.shape[-1] // factor) * factor
+    blocks = values[..., :rows, :cols].reshape(values.shape[:-2] + (rows // factor, factor, cols // factor, factor))
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning) #all-NaN blocks
+        out = np.nanmean(blocks, axis=(-3, -1))
+    return np.ma.masked_invalid(out)
+
+
+def _spec_image(spec, bands, max_size, resampling="average"):
+    # image of a spec's source (raster file or array) at no more than max_size pixels per side, and its extent
+    source = spec["source"]
+    if isinstance(source, str):
+        from satmobfusion.satellite_data import read_decimated
+        img, transform = read_decimated(source, bands=bands, bounds=spec.get("bounds"), bounds_crs=spec.get("bounds_crs", "EPSG:4326"),
+                                        max_size=max_size, resampling=resampling)
+        extent = [transform.c, transform.c + transform.a * img.shape[-1], transform.f + transform.e * img.shape[-2], transform.f]
+        return img, extent
+    img = np.ma.asarray(source)
+    if bands is not None and img.ndim == 3:
+        img = img[np.atleast_1d(bands) - 1] if not isinstance(bands, int) else img[bands - 1]
+    return downsample(img, max_size), spec.get("extent")
+
+
+def _percentile_limits(img, percentiles):
+    values = np.ma.filled(np.ma.asarray(img).astype(float), np.nan)
+    return np.nanpercentile(values, percentiles[0]), np.nanpercentile(values, percentiles[1])
+
+
+def render_figure(spec):
+    """
+    Renders one figure spec headlessly (Agg canvas, no pyplot state) and saves it.
+
+    A spec is a dict with the keys
+    "kind" : "rgb", "raster", "bands", "hist" or "points"
+    "filename" : output path
+    "source" : raster file (read at the output resolution through its overviews,
+        see satellite_data.read_decimated()) or array; for "points" a dict/DataFrame
+        with "lng" and "lat" or a Parquet file (e.g. preprocessed.parquet)
+    and optionally
+    "bands" : band(s) to read ("rgb": 3 bands, "bands": one panel per band)
+    "bounds", "bounds_crs" : AOI to read from a raster file
+    "figsize", "dpi" : figure size in inches and resolution (default (6.4, 4.8), 200)
+    "cmap", "vmin", "vmax", "percentiles" : color scaling (default: 1st/99th percentile)
+    "colorbar" : label of a colorbar, "title(s)", "xlabel", "ylabel"
+    "bins", "log", "axvline" : histogram settings
+    "scalebar" : add a matplotlib_scalebar ScaleBar (if installed)
+
+    Rasters are never drawn at more pixels than the figure has; dense point
+    layers are drawn as density rasters of the figure's resolution.
+
+    Returns
+    -------
+    Path of the saved figure.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    kind = spec["kind"]
+    dpi = spec.get("dpi", 200)
+    figsize = spec.get("figsize", (16, 12) if kind == "bands" else (6.4, 4.8))
+    max_size = int(np.ceil(max(figsize) * dpi))
+    percentiles = spec.get("percentiles", (1, 99))
+
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    if kind == "bands":
+        bands = spec.get("bands", (1, 2, 3))
+        axs = fig.subplots(1, len(bands))
+        img, extent = _spec_image(spec, tuple(bands), max_size // len(bands))
+        titles = spec.get("titles", [None] * len(bands))
+        for ax, band_img, title in zip(np.atleast_1d(axs), img, titles):
+            pos = ax.imshow(band_img, extent=extent, cmap=spec.get("cmap", "BrBG"), interpolation="nearest")
+            fig.colorbar(pos, ax=ax, fraction=0.032)
+            if title is not None:
+                ax.set_title(title)
+        fig.subplots_adjust(wspace=0.45)
+        ax = axs
+    else:
+        ax = fig.subplots()
+    if kind == "rgb":
+        img, extent = _spec_image(spec, tuple(spec.get("bands", (1, 2, 3))), max_size)
+        if img.dtype != np.uint8:
+            #stretch every band to [0, 1] between its percentiles
+            img = np.ma.stack([np.ma.clip((band - lo) / (hi - lo), 0, 1) for band in img
+                               for lo, hi in [_percentile_limits(band, spec.get("percentiles", (2, 98)))]])
+        ax.imshow(np.ma.filled(np.moveaxis(img, 0, -1), 0), extent=extent, interpolation="nearest")
+    elif kind == "raster":
+        img, extent = _spec_image(spec, spec.get("bands", 1), max_size)
+        vmin, vmax = _percentile_limits(img, percentiles)
+        pos = ax.imshow(img, extent=extent, cmap=spec.get("cmap", "gray"), vmin=spec.get("vmin", vmin), vmax=spec.get("vmax", vmax),
+                        interpolation="nearest")
+        if spec.get("colorbar") is not None:
+            fig.colorbar(pos, ax=ax, fraction=0.046, label=spec["colorbar"], extend="both")
+    elif kind == "hist":
+        #a nearest-neighbour sample keeps the distribution of the values (averaging would narrow it)
+        img, _ = _spec_image(spec, spec.get("bands", 1), spec.get("max_samples", 2048), resampling="nearest")
+        values = np.ma.masked_invalid(np.ma.asarray(img).astype(float)).compressed()
+        ax.hist(values, bins=spec.get("bins", 256), log=spec.get("log", False), color=spec.get("color", "royalblue"))
+        if spec.get("axvline") is not None:
+            ax.axvline(spec["axvline"], color="black")
+    elif kind == "points":
+        source = spec["source"]
+        if isinstance(source, str):
+            source = pd.read_parquet(source, columns=[spec.get("lng", "lng"), spec.get("lat", "lat")])
+        x, y = np.asarray(source[spec.get("lng", "lng")]), np.asarray(source[spec.get("lat", "lat")])
+        width_px, height_px = int(figsize[0] * dpi), int(figsize[1] * dpi)
+        if len(x) > spec.get("max_points", 50_000):
+            _draw_density(ax, x, y, color=spec.get("color", "royalblue"), extent=spec.get("extent"), shape=(height_px // 2, width_px // 2))
+        else:
+            ax.scatter(x, y, color=spec.get("color", "royalblue"), marker=".", lw=0, s=spec.get("s", 4))
+    elif kind != "bands":
+        raise ValueError(f"Unknown figure kind {kind!r}")
+
+    if spec.get("scalebar"):
+        try:
+            from matplotlib_scalebar.scalebar import ScaleBar
+            ax.add_artist(ScaleBar(1.0))
+        except ImportError:
+            pass
+    if kind != "bands":
+        for key, setter in [("title", ax.set_title), ("xlabel", ax.set_xlabel), ("ylabel", ax.set_ylabel)]:
+            if spec.get(key) is not None:
+                setter(spec[key])
+    save_figure(fig, spec["filename"], dpi=dpi)
+    return spec["filename"]
+
+
+def _init_render_worker():
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+def render_figures(specs, n_workers=None):
+    """
+    Renders a list of figure specs (see render_figure()) in a process pool.
+
+    Parameters
+    ----------
+    n_workers : int or None
+        Number of processes; default is one per core (at most one per spec).
+        1 renders in this process.
+
+    Returns
+    -------
+    List of the paths of the saved figures, in the order of `specs`.
+    """
+    specs = list(specs)
+    n_workers = min(n_workers or os.cpu_count() or 1, max(len(specs), 1))
+    if n_workers == 1:
+        return [render_figure(spec) for spec in specs]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_render_worker) as executor:
+        return list(executor.map(render_figure, specs))
+
+
+def event_figure_specs(products, fn_pre, fn_post, output_folder, bounds=None, dpi=200):
+    """
+    Specs of the standard maps of an event, as in analyze_satellite_imagery.ipynb:
+    visual pre/post, grayscale and NDVI of pre, post and their difference,
+    histograms of the differences and the per-band differences.
+
+    Parameters
+    ----------
+    products : dict
+        Product -> path, as returned by satellite_data.compute_difference_rasters().
+    fn_pre, fn_post : string
+        The pre/post scenes.
+    bounds : tuple or None
+        AOI (lon/lat) to show of the scenes; the products cover it already.
+    """
+    out = lambda name: os.path.join(output_folder, name)
+    specs = [
+        dict(kind="rgb", source=fn_pre, bounds=bounds, filename=out("vis_pre.png"), dpi=dpi, scalebar=True),
+        dict(kind="rgb", source=fn_post, bounds=bounds, filename=out("vis_post.png"), dpi=dpi, scalebar=True),
+    ]
+    for product, cmap, label in [("gray", "gray", "Luminosity"), ("ndvi", "RdYlGn", "NDVI")]:
+        if product not in products:
+            continue
+        for band, period in [(1, "pre"), (2, "post"), (3, "diff")]:
+            specs.append(dict(kind="raster", source=products[product], bands=band, cmap=cmap, colorbar=label,
+                              filename=out(f"{product}_{period}.png"), dpi=dpi, scalebar=True))
+        specs.append(dict(kind="hist", source=products[product], bands=3, axvline=0, filename=out(f"hist_{product}_diff.png"), dpi=dpi))
+    if "diff" in products:
+        specs.append(dict(kind="bands", source=products["diff"], bands=(1, 2, 3), titles=["Reds", "Greens", "Blues"],
+                          filename=out("diff_bands.png"), dpi=dpi))
+    return specs
@@ -0,0 +1,334 @@
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.enums
+import rasterio.warp
+import rasterio.windows
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+
+import satmobfusion.instrumentation as instrumentation
+import satmobfusion.projection as projection
+
+RGBN_NAMES = ("red", "green", "blue", "nir")
+
+
+class RasterCube():
+    """
+    Time cube of co-registered scenes of one AOI on local disk.
+
+    Every scene is reprojected onto the grid of the cube once, when it is
+    appended, and stored as its own .npy file of shape (bands, height, width)
+    next to a boolean valid mask (height, width); meta.json holds the grid and
+    the list of scenes. Scenes are read as memory maps, so time series and
+    baselines are computed one spatial chunk at a time and appending a scene
+    never rewrites the others.
+
+    Use RasterCube.create(), .from_reference() or .open() to get a cube.
+
+    Parameters
+    ----------
+    folder : string
+        Folder of the cube.
+    meta : dict
+        Content of meta.json.
+    """
+    def __init__(self, folder, meta):
+        self.folder = folder
+        self.meta = meta
+        self.crs = CRS.from_wkt(meta["crs"])
+        self.transform = rasterio.Affine(*meta["transform"])
+        self.shape = (meta["height"], meta["width"])
+
+    @classmethod
+    def create(cls, folder, crs, transform, width, height, bands=RGBN_NAMES, dtype="uint16", chunk_size=512):
+        """
+        Creates an empty cube on the grid given by `crs`, `transform`, `width` and `height`.
+
+        Parameters
+        ----------
+        bands : tuple of string
+            Names of the bands stored per scene, in the order of the source files.
+        dtype : string
+            Storage type of the band values (e.g. that of the scenes).
+        chunk_size : int
+            Side length in pixels of the spatial chunks of the lazy computations.
+        """
+        if os.path.isfile(os.path.join(folder, "meta.json")):
+            raise FileExistsError(f"{folder} already holds a cube, use RasterCube.open()")
+        os.makedirs(os.path.join(folder, "scenes"), exist_ok=True)
+        meta = {
+            "crs": CRS.from_user_input(crs).to_wkt(), "transform": list(transform)[:6],
+            "width": int(width), "height": int(height), "bands": list(bands), "dtype": np.dtype(dtype).name,
+            "chunk_size": int(chunk_size), "scenes": [],
+        }
+        cube = cls(folder, meta)
+        cube._write_meta()
+        return cube
+
+    @classmethod
+    def from_reference(cls, folder, fn, bounds=None, bounds_crs="EPSG:4326", **kwargs):
+        """
+        Creates an empty cube on the grid of the raster `fn` (e.g. the first
+        scene), cut to `bounds` (left, bottom, right, top in `bounds_crs`) if given.
+        """
+        with rasterio.open(fn) as src:
+            window = rasterio.windows.Window(0, 0, src.width, src.height)
+            if bounds is not None:
+                window = projection.window_from_bounds(bounds, bounds_crs, src)
+                window = window.round_offsets().round_lengths().intersection(rasterio.windows.Window(0, 0, src.width, src.height))
+            kwargs.setdefault("bands", RGBN_NAMES[:src.count] if src.count <= 4 else [str(b) for b in src.indexes])
+            kwargs.setdefault("dtype", src.dtypes[0])
+            return cls.create(folder, src.crs, rasterio.windows.transform(window, src.transform),
+                              int(window.width), int(window.height), **kwargs)
+
+    @classmethod
+    def from_bounds(cls, folder, bounds, resolution, crs, bounds_crs="EPSG:4326", **kwargs):
+        """
+        Creates an empty cube covering `bounds` (left, bottom, right, top in
+        `bounds_crs`) with square pixels of `resolution` units of `crs`.
+        """
+        left, bottom, right, top = projection.transform_bounds(bounds, bounds_crs, crs)
+        width = math.ceil((right - left) / resolution)
+        height = math.ceil((top - bottom) / resolution)
+        return cls.create(folder, crs, from_origin(left, top, resolution, resolution), width, height, **kwargs)
+
+    @classmethod
+    def open(cls, folder):
+        with open(os.path.join(folder, "meta.json")) as f:
+            return cls(folder, json.load(f))
+
+    def _write_meta(self):
+        path = os.path.join(self.folder, "meta.json")
+        with open(path+".tmp", "w") as f:
+            json.dump(self.meta, f, indent=1)
+        os.replace(path+".tmp", path) #readers never see a half-written list of scenes
+
+    @property
+    def scenes(self):
+        """
+        DataFrame of the scenes in time order: id, acquired, valid_share and source.
+        """
+        scenes = pd.DataFrame(self.meta["scenes"], columns=["id", "acquired", "valid_share", "source"])
+        scenes["acquired"] = pd.to_datetime(scenes["acquired"], utc=True)
+        return scenes
+
+    def __len__(self):
+        return len(self.meta["scenes"])
+
+    def __contains__(self, scene_id):
+        return any(scene["id"] == scene_id for scene in self.meta["scenes"])
+
+    def _paths(self, scene_id):
+        return (os.path.join(self.folder, "scenes", f"{scene_id}.npy"),
+                os.path.join(self.folder, "scenes", f"{scene_id}_valid.npy"))
+
+    @instrumentation.instrumented("RasterCube.append")
+    def append(self, fn, acquired, scene_id=None, resampling="bilinear", rows_per_chunk=None):
+        """
+        Reprojects a scene onto the grid of the cube and adds it.
+
+        The scene is warped with rasterio.warp.reproject() band by band, a
+        chunk of rows at a time; its valid mask is warped along (nearest).
+        Scenes already in the cube are skipped.
+
+        Parameters
+        ----------
+        fn : string
+            Path of the scene, e.g. a downloaded Planet image.
+        acquired : datetime-like
+            Acquisition time; naive times are taken as UTC.
+        scene_id : string or None
+            Default: the file name without extension.
+        resampling : string
+            Resampling method of the band values.
+
+        Returns
+        -------
+        True if the scene was added, False if it was in the cube already.
+        """
+        scene_id = scene_id or os.path.splitext(os.path.basename(fn))[0]
+        if scene_id in self:
+            return False
+        fn_data, fn_valid = self._paths(scene_id)
+        height, width = self.shape
+        n_bands = len(self.meta["bands"])
+        rows_per_chunk = rows_per_chunk or self.meta["chunk_size"]
+        data = np.lib.format.open_memmap(fn_data+".tmp", mode="w+", dtype=self.meta["dtype"], shape=(n_bands, height, width))
+        valid = np.lib.format.open_memmap(fn_valid+".tmp", mode="w+", dtype=bool, shape=(height, width))
+
+        with rasterio.open(fn) as src:
+            if src.count < n_bands:
+                raise ValueError(f"{fn} has {src.count} bands, the cube stores {n_bands}")
+            extent = rasterio.windows.Window(0, 0, src.width, src.height)
+            for row in range(0, height, rows_per_chunk):
+                rows = min(rows_per_chunk, height - row)
+                chunk = rasterio.windows.Window(0, row, width, rows)
+                dst_transform = rasterio.windows.transform(chunk, self.transform)
+                warped = np.zeros((n_bands, rows, width), dtype=self.meta["dtype"])
+                for b in range(n_bands):
+                    rasterio.warp.reproject(rasterio.band(src, b + 1), warped[b], dst_transform=dst_transform, dst_crs=self.crs,
+                                            resampling=rasterio.enums.Resampling[resampling])
+                data[:, row:row + rows] = warped
+
+                # only the part of the source mask under this chunk is read (plus a margin of one pixel)
+                src_window = projection.window_from_bounds(rasterio.windows.bounds(chunk, self.transform), self.crs, src)
+                src_window = rasterio.windows.Window(src_window.col_off - 1, src_window.row_off - 1, src_window.width + 2,
+                                                     src_window.height + 2).round_offsets().round_lengths()
+                if not rasterio.windows.intersect(src_window, extent):
+                    valid[row:row + rows] = False
+                    continue
+                src_window = src_window.intersection(extent)
+                mask = np.zeros((rows, width), dtype="uint8")
+                rasterio.warp.reproject(src.dataset_mask(window=src_window), mask, src_transform=rasterio.windows.transform(src_window, src.transform),
+                                        src_crs=src.crs, dst_transform=dst_transform, dst_crs=self.crs,
+                                        resampling=rasterio.enums.Resampling.nearest)
+                valid[row:row + rows] = mask > 0
+        valid_share = float(valid.mean()) if valid.size else 0.
+        data.flush()
+        valid.flush()
+        del data, valid
+        os.replace(fn_data+".tmp", fn_data)
+        os.replace(fn_valid+".tmp", fn_valid)
+
+        acquired = pd.Timestamp(acquired)
+        acquired = acquired.tz_localize("UTC") if acquired.tz is None else acquired.tz_convert("UTC")
+        self.meta["scenes"].append({"id": scene_id, "acquired": acquired.isoformat(), "valid_share": valid_share, "source": fn})
+        self.meta["scenes"].sort(key=lambda scene: scene["acquired"])
+        self._write_meta()
+        instrumentation.current().record(scene=scene_id, pixels=height * width, valid_share=valid_share)
+        return True
+
+    def band(self, scene_id):
+        """
+        Memory map (bands, height, width) of a scene and its valid mask (height, width).
+        """
+        fn_data, fn_valid = self._paths(scene_id)
+        return np.load(fn_data, mmap_mode="r"), np.load(fn_valid, mmap_mode="r")
+
+    def chunks(self, chunk_size=None):
+        """
+        Yields the windows of the spatial chunks of the cube.
+        """
+        chunk_size = chunk_size or self.meta["chunk_size"]
+        height, width = self.shape
+        for row in range(0, height, chunk_size):
+            for col in range(0, width, chunk_size):
+                yield rasterio.windows.Window(col, row, min(chunk_size, width - col), min(chunk_size, height - row))
+
+    def series(self, product, window=None, scenes=None):
+        """
+        Time series of a product over a window, read from the memory maps.
+
+        Parameters
+        ----------
+        product : string
+            "gray" (0.3*R + 0.59*G + 0.11*B), "ndvi" ((NIR - R) / (NIR + R)) or a band name.
+        window : Window or None
+            Part of the grid (default: all of it; use chunks() for large cubes).
+        scenes : list of string or None
+            Scene ids (default: all, in time order).
+
+        Returns
+        -------
+        (n_scenes, rows, cols) float32 array, NaN where a scene is not valid.
+        """
+        window = window or rasterio.windows.Window(0, 0, self.shape[1], self.shape[0])
+        rows, cols = window.toslices()
+        scenes = scenes if scenes is not None else [scene["id"] for scene in self.meta["scenes"]]
+        out = np.empty((len(scenes), int(window.height), int(window.width)), dtype="float32")
+        for i, scene_id in enumerate(scenes):
+            data, valid = self.band(scene_id)
+            out[i] = self._product(product, data[:, rows, cols])
+            out[i][~valid[rows, cols]] = np.nan
+        return out
+
+    def _product(self, product, values):
+        bands = self.meta["bands"]
+        if product in bands:
+            return values[bands.index(product)]
+        values = values.astype("float32")
+        if product == "gray":
+            from satmobfusion.satellite_data import GRAY_WEIGHTS
+            return sum(weight * values[bands.index(name)] for weight, name in zip(GRAY_WEIGHTS, RGBN_NAMES[:3]))
+        if product == "ndvi":
+            if "nir" not in bands:
+                raise ValueError("NDVI needs the bands 'red' and 'nir'")
+            red, nir = values[bands.index("red")], values[bands.index("nir")]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                return (nir - red) / (nir + red)
+        raise ValueError(f"Unknown product {product!r}, use 'gray', 'ndvi' or one of {bands}")
+
+    def rolling_baseline(self, product, window=None, n_scenes=5, min_periods=2, scenes=None):
+        """
+        Per-pixel baseline of every scene: mean and standard deviation of the
+        valid values of the `n_scenes` scenes before it, and the z-score of the
+        scene against it.
+
+        Returns
+        -------
+        mean, std, z : (n_scenes, rows, cols) float32 arrays, NaN where fewer
+        than `min_periods` earlier values are valid (z also where std is 0).
+        """
+        values = self.series(product, window=window, scenes=scenes)
+        ok = np.isfinite(values)
+        filled = np.where(ok, values, 0).astype("float64")
+        # cumulative sums along time with a leading zero; the baseline of scene i uses scenes i-n..i-1
+        zero = np.zeros((1,) + values.shape[1:])
+        count = np.concatenate([zero, np.cumsum(ok, axis=0)])
+        total = np.concatenate([zero, np.cumsum(filled, axis=0)])
+        squares = np.concatenate([zero, np.cumsum(filled**2, axis=0)])
+        hi = np.arange(len(values))
+        lo = np.maximum(hi - n_scenes, 0)
+        n = count[hi] - count[lo]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = (total[hi] - total[lo]) / n
+            std = np.sqrt(np.maximum((squares[hi] - squares[lo]) - n * mean**2, 0) / (n - 1))
+            z = (values - mean) / std
+        enough = n >= min_periods
+        mean[~enough] = np.nan
+        std[~enough] = np.nan
+        z[~enough | (std == 0)] = np.nan
+        return mean.astype("float32"), std.astype("float32"), z.astype("float32")
+
+    @instrumentation.instrumented("RasterCube.anomalies")
+    def anomalies(self, product, n_scenes=5, min_periods=2, scenes=None, out=None):
+        """
+        z-scores of rolling_baseline() for the whole cube, computed chunk by
+        chunk into a memory-mapped .npy file.
+
+        Parameters
+        ----------
+        scenes : list of string or None
+            Scenes to score (default: all); e.g. only the newest scenes plus
+            the `n_scenes` before them for live monitoring.
+        out : string or None
+            Path of the result (default: "<folder>/<product>_z.npy").
+
+        Returns
+        -------
+        Memory map (n_scenes, height, width) of the z-scores.
+        """
+        scenes = scenes if scenes is not None else [scene["id"] for scene in self.meta["scenes"]]
+        out = out or os.path.join(self.folder, f"{product}_z.npy")
+        z = np.lib.format.open_memmap(out, mode="w+", dtype="float32", shape=(len(scenes),) + self.shape)
+        for window in self.chunks():
+            rows, cols = window.toslices()
+            z[:, rows, cols] = self.rolling_baseline(product, window=window, n_scenes=n_scenes, min_periods=min_periods, scenes=scenes)[2]
+        z.flush()
+        instrumentation.current().record(scenes=len(scenes), pixels=self.shape[0] * self.shape[1])
+        return z
+
+
+def usable_images(images_df, min_coverage=0.5):
+    """
+    IDs of all images of rank_images() covering at least `min_coverage` of the
+    AOI, in time order, e.g. to append to a RasterCube instead of picking one
+    pre/post pair.
+    """
+    usable = images_df[images_df["coverage_of_AOI"] >= min_coverage]
+    return usable.sort_values("date_acquired", kind="mergesort").index.tolist()
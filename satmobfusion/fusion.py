@@ -0,0 +1,214 @@
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.windows
+
+import satmobfusion.grid as grid
+import satmobfusion.projection as projection
+from satmobfusion.metrics import compute_metrics
+
+
+class PixelCellIndex():
+    """
+    Grid cell (see grid.cell_ids()) of every pixel of a raster.
+
+    The pixel-to-cell assignment is computed once per AOI and stored as one
+    small integer code per pixel; zonal statistics of any number of raster
+    products and the rasterization of any number of cell-level metrics are
+    then bincounts/lookups over these codes, without further geometry work.
+
+    Parameters
+    ----------
+    transform : Affine
+        Transform of the raster.
+    width, height : int
+        Size of the raster in pixels.
+    crs : CRS
+        CRS of the raster.
+    resolution : int
+        Grid resolution of the cells.
+    rows_per_chunk : int
+        Pixel rows whose coordinates are transformed at a time.
+    """
+    def __init__(self, transform, width, height, crs, resolution=17, rows_per_chunk=256):
+        self.transform = transform
+        self.shape = (height, width)
+        self.crs = crs
+        self.resolution = resolution
+
+        self.codes = np.empty(self.shape, dtype=np.int32)
+        code_of = {} #cell id -> code, in order of appearance
+        cols = np.arange(width) + 0.5
+        for row in range(0, height, rows_per_chunk):
+            rows = np.arange(row, min(row + rows_per_chunk, height)) + 0.5
+            x, y = transform * np.meshgrid(cols, rows)
+            lon, lat = projection.transform_coords(x.ravel(), y.ravel(), crs, "EPSG:4326")
+            cells, inverse = np.unique(grid.cell_ids(lon, lat, resolution), return_inverse=True)
+            lookup = np.array([code_of.setdefault(cell, len(code_of)) for cell in cells], dtype=np.int32)
+            self.codes[row:row + len(rows)] = lookup[inverse].reshape(len(rows), width)
+        self.cells = np.fromiter(code_of.keys(), dtype=np.int64, count=len(code_of))
+
+    @classmethod
+    def from_raster(cls, fn, resolution=17, **kwargs):
+        """
+        Index of the pixels of the raster file `fn`.
+        """
+        with rasterio.open(fn) as src:
+            return cls(src.transform, src.width, src.height, src.crs, resolution=resolution, **kwargs)
+
+    def zonal_stats(self, values, valid=None, window=None):
+        """
+        Count, mean and standard deviation of pixel values per cell.
+
+        Parameters
+        ----------
+        values : ndarray
+            (height, width) array of one band, or (bands, height, width); a
+            masked array's mask and NaNs count as invalid.
+        valid : ndarray or None
+            Additional (height, width) mask of valid pixels.
+        window : Window or None
+            Part of the raster `values` covers (default: all of it).
+
+        Returns
+        -------
+        DataFrame indexed by cell with the columns "count", "mean", "std" (one
+        set per band, as a column MultiIndex (band, stat), if `values` is 3D).
+        """
+        sums = self._accumulate(values, valid, window)
+        return self._finish(sums)
+
+    def _accumulate(self, values, valid=None, window=None, sums=None):
+        # running per-cell [count, sum, sum of squares] of every band
+        codes = self.codes if window is None else self.codes[window.toslices()]
+        values = np.ma.asarray(values)
+        values = values.reshape((-1,) + values.shape[-2:])
+        n_cells = len(self.cells)
+        if sums is None:
+            sums = np.zeros((len(values), 3, n_cells))
+        for band, band_values in enumerate(values):
+            ok = ~np.ma.getmaskarray(band_values) & np.isfinite(band_values.filled(np.nan))
+            if valid is not None:
+                ok &= valid
+            v = band_values.data[ok].astype(float)
+            c = codes[ok]
+            sums[band, 0] += np.bincount(c, minlength=n_cells)
+            sums[band, 1] += np.bincount(c, v, minlength=n_cells)
+            sums[band, 2] += np.bincount(c, v*v, minlength=n_cells)
+        return sums
+
+    def _finish(self, sums, band_names=None):
+        index = pd.Index(self.cells, name="cell")
+        frames = []
+        for count, total, squares in sums:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                mean = total / count
+                std = np.sqrt(np.maximum(squares - count * mean**2, 0) / (count - 1))
+            std[count < 2] = np.nan
+            frames.append(pd.DataFrame({"count": count.astype(np.int64), "mean": mean, "std": std}, index=index))
+        if len(frames) == 1 and band_names is None:
+            return frames[0].sort_index()
+        names = band_names if band_names is not None else list(range(len(frames)))
+        return pd.concat(frames, axis=1, keys=names, names=["band", "stat"]).sort_index()
+
+    def zonal_stats_raster(self, fn, bands=None, prefix=None):
+        """
+        Zonal statistics of a raster file with the same grid as the index,
+        read block by block.
+
+        Parameters
+        ----------
+        bands : list of int or None
+            Bands to read (default: all).
+        prefix : string or None
+            Prefix of the band names (default: the file name without extension).
+
+        Returns
+        -------
+        DataFrame indexed by cell with one column per (band, statistic), named
+        "<prefix>_<band description>_<stat>", e.g. "ndvi_diff_mean".
+        """
+        with rasterio.open(fn) as src:
+            if (src.height, src.width) != self.shape or src.transform != self.transform:
+                raise ValueError(f"{fn} is not on the grid of this index")
+            bands = list(bands) if bands is not None else list(src.indexes)
+            names = [src.descriptions[b-1] or str(b) for b in bands]
+            sums = None
+            for _, window in src.block_windows(1):
+                sums = self._accumulate(src.read(bands, window=window, masked=True), window=window, sums=sums)
+        prefix = prefix if prefix is not None else fn.replace("\\", "/").split("/")[-1].rsplit(".", 1)[0]
+        stats = self._finish(sums, band_names=names)
+        stats.columns = [f"{prefix}_{band}_{stat}" for band, stat in stats.columns]
+        return stats
+
+    def rasterize(self, cell_values, fill_value=np.nan):
+        """
+        Paints cell-level values (e.g. one column of compute_metrics() for one
+        time bin) onto the raster grid.
+
+        Parameters
+        ----------
+        cell_values : Series
+            Values indexed by cell id.
+
+        Returns
+        -------
+        (height, width) float array.
+        """
+        per_code = pd.Series(cell_values).reindex(self.cells).to_numpy(dtype=float, na_value=fill_value)
+        return per_code[self.codes]
+
+
+def join_metrics(metrics, zonal, cell_col="cell"):
+    """
+    Joins mobility metrics per (time bin, cell) with the per-cell statistics
+    of the raster products; the raster side is computed once and broadcast to
+    all time bins.
+
+    Parameters
+    ----------
+    metrics : DataFrame
+        Output of compute_metrics() with `region_col`=cell_col.
+    zonal : DataFrame
+        Zonal statistics indexed by cell (see PixelCellIndex.zonal_stats_raster()).
+    """
+    return metrics.join(zonal.rename_axis(cell_col), on=cell_col, how="left")
+
+
+def fuse_event(gdf, product_fns, resolution=17, bin_width="1h", locs=None, location=None, lat="lat", lng="lng"):
+    """
+    Fusion table of one event: mobility metrics per time bin and grid cell,
+    joined with zonal statistics of the raster change products in that cell.
+
+    Parameters
+    ----------
+    gdf : DataFrame
+        Preprocessed points (see preprocess_mobile_data()) with lon/lat coordinates.
+    product_fns : list of string
+        Rasters on the same grid, e.g. the "gray.tif" and "ndvi.tif" of
+        satellite_data.compute_difference_rasters().
+    resolution : int
+        Grid resolution of the cells.
+    bin_width, locs, location :
+        See compute_metrics().
+
+    Returns
+    -------
+    DataFrame indexed by (bin, cell) with the metric columns and e.g.
+    "ndvi_diff_mean", "ndvi_diff_std", "ndvi_diff_count" (pixels in the cell).
+    Cells without pixels have NaN raster statistics.
+    """
+    points = pd.DataFrame({lat: gdf[lat].values, lng: gdf[lng].values, "uid": gdf["uid"].values,
+                           "datetime": gdf["datetime"].values})
+    points["cell"] = grid.cell_ids(points[lng].values, points[lat].values, resolution)
+    metrics = compute_metrics(points, bin_width=bin_width, region_col="cell", locs=locs, location=location, lat=lat, lng=lng)
+
+    index = None
+    zonal = []
+    for fn in product_fns:
+        if index is None:
+            index = PixelCellIndex.from_raster(fn, resolution=resolution)
+        zonal.append(index.zonal_stats_raster(fn))
+    if not zonal:
+        return metrics
+    return join_metrics(metrics, pd.concat(zonal, axis=1))
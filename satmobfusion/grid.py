@@ -0,0 +1,156 @@
+import numpy as np
+
+# cells are Web Mercator quadtree tiles: resolution r splits the world into 2^r x 2^r cells
+# (about 2.4 km at resolution 14 and 150 m at resolution 18 in Tulsa)
+MAX_RESOLUTION = 28
+_MORTON_BITS = 2 * MAX_RESOLUTION
+_MORTON_MASK = (1 << _MORTON_BITS) - 1
+_MAX_LAT = 85.05112878
+
+
+def _spread_bits(v):
+    #insert a zero bit between each of the lower 32 bits of v
+    v = v.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)]:
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def _compact_bits(v):
+    #inverse of _spread_bits
+    v = v.astype(np.uint64) & np.uint64(0x5555555555555555)
+    for shift, mask in [(1, 0x3333333333333333), (2, 0x0F0F0F0F0F0F0F0F), (4, 0x00FF00FF00FF00FF),
+                        (8, 0x0000FFFF0000FFFF), (16, 0x00000000FFFFFFFF)]:
+        v = (v | (v >> np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def _encode(morton, resolution):
+    return (np.uint64(resolution) << np.uint64(_MORTON_BITS) | morton).astype(np.int64)
+
+
+def cell_ids(lon, lat, resolution):
+    """
+    Integer id of the grid cell containing every point.
+
+    Ids carry their resolution in the top bits and the Morton (Z-order) code of
+    the tile below, so the ids of all cells inside a coarser cell form one
+    contiguous range (see cell_range()) and parents are a bit shift away.
+
+    Parameters
+    ----------
+    lon, lat : array-like
+        Coordinates in decimal degrees (WGS84).
+    resolution : int
+        0 (whole world) to MAX_RESOLUTION.
+    """
+    if not 0 <= resolution <= MAX_RESOLUTION:
+        raise ValueError(f"resolution must be between 0 and {MAX_RESOLUTION}, got {resolution}")
+    lon = np.asarray(lon, dtype=float)
+    lat = np.clip(np.asarray(lat, dtype=float), -_MAX_LAT, _MAX_LAT)
+    n = 2**resolution
+    x = np.clip(np.floor((lon + 180.) / 360. * n), 0, n-1).astype(np.uint64)
+    lat_rad = np.radians(lat)
+    y = np.clip(np.floor((1. - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2. * n), 0, n-1).astype(np.uint64)
+    return _encode(_spread_bits(x) | (_spread_bits(y) << np.uint64(1)), resolution)
+
+
+def cell_resolution(ids):
+    """
+    Resolution of every cell id.
+    """
+    return (np.asarray(ids, dtype=np.int64) >> _MORTON_BITS).astype(np.int64)
+
+
+def cell_xy(ids):
+    """
+    Tile column and row (x, y) of every cell id within its resolution.
+    """
+    morton = np.asarray(ids, dtype=np.int64).astype(np.uint64) & np.uint64(_MORTON_MASK)
+    return _compact_bits(morton).astype(np.int64), _compact_bits(morton >> np.uint64(1)).astype(np.int64)
+
+
+def cell_parent(ids, resolution):
+    """
+    Id of the enclosing cell at the coarser `resolution`.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    shift = 2 * (cell_resolution(ids) - resolution)
+    if np.any(shift < 0):
+        raise ValueError("cell_parent() needs a resolution at or below the resolution of the cells")
+    morton = ids.astype(np.uint64) & np.uint64(_MORTON_MASK)
+    return _encode(morton >> shift.astype(np.uint64), resolution)
+
+
+def cell_range(cell, resolution):
+    """
+    Half-open range [lo, hi) of the ids at the finer `resolution` that lie inside `cell`.
+    """
+    shift = np.uint64(2 * (resolution - int(cell_resolution(cell))))
+    morton = np.uint64(int(cell) & _MORTON_MASK)
+    return int(_encode(morton << shift, resolution)), int(_encode((morton + np.uint64(1)) << shift, resolution))
+
+
+def cell_bounds(ids):
+    """
+    Bounds (lon_min, lat_min, lon_max, lat_max) of every cell, as arrays.
+    """
+    x, y = cell_xy(ids)
+    n = 2.**cell_resolution(ids)
+    def lat_of(row):
+        return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * row / n))))
+    return x / n * 360. - 180., lat_of(y + 1), (x + 1) / n * 360. - 180., lat_of(y)
+
+
+def cell_polygons(ids, crs="EPSG:4326"):
+    """
+    GeoSeries with the outline of every cell, e.g. to plot or sjoin cell-level results.
+    """
+    import geopandas as gpd
+    import shapely
+    return gpd.GeoSeries(shapely.box(*cell_bounds(ids)), crs=crs)
+
+
+class CellIndex():
+    """
+    Points sorted by their cell id at a fine resolution.
+
+    Any coarser cell covers a contiguous range of the sorted fine ids, so
+    counting points per cell at any coarser resolution, or selecting the points
+    of one coarse cell (drill-down), uses the sorted ids only and never goes
+    back to the coordinates.
+
+    Parameters
+    ----------
+    lon, lat : array-like
+        Point coordinates in decimal degrees.
+    resolution : int
+        Finest resolution that will be queried.
+    """
+    def __init__(self, lon, lat, resolution=18):
+        self.resolution = resolution
+        ids = cell_ids(lon, lat, resolution)
+        self.order = np.argsort(ids, kind="mergesort")
+        self.ids = ids[self.order]
+
+    def rows(self, cell):
+        """
+        Positions (in the original point order) of the points inside `cell`.
+        """
+        lo, hi = cell_range(cell, self.resolution)
+        return self.order[np.searchsorted(self.ids, lo):np.searchsorted(self.ids, hi)]
+
+    def counts(self, resolution, within=None):
+        """
+        Number of points per cell at `resolution`, optionally only inside the coarser cell `within`.
+
+        Returns
+        -------
+        cells, counts : ndarray
+        """
+        ids = self.ids
+        if within is not None:
+            lo, hi = cell_range(within, self.resolution)
+            ids = ids[np.searchsorted(ids, lo):np.searchsorted(ids, hi)]
+        return np.unique(cell_parent(ids, resolution), return_counts=True)
@@ -0,0 +1,262 @@
+"""
+Stage-level instrumentation: duration, peak memory, row/byte counts and
+reduction ratios of the processing functions, reported to pluggable sinks.
+
+Nothing is measured until a sink is enabled; until then stage() and current()
+return a shared no-op object and instrumented functions call straight through.
+
+    import satmobfusion.instrumentation as instrumentation
+    instrumentation.enable(instrumentation.LoggingSink(), instrumentation.JSONLinesSink("run.jsonl"))
+"""
+import functools
+import json
+import logging
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+_sinks = []
+_track_memory = False
+_local = threading.local() #per-thread stack of open stages
+_memory_lock = threading.Lock()
+_memory_users = 0 #open stages that need tracemalloc
+_started_tracemalloc = False
+#without tracemalloc.reset_peak() (Python < 3.9), the peak of a stage includes earlier allocations
+_reset_peak = getattr(tracemalloc, "reset_peak", lambda: None)
+
+
+class LoggingSink():
+    """
+    Writes one log line per stage, e.g.
+    "preprocess_mobile_data: 2.31 s, peak 512.0 MB, rows_in=1000000 rows_out=81234 reduction=0.919".
+    """
+    def __init__(self, logger="satmobfusion", level=logging.INFO):
+        self.logger = logging.getLogger(logger) if isinstance(logger, str) else logger
+        self.level = level
+
+    def __call__(self, record):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        skip = ("stage", "path", "start", "seconds", "peak_mb", "status")
+        text = f"{record['path']}: {record['seconds']:.3f} s"
+        if record.get("peak_mb") is not None:
+            text += f", peak {record['peak_mb']:.1f} MB"
+        if record["status"] != "ok":
+            text += f", {record['status']}"
+        fields = " ".join(f"{k}={_format(v)}" for k, v in record.items() if k not in skip)
+        self.logger.log(self.level, f"{text}, {fields}" if fields else text)
+
+
+class JSONLinesSink():
+    """
+    Appends every stage as one JSON object per line to `path`.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a")
+
+    def __call__(self, record):
+        line = json.dumps(record, default=_to_json)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def _format(value):
+    return f"{value:.3g}" if isinstance(value, (float, np.floating)) else value
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def enable(*sinks, memory=True):
+    """
+    Starts reporting to `sinks` (callables taking a record dict, e.g.
+    LoggingSink or JSONLinesSink) in addition to the ones enabled before.
+
+    Parameters
+    ----------
+    memory : bool
+        Whether to measure the peak memory of every stage with tracemalloc.
+        This slows down allocation-heavy Python code; concurrently running
+        stages (threads) share one peak.
+    """
+    global _track_memory
+    _sinks.extend(sinks)
+    _track_memory = memory
+
+
+def disable():
+    """
+    Stops reporting and closes the sinks that can be closed.
+    """
+    for sink in _sinks:
+        if hasattr(sink, "close"):
+            sink.close()
+    _sinks.clear()
+
+
+def enabled():
+    return bool(_sinks)
+
+
+def _emit(record):
+    for sink in list(_sinks):
+        sink(record)
+
+
+def _start_memory():
+    global _memory_users, _started_tracemalloc
+    with _memory_lock:
+        if _memory_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracemalloc = True
+        _memory_users += 1
+
+
+def _stop_memory():
+    global _memory_users, _started_tracemalloc
+    with _memory_lock:
+        _memory_users -= 1
+        if _memory_users == 0 and _started_tracemalloc:
+            tracemalloc.stop()
+            _started_tracemalloc = False
+
+
+class Stage():
+    """
+    Measures one run of a processing stage; use stage() to create it.
+
+    Counts are attached with record() (set) or add() (increment). Known counts
+    get derived fields: rows_in/rows_out give "reduction" (share of rows
+    removed) and "rows_per_s", bytes gives "mb_per_s".
+    """
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.parent = None
+        self.peak = 0
+
+    def record(self, **fields):
+        self.fields.update(fields)
+        return self
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.fields[key] = self.fields.get(key, 0) + value
+        return self
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault("stack", [])
+        self.parent = stack[-1] if stack else None
+        self.path = f"{self.parent.path}/{self.name}" if self.parent is not None else self.name
+        self.memory = _track_memory
+        if self.memory:
+            _start_memory()
+            current_mem, peak = tracemalloc.get_traced_memory()
+            if self.parent is not None and self.parent.memory:
+                self.parent.peak = max(self.parent.peak, peak)
+            _reset_peak()
+            self.start_memory = current_mem
+        stack.append(self)
+        self.start = time.time()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.t0
+        _local.stack.pop()
+        peak_mb = None
+        if self.memory:
+            peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            peak_mb = (peak - self.start_memory) / 1e6
+            if self.parent is not None and self.parent.memory:
+                self.parent.peak = max(self.parent.peak, peak)
+            _stop_memory()
+
+        record = {"stage": self.name, "path": self.path, "start": self.start, "seconds": seconds, "peak_mb": peak_mb,
+                  "status": "ok" if exc_type is None else f"error: {exc_type.__name__}: {exc}"}
+        record.update(self.fields)
+        if "rows_in" in self.fields:
+            record["rows_per_s"] = self.fields["rows_in"] / seconds if seconds > 0 else None
+            if self.fields.get("rows_out") is not None and self.fields["rows_in"] > 0:
+                record["reduction"] = 1 - self.fields["rows_out"] / self.fields["rows_in"]
+        if "bytes" in self.fields:
+            record["mb_per_s"] = self.fields["bytes"] / 1e6 / seconds if seconds > 0 else None
+        _emit(record)
+        return False
+
+
+class _NullStage():
+    # stand-in while instrumentation is disabled
+    def record(self, **fields):
+        return self
+
+    def add(self, **counts):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name, **fields):
+    """
+    Context manager measuring the enclosed block as stage `name`; a no-op if
+    no sink is enabled.
+
+        with instrumentation.stage("download", ID=ID) as s:
+            ...
+            s.add(bytes=len(chunk))
+    """
+    return Stage(name, **fields) if _sinks else _NULL_STAGE
+
+
+def current():
+    """
+    Innermost open stage of this thread (a no-op stand-in if there is none),
+    for attaching counts from inside an instrumented function.
+    """
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if (_sinks and stack) else _NULL_STAGE
+
+
+def instrumented(name=None):
+    """
+    Decorator running every call of the function as a stage named `name`
+    (default: the function name).
+    """
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return func(*args, **kwargs)
+            with Stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def event(name, **fields):
+    """
+    Reports a point in time (e.g. "asset active") as a stage of zero duration.
+    """
+    if _sinks:
+        with Stage(name, **fields):
+            pass
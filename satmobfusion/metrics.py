@@ -0,0 +1,209 @@
+import numpy as np
+import pandas as pd
+
+from satmobfusion.trajectory import haversine
+
+PERIODS = ["pre", "during", "post"]
+
+
+def to_local_time(datetimes, timezone):
+    """
+    Converts timestamps to `timezone`; naive timestamps (as produced by
+    preprocess_mobile_data() from unix timestamps) are taken as UTC.
+    """
+    datetimes = pd.DatetimeIndex(datetimes)
+    if datetimes.tz is None:
+        datetimes = datetimes.tz_localize("UTC")
+    return datetimes.tz_convert(timezone)
+
+
+def label_event_periods(datetimes, locs, location, resolution="D"):
+    """
+    Labels timestamps as "pre", "during" or "post" event.
+
+    The event window is taken from the "date_event_begin"/"date_event_end" and
+    "timezone" columns of the locations file (see convenience.read_locations()).
+
+    Parameters
+    ----------
+    datetimes : array-like of datetimes
+        Naive timestamps are taken as UTC.
+    locs : DataFrame
+        Event configuration, indexed by location.
+    location : string
+        Row of `locs` to use.
+    resolution : string or None
+        If given, the event window is widened to whole units of this frequency
+        in local time; with the default "D" every point on the day(s) of the
+        event counts as "during", as in the Tulsa analysis.
+        If None, "during" is exactly [date_event_begin, date_event_end].
+
+    Returns
+    -------
+    Ordered Categorical with the categories in PERIODS.
+    """
+    timezone = locs.loc[location, "timezone"]
+    local = to_local_time(datetimes, timezone)
+    begin = pd.Timestamp(locs.loc[location, "date_event_begin"]).tz_convert(timezone)
+    end = pd.Timestamp(locs.loc[location, "date_event_end"]).tz_convert(timezone)
+    if resolution is not None:
+        begin = begin.floor(resolution)
+        is_post = local >= end.floor(resolution) + pd.tseries.frequencies.to_offset(resolution)
+    else:
+        is_post = local > end
+    labels = np.where(local < begin, "pre", np.where(is_post, "post", "during"))
+    return pd.Categorical(labels, categories=PERIODS, ordered=True)
+
+
+def _grouped_mean_std(values, groups, n_groups):
+    # mean and sample standard deviation (ddof=1, like pandas) per group, two passes over the values
+    count = np.bincount(groups, minlength=n_groups)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.bincount(groups, values, minlength=n_groups) / count
+        dev = values - mean[groups]
+        std = np.sqrt(np.bincount(groups, dev**2, minlength=n_groups) / (count - 1))
+    std[count < 2] = np.nan
+    return mean, std, count
+
+
+def compute_metrics(gdf, bin_width="1h", region_col=None, locs=None, location=None, period_resolution="D",
+                    lat="lat", lng="lng", uid="uid", datetime="datetime"):
+    """
+    Mobility metrics per time bin (and region) in a single vectorized pass.
+
+    Replaces the per-period `groupby(['date','hour']).apply(...)` calls of the
+    skmob measures: every point is assigned to a (time bin, region) group once,
+    and all aggregates are computed with bincounts over the group codes.
+
+    Parameters
+    ----------
+    gdf : DataFrame or GeoDataFrame
+        Preprocessed points (see preprocess_mobile_data()).
+    bin_width : string
+        pandas frequency of the time bins, e.g. "1h" or "15min".
+    region_col : string or None
+        Column with a region id per point, e.g. a census tract or an integer
+        grid cell from grid.cell_ids(). If None, all points form one region.
+    locs, location : DataFrame, string
+        Event configuration (see convenience.read_locations()). If given, bins
+        are in the location's local time and labeled with their event period.
+    period_resolution : string or None
+        See label_event_periods().
+
+    Returns
+    -------
+    DataFrame indexed by "bin" (and `region_col`) with the columns
+    n_visits : number of points
+    n_users : number of unique users
+    radius_of_gyration, radius_of_gyration_std : mean and std over users of their radius of gyration in km
+    jump_length, jump_length_std, n_jumps : statistics of the distances in km between consecutive points of a user
+    period : "pre", "during" or "post" (only if `locs` is given)
+    """
+    times = pd.DatetimeIndex(gdf[datetime])
+    if locs is not None:
+        times = to_local_time(times, locs.loc[location, "timezone"])
+    keys = {"bin": times.floor(bin_width)}
+    if region_col is not None:
+        keys[region_col] = gdf[region_col].values
+    keys = pd.DataFrame(keys)
+    grouped = keys.groupby(list(keys.columns), sort=True, dropna=False)
+    groups = grouped.ngroup().values
+    index = grouped.size().index
+    n_groups = len(index)
+
+    lat_values = np.asarray(gdf[lat], dtype=float)
+    lng_values = np.asarray(gdf[lng], dtype=float)
+    users = pd.factorize(gdf[uid])[0].astype(np.int64)
+
+    #(group, user) pairs: radius of gyration around each user's center of mass within the group
+    pairs = pd.factorize(groups.astype(np.int64) * (users.max(initial=0) + 1) + users)[0]
+    n_pairs = pairs.max(initial=-1) + 1
+    n_points = np.bincount(pairs, minlength=n_pairs)
+    com_lat = np.bincount(pairs, lat_values, minlength=n_pairs) / n_points
+    com_lng = np.bincount(pairs, lng_values, minlength=n_pairs) / n_points
+    dist = haversine(lat_values, lng_values, com_lat[pairs], com_lng[pairs])
+    rg = np.sqrt(np.bincount(pairs, dist**2, minlength=n_pairs) / n_points)
+    pair_group = np.zeros(n_pairs, dtype=np.int64)
+    pair_group[pairs] = groups
+    rg_mean, rg_std, n_users = _grouped_mean_std(rg, pair_group, n_groups)
+
+    #jumps between consecutive points of the same user within the same group
+    order = np.lexsort((times.asi8, users, groups))
+    same = (groups[order][1:] == groups[order][:-1]) & (users[order][1:] == users[order][:-1])
+    src, dst = order[:-1][same], order[1:][same]
+    jumps = haversine(lat_values[src], lng_values[src], lat_values[dst], lng_values[dst])
+    jump_mean, jump_std, n_jumps = _grouped_mean_std(jumps, groups[dst], n_groups)
+
+    metrics = pd.DataFrame({
+        "n_visits": np.bincount(groups, minlength=n_groups),
+        "n_users": n_users,
+        "radius_of_gyration": rg_mean,
+        "radius_of_gyration_std": rg_std,
+        "jump_length": jump_mean,
+        "jump_length_std": jump_std,
+        "n_jumps": n_jumps,
+    }, index=index)
+    if locs is not None:
+        metrics["period"] = label_event_periods(index.get_level_values("bin"), locs, location, resolution=period_resolution)
+    return metrics
+
+
+def hourly_profile(metrics, column="n_visits"):
+    """
+    Mean, std and number of days of a metric per event period and hour of day,
+    i.e. the daily profiles compared in the Tulsa analysis.
+
+    Parameters
+    ----------
+    metrics : DataFrame
+        Output of compute_metrics() with a "period" column.
+    """
+    bins = metrics.index.get_level_values("bin")
+    return metrics.groupby([metrics["period"], bins.hour.rename("hour")], observed=True)[column].agg(["mean", "std", "count"])
+
+
+def location_frequency(df, cell_col="cell", by=None, uid="uid", normalize=True):
+    """
+    Visits of every user to every location, with locations given as integer
+    cell ids (see grid.cell_ids()) instead of raw coordinates.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Points with a uid and a cell id column.
+    by : list of str or None
+        Extra grouping columns, e.g. ["date"] or ["period"].
+    normalize : bool
+        If True, the share of the user's points in the cell, otherwise the number of points.
+
+    Returns
+    -------
+    DataFrame with the columns `by` + [uid, cell_col, "location_frequency"].
+    """
+    keys = list(by or []) + [uid]
+    visits = df.groupby(keys + [cell_col], sort=False, observed=True).size().rename("location_frequency")
+    if normalize:
+        visits = visits / visits.groupby(level=keys, sort=False).transform("sum")
+    return visits.reset_index()
+
+
+def location_entropy(df, cell_col="cell", by=None, uid="uid"):
+    """
+    Entropy of the visitors of every cell.
+
+    Returns
+    -------
+    DataFrame indexed by `by` + [cell_col] with the columns
+    n_users : number of distinct users
+    random_location_entropy : log2(n_users), as in skmob.measures.collective
+    uncorrelated_location_entropy : -sum p_u log2(p_u) over the users' shares p_u of the cell's visits
+    """
+    keys = list(by or []) + [cell_col]
+    visits = df.groupby(keys + [uid], sort=False, observed=True).size()
+    share = visits / visits.groupby(level=keys, sort=False).transform("sum")
+    n_users = share.groupby(level=keys).size()
+    return pd.DataFrame({
+        "n_users": n_users,
+        "random_location_entropy": np.log2(n_users),
+        "uncorrelated_location_entropy": (-share * np.log2(share)).groupby(level=keys).sum(),
+    })
@@ -1,66 +1,376 @@
-import skmob
-import geopandas as gpd
+import logging
+import os
+import numpy as np
 import pandas as pd
 
+import satmobfusion.instrumentation as instrumentation
+import satmobfusion.projection as projection
+import satmobfusion.trajectory as trajectory
+
+# compact dtypes for the columns of a Spectus export; columns missing from a file are ignored
+MOBILE_DTYPES = {'uid': 'category', 'lat': 'float32', 'lon': 'float32', 'timestamp': 'int64'}
+
+log = logging.getLogger(__name__)
+
 class mobiledatamodule():
-    def __init__(self, data=None, file_path=None):
+    def __init__(self, data=None, file_path=None, cache=None, cache_key=None):
         self.file_path = file_path
+        # a TrajectoryCache entry can back the module instead of in-memory data
+        self.cache = cache
+        self.cache_key = cache_key
+        self.data = None
 
         if file_path is not None:
             self.read_data(file_path)
         elif data is not None:
             self.data = data
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        # new data invalidates the lookup indices; they are rebuilt lazily
+        self._data = data
+        self._time_index = None
+        self._uid_index = None
+
+    def build_time_index(self, datetime='datetime'):
+        """
+        Keeps the sorted timestamps and the row positions they come from (rows
+        with NaT are left out), so that subset_by_time() is a binary search
+        (O(log n + k) instead of a full scan) and no copy of the data is kept.
+        If the data is already sorted by time, no positions are needed and
+        windows are slices (views) of self.data.
+        """
+        times = pd.DatetimeIndex(self.data[datetime])
+        valid = ~times.isna()
+        if valid.all() and times.is_monotonic_increasing:
+            positions = None
+        else:
+            positions = np.flatnonzero(valid)
+            positions = positions[np.argsort(times.asi8[positions], kind='stable')]
+            times = times[positions]
+        self._time_index = (datetime, times, positions)
+        return self._time_index
+
+    def build_uid_index(self):
+        """
+        Keeps the row range of every user in a stable ordering of the rows by uid
+        (points of a user keep their order), so that choose_user() is a dictionary
+        lookup plus a slice; no copy of the data is kept. If the data is already
+        sorted by uid, the ordering is not needed and users are slices (views) of self.data.
+        """
+        codes, uids = pd.factorize(self.data['uid'], sort=True)
+        order = None if (np.diff(codes) >= 0).all() else np.argsort(codes, kind='stable')
+        sorted_codes = codes if order is None else codes[order]
+        starts, ends = trajectory.group_bounds(sorted_codes)
+        keep = sorted_codes[starts] >= 0 #rows without uid
+        ranges = dict(zip(uids[sorted_codes[starts[keep]]], zip(starts[keep], ends[keep])))
+        self._uid_index = (ranges, order)
+        return self._uid_index
     
-    def read_data(self, file_path):
-        self.data = pd.read_csv(file_path)
+    @instrumentation.instrumented("mobiledatamodule.read_data")
+    def read_data(self, file_path, chunksize=None, dtype=None):
+        if chunksize is not None:
+            # out-of-core mode: hand back a chunk iterator and leave self.data untouched
+            return iter_mobile_data(file_path, chunksize=chunksize, dtype=dtype or MOBILE_DTYPES)
+        self.data = pd.read_csv(file_path, dtype=dtype)
+        instrumentation.current().record(rows_out=len(self.data), bytes=os.path.getsize(file_path))
         return self.data
     
-    def read_as_gdf(self, crs, lat='lat', lng='lon'):
-        self.data_gdf = gpd.GeoDataFrame(self.data, crs=crs, geometry=gpd.points_from_xy(df[lng], df[lat]))
+    @instrumentation.instrumented("mobiledatamodule.read_as_gdf")
+    def read_as_gdf(self, crs, lat='lat', lng='lon', out_crs=None):
+        # with out_crs, the coordinates are transformed as arrays and the geometry is built directly in out_crs
+        instrumentation.current().record(rows_in=len(self.data))
+        self.data_gdf = projection.points_gdf(self.data, crs, out_crs=out_crs, lng=lng, lat=lat)
         return self.data_gdf
     
+    @instrumentation.instrumented("mobiledatamodule.add_datetime")
     def add_datetime(self, time_col = 'timestamp', unit='s'):
+        instrumentation.current().record(rows_in=len(self.data))
         self.data['datetime'] = pd.to_datetime(self.data[time_col], unit=unit)
+        self.data = self.data
+
+    def _from_cache(self):
+        return (self.data is None) & (self.cache is not None)
 
+    @instrumentation.instrumented("mobiledatamodule.choose_user")
     def choose_user(self, uid):
-        return self.data[self.data.uid == uid]
+        """
+        Points of user `uid` in their original order. They keep their row labels
+        of self.data (no reset_index()), and are a view of it if the data is
+        sorted by uid. Read from a cache, they are indexed 0..n-1.
+        """
+        if self._from_cache():
+            user = self.cache.read(self.cache_key, uid=uid)
+        else:
+            uid_ranges, order = self._uid_index or self.build_uid_index()
+            lo, hi = uid_ranges.get(uid, (0, 0))
+            user = self.data.iloc[lo:hi] if order is None else self.data.take(order[lo:hi])
+        instrumentation.current().record(rows_out=len(user))
+        return user
     
+    @instrumentation.instrumented("mobiledatamodule.subset_by_time")
     def subset_by_time(self, starttime, endtime, datetime='datetime'):
-        if (starttime is not None) & (endtime is not None):
-            return self.data[(self.data[datetime] >= starttime) & (self.data[datetime] <= endtime)].reset_index()
-        elif (starttime is not None) & (endtime is None):
-            return self.data[self.data[datetime] >= starttime].reset_index()
-        elif (endtime is not None) & (starttime is None):
-            return self.data[self.data[datetime] <= endtime].reset_index()
+        """
+        Points with `starttime` <= datetime <= `endtime` (either bound can be None)
+        in their original order. They keep their row labels of self.data (no
+        reset_index()), and are a view of it if the data is sorted by time. Read
+        from a cache, they are indexed 0..n-1.
+        """
+        if self._from_cache():
+            subset = self.cache.read(self.cache_key, starttime=starttime, endtime=endtime)
+        else:
+            if (self._time_index is None) or (self._time_index[0] != datetime):
+                self.build_time_index(datetime)
+            _, times, positions = self._time_index
+            # both bounds are inclusive; rows keep their original order and labels
+            lo = 0 if starttime is None else times.searchsorted(pd.Timestamp(starttime), side='left')
+            hi = len(times) if endtime is None else times.searchsorted(pd.Timestamp(endtime), side='right')
+            subset = self.data.iloc[lo:hi] if positions is None else self.data.take(np.sort(positions[lo:hi]))
+        instrumentation.current().record(rows_out=len(subset))
+        return subset
     
+    @instrumentation.instrumented("mobiledatamodule.subset_by_geo")
     def subset_by_geo(self, geo_df, data_gdf=None, how='left', predicate='predicate'):
         if (self.data_gdf is None) & (data_gdf is None):
             return "Please run the read_as_gdf() function or pass a GeoDataFrame as an argument!"
         else:
-            return gpd.sjoin(data_gdf, geo_df, how=how, predicate=predicate)
+            import geopandas as gpd
+            joined = gpd.sjoin(data_gdf, geo_df, how=how, predicate=predicate)
+            instrumentation.current().record(rows_in=len(data_gdf), rows_out=len(joined))
+            return joined
 
 
-def preprocess_mobile_data(df, state_df=None, crs='EPSG:4269', max_speed_kmh=400, spatial_radius_km=0.2):
-    gdf = gpd.GeoDataFrame(df, crs=crs, geometry=gpd.points_from_xy(df['lon'], df['lat']))
+@instrumentation.instrumented()
+def clip_to_region(lon, lat, region_df, columns=None, crs='EPSG:4269', chunksize=1_000_000):
+    """
+    Point-in-region test for raw coordinate arrays; a lightweight replacement for
+    gpd.sjoin(points, region_df, predicate='within').
 
-    # Exclude points outside of relevant state
+    Points outside the bounding box of `region_df` are discarded with a cheap
+    vectorized comparison; only the remaining ones are turned into geometries and
+    tested against the polygons through the STRtree of `region_df.sindex`.
+    Points are processed `chunksize` at a time.
+
+    Parameters
+    ----------
+    lon, lat : array-like
+        Point coordinates in `crs`.
+    region_df : GeoDataFrame
+        Region polygons, e.g. census tracts; reprojected to `crs` if needed.
+    columns : list of str or None
+        Region columns to return. If None, only a boolean mask is returned.
+
+    Returns
+    -------
+    ndarray of bool (True for points inside any region) if `columns` is None,
+    else a DataFrame with the requested columns for the points inside a region,
+    indexed by point position (first match if regions overlap).
+    """
+    import geopandas as gpd
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    instrumentation.current().record(rows_in=len(lon))
+    if region_df.crs is not None and crs is not None and not region_df.crs.equals(crs):
+        region_df = region_df.to_crs(crs)
+    minx, miny, maxx, maxy = region_df.total_bounds
+    sindex = region_df.sindex
+
+    inside = np.zeros(len(lon), dtype=bool)
+    match = np.full(len(lon), -1, dtype=np.int64)
+    for lo in range(0, len(lon), chunksize):
+        x, y = lon[lo:lo+chunksize], lat[lo:lo+chunksize]
+        candidates = np.flatnonzero((x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy))
+        if len(candidates) == 0:
+            continue
+        point_idx, region_idx = sindex.query(gpd.points_from_xy(x[candidates], y[candidates]), predicate='within')
+        #keep the first region per point if regions overlap
+        point_idx, first = np.unique(point_idx, return_index=True)
+        hits = lo + candidates[point_idx]
+        inside[hits] = True
+        match[hits] = region_idx[first]
+
+    instrumentation.current().record(rows_out=int(inside.sum()))
+    if columns is None:
+        return inside
+    hits = np.flatnonzero(inside)
+    regions = region_df[list(columns)].iloc[match[hits]]
+    regions.index = hits
+    return pd.DataFrame(regions)
+
+
+@instrumentation.instrumented()
+def preprocess_mobile_data(df, state_df=None, crs='EPSG:4269', max_speed_kmh=400, spatial_radius_km=0.2, engine='numpy', n_jobs=1,
+                           region_cols=None, cache=None, source=None, out_crs=None):
+    if engine not in ('numpy', 'skmob'):
+        raise ValueError(f"engine must be 'numpy' or 'skmob', got {engine!r}")
+    if n_jobs != 1 and engine != 'numpy':
+        raise ValueError("n_jobs != 1 is only supported with engine='numpy'")
+    stage = instrumentation.current().record(rows_in=len(df), engine=engine, n_jobs=n_jobs)
+
+    # Reuse the output of an earlier run with the same input and parameters
+    # (`cache` is a TrajectoryCache or a folder, `source` the path of the raw export if df was read from one)
+    if cache is not None:
+        from satmobfusion.cache import TrajectoryCache
+        if not isinstance(cache, TrajectoryCache):
+            cache = TrajectoryCache(cache)
+        cache_key = cache.key(df if source is None else source, crs, max_speed_kmh, spatial_radius_km,
+                              region_df=state_df, region_cols=region_cols)
+        if cache_key in cache:
+            log.info('Reading preprocessed points from cache: %s', cache.path(cache_key))
+            gdf = cache.read(cache_key, out_crs=out_crs)
+            stage.record(cache='hit', rows_out=len(gdf))
+            return gdf
+
+    # Exclude points outside of relevant state, optionally tagging the kept points with region ids
     if state_df is not None:
-        gdf = gpd.sjoin(gdf, state_df, how='left', predicate='within')
+        if region_cols is None:
+            df = df[clip_to_region(df['lon'].values, df['lat'].values, state_df, crs=crs)]
+        else:
+            regions = clip_to_region(df['lon'].values, df['lat'].values, state_df, columns=region_cols, crs=crs)
+            df = df.iloc[regions.index].reset_index(drop=True)
+            df[list(region_cols)] = regions.values
 
-    # Create datetime column using timestamps
-    gdf['datetime'] = pd.to_datetime(gdf['timestamp'], unit='s')
+    # Create datetime column using timestamps; no geometry is needed until the output is built
+    gdf = df.assign(datetime=pd.to_datetime(df['timestamp'], unit='s'))
 
     # Keep first 13 columns
     #comp1_gpd = comp1_gpd.iloc[:, :13]
     # Create a date column
     #comp1_gpd['date'] = comp1_gpd['datetime'].dt.date
-    tdf = skmob.TrajDataFrame(gdf, latitude='lat', longitude='lon', datetime='datetime', user_id='uid')
-    print('Original number of points: ', tdf.shape[0])
-    f_tdf = skmob.preprocessing.filtering.filter(tdf, max_speed_kmh=max_speed_kmh, include_loops=False)
-    print('Number of points after filtering: ', f_tdf.shape[0])
-    fc_tdf = skmob.preprocessing.compression.compress(f_tdf, spatial_radius_km=spatial_radius_km)
-    print('Number of points after compression: ', fc_tdf.shape[0])
-
-    preproc_gdf = gpd.GeoDataFrame(fc_tdf, crs=crs, geometry=gpd.points_from_xy(fc_tdf['lng'], fc_tdf['lat']))
-    preproc_gdf['datetime'] = pd.to_datetime(preproc_gdf['datetime'], format='%Y-%m-%d %H:%M:%S')  
-    return preproc_gdf  
\ No newline at end of file
+    # The NumPy engine only needs the TrajDataFrame column names, so skmob is imported for its own engine only
+    if engine == 'skmob':
+        import skmob
+        tdf = skmob.TrajDataFrame(gdf, latitude='lat', longitude='lon', datetime='datetime', user_id='uid')
+    else:
+        tdf = gdf.rename(columns={'lon': 'lng'})
+    stage.record(rows_in_region=tdf.shape[0])
+    if n_jobs != 1:
+        fc_tdf = parallel_preprocess(tdf, max_speed_kmh=max_speed_kmh, spatial_radius_km=spatial_radius_km, n_jobs=n_jobs)
+    else:
+        with instrumentation.stage('filter', rows_in=tdf.shape[0]) as s:
+            if engine == 'numpy':
+                f_tdf = trajectory.filter_trajectories(tdf, max_speed_kmh=max_speed_kmh)
+            else:
+                f_tdf = skmob.preprocessing.filtering.filter(tdf, max_speed_kmh=max_speed_kmh, include_loops=False)
+            s.record(rows_out=f_tdf.shape[0])
+        stage.record(rows_filtered=f_tdf.shape[0])
+        with instrumentation.stage('compress', rows_in=f_tdf.shape[0]) as s:
+            if engine == 'numpy':
+                fc_tdf = trajectory.compress_trajectories(f_tdf, spatial_radius_km=spatial_radius_km)
+            else:
+                fc_tdf = skmob.preprocessing.compression.compress(f_tdf, spatial_radius_km=spatial_radius_km)
+            s.record(rows_out=fc_tdf.shape[0])
+    stage.record(rows_out=fc_tdf.shape[0])
+
+    # Geometry is built once, from the compressed points (directly in out_crs if given)
+    preproc_df = pd.DataFrame(fc_tdf)
+    preproc_df['datetime'] = pd.to_datetime(preproc_df['datetime'], format='%Y-%m-%d %H:%M:%S')
+
+    if cache is not None:
+        cache.write(cache_key, preproc_df, crs=crs)
+    return projection.points_gdf(preproc_df, crs, out_crs=out_crs)
+
+
+@instrumentation.instrumented()
+def parallel_preprocess(tdf, max_speed_kmh=400, spatial_radius_km=0.2, n_jobs=-1):
+    """
+    Filters and compresses a TrajDataFrame on all cores.
+
+    Users are split into batches of similar point count that are processed in a
+    process pool (see trajectory.parallel_filter_compress()). The result is
+    identical to running the 'numpy' engine of preprocess_mobile_data() serially.
+
+    Parameters
+    ----------
+    tdf : TrajDataFrame
+        Points with columns 'lat', 'lng', 'datetime' and 'uid'.
+    n_jobs : int
+        Number of worker processes; -1 uses all cores.
+
+    Returns
+    -------
+    TrajDataFrame of compressed points, sorted by uid and datetime.
+    """
+    tdf = tdf.sort_values(['uid', 'datetime'], kind='mergesort')
+    t = tdf['datetime'].values.astype('datetime64[ns]').astype('int64') / 1e9
+    anchors, median_lat, median_lng, n_filtered = trajectory.parallel_filter_compress(
+        tdf['lat'].values, tdf['lng'].values, t, pd.factorize(tdf['uid'])[0],
+        max_speed_kmh=max_speed_kmh, spatial_radius_km=spatial_radius_km, n_jobs=n_jobs)
+    instrumentation.current().record(rows_in=len(tdf), rows_filtered=n_filtered, rows_out=len(anchors), n_jobs=n_jobs)
+
+    fc_tdf = tdf.iloc[anchors].reset_index(drop=True)
+    fc_tdf['lat'] = median_lat
+    fc_tdf['lng'] = median_lng
+    return fc_tdf
+
+
+def iter_mobile_data(file_path, chunksize=1_000_000, dtype=MOBILE_DTYPES):
+    """
+    Reads a Spectus export in chunks of `chunksize` rows with compact dtypes.
+
+    Returns
+    -------
+    pandas TextFileReader, iterating over DataFrames of at most `chunksize` rows.
+    """
+    # the chunks are read lazily, so they are measured by the consumer (e.g. shard_mobile_data())
+    return pd.read_csv(file_path, chunksize=chunksize, dtype=dtype)
+
+
+@instrumentation.instrumented()
+def shard_mobile_data(file_path, shard_dir, n_shards=16, chunksize=1_000_000, dtype=MOBILE_DTYPES):
+    """
+    Partitions a Spectus export into `n_shards` CSV files by a hash of `uid`.
+
+    All points of a user end up in the same shard, so every shard can be
+    preprocessed on its own. Only one chunk is held in memory at a time.
+
+    Returns
+    -------
+    list of paths to the non-empty shards.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    paths = [os.path.join(shard_dir, f"shard_{i:04d}.csv") for i in range(n_shards)]
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
+    stage = instrumentation.current().record(bytes=os.path.getsize(file_path), n_shards=n_shards)
+    for chunk in iter_mobile_data(file_path, chunksize=chunksize, dtype=dtype):
+        stage.add(rows_in=len(chunk), chunks=1)
+        # hashing is done on the uid values (not the per-chunk category codes), so it is stable across chunks
+        shard_ids = pd.util.hash_pandas_object(chunk['uid'], index=False).values % n_shards
+        for shard_id, part in chunk.groupby(shard_ids, sort=False):
+            path = paths[shard_id]
+            part.to_csv(path, mode='a', header=not os.path.isfile(path), index=False)
+
+    return [path for path in paths if os.path.isfile(path)]
+
+
+def preprocess_mobile_data_chunked(file_path, shard_dir, state_df=None, crs='EPSG:4269', max_speed_kmh=400, spatial_radius_km=0.2,
+                                   n_shards=16, chunksize=1_000_000, dtype=MOBILE_DTYPES, engine='numpy', n_jobs=1,
+                                   region_cols=None, out_crs=None):
+    """
+    Out-of-core version of preprocess_mobile_data().
+
+    The export is first partitioned into uid shards on disk (see shard_mobile_data()),
+    then state clipping, filtering and compression run one shard at a time.
+    Peak memory is bounded by the size of the largest shard, not by the size of the file;
+    increase `n_shards` if a single shard does not fit.
+    Every shard is reported as one stage (the consumer's work between shards is not included).
+
+    Yields
+    ------
+    GeoDataFrame of preprocessed points, one per shard.
+    """
+    for i, path in enumerate(shard_mobile_data(file_path, shard_dir, n_shards=n_shards, chunksize=chunksize, dtype=dtype)):
+        with instrumentation.stage("preprocess_mobile_data_chunked", shard=i) as stage:
+            shard = pd.read_csv(path, dtype=dtype)
+            gdf = preprocess_mobile_data(shard, state_df=state_df, crs=crs, max_speed_kmh=max_speed_kmh,
+                                         spatial_radius_km=spatial_radius_km, engine=engine, n_jobs=n_jobs,
+                                         region_cols=region_cols, out_crs=out_crs)
+            stage.record(rows_in=len(shard), rows_out=len(gdf), bytes=os.path.getsize(path))
+        yield gdf
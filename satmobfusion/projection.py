@@ -0,0 +1,96 @@
+from functools import lru_cache
+
+import numpy as np
+
+#pyproj is imported by the functions that need it; the transformers and CRS comparisons are cached anyway
+
+
+def _crs_key(crs):
+    # hashable, canonical form of anything pyproj.CRS accepts (strings, EPSG codes, pyproj/rasterio CRS objects)
+    if isinstance(crs, (str, int)):
+        return crs
+    import pyproj
+    return pyproj.CRS.from_user_input(crs).to_wkt()
+
+
+@lru_cache(maxsize=64)
+def _transformer(crs_from, crs_to):
+    import pyproj
+    return pyproj.Transformer.from_crs(crs_from, crs_to, always_xy=True)
+
+
+def get_transformer(crs_from, crs_to):
+    """
+    pyproj.Transformer from `crs_from` to `crs_to` (x/lon first), created once per CRS pair.
+    """
+    return _transformer(_crs_key(crs_from), _crs_key(crs_to))
+
+
+@lru_cache(maxsize=64)
+def _same_crs(crs_a, crs_b):
+    import pyproj
+    return crs_a == crs_b or pyproj.CRS.from_user_input(crs_a) == pyproj.CRS.from_user_input(crs_b)
+
+
+def same_crs(crs_a, crs_b):
+    """
+    True if both CRS are equivalent (e.g. 'EPSG:4326' and 4326).
+    """
+    return _same_crs(_crs_key(crs_a), _crs_key(crs_b))
+
+
+def transform_coords(x, y, crs_from, crs_to):
+    """
+    Transforms coordinate arrays without building geometries.
+
+    Parameters
+    ----------
+    x, y : array-like
+        Coordinates in `crs_from`, x/longitude first.
+
+    Returns
+    -------
+    x, y : ndarray (float64)
+        Coordinates in `crs_to`.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if same_crs(crs_from, crs_to):
+        return x, y
+    return get_transformer(crs_from, crs_to).transform(x, y)
+
+
+def transform_bounds(bounds, crs_from, crs_to, densify_pts=21):
+    """
+    Bounds (left, bottom, right, top) in `crs_to` that enclose `bounds` given in
+    `crs_from`; the edges are densified so that curved edges are covered.
+    """
+    if same_crs(crs_from, crs_to):
+        return tuple(float(b) for b in bounds)
+    return get_transformer(crs_from, crs_to).transform_bounds(*bounds, densify_pts=densify_pts)
+
+
+def window_from_bounds(bounds, crs, src):
+    """
+    rasterio Window of the open dataset `src` covering `bounds` (left, bottom, right, top) given in `crs`,
+    e.g. the lon/lat bounds of an event in locations.csv.
+    """
+    import rasterio.windows
+    return rasterio.windows.from_bounds(*transform_bounds(bounds, crs, src.crs), transform=src.transform)
+
+
+def points_gdf(df, crs, out_crs=None, lng='lng', lat='lat'):
+    """
+    GeoDataFrame of point geometries built from the `lng`/`lat` columns of `df`.
+
+    If `out_crs` is given, the coordinate arrays are transformed first and the
+    geometry is built directly in `out_crs` (instead of building it in `crs`
+    and reprojecting the whole GeoDataFrame); the `lng`/`lat` columns keep the
+    original coordinates.
+    """
+    import geopandas as gpd
+    x, y = df[lng].values, df[lat].values
+    if out_crs is not None:
+        x, y = transform_coords(x, y, crs, out_crs)
+        crs = out_crs
+    return gpd.GeoDataFrame(df, crs=crs, geometry=gpd.points_from_xy(x, y))
@@ -0,0 +1,391 @@
+"""
+Runs the SatMobFusion pipeline for many events (rows of config/locations.csv) at once.
+
+Every event is split into stages that depend on each other:
+
+    search -> select -> download -> raster_diff -> fusion
+    mobile -> metrics                 mobile ----^
+    mobile -> stays
+
+Independent stages of all events run in parallel in a process pool. A stage
+is skipped if it finished before with the same key, a content hash of its
+parameters, the event configuration and its inputs (raw mobile data and the
+outputs of the stages it depends on). Search results are only reused on the
+day they were fetched. The wall time of every stage (and, with --trace-memory,
+its peak memory) is written to a JSON run report.
+
+Example (from the repository root):
+
+    satmobfusion --events Tulsa_small Champaign --workers 4
+"""
+import argparse
+import datetime as dt
+import hashlib
+import json
+import logging
+import os
+import time
+import tracemalloc
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import pandas as pd
+
+import satmobfusion.convenience as c
+from satmobfusion.cache import file_hash
+
+#stage -> stages it depends on
+STAGES = {
+    "search": [],
+    "select": ["search"],
+    "download": ["select"],
+    "raster_diff": ["download"],
+    "mobile": [],
+    "metrics": ["mobile"],
+    "stays": ["mobile"],
+    "fusion": ["mobile", "raster_diff"],
+}
+#parameters that change the result of a stage
+STAGE_PARAMS = {
+    "search": ["max_cloud_cover", "item_type"],
+    "select": [],
+    "download": ["item_type", "asset_type"],
+    "raster_diff": ["block_size"],
+    "mobile": ["max_speed_kmh", "spatial_radius_km", "engine"],
+    "metrics": ["bin_width"],
+    "stays": ["stay_radius_km", "minutes_for_a_stop", "cluster_radius_km"],
+    "fusion": ["bin_width", "grid_resolution"],
+}
+#columns of the locations file that define an event
+EVENT_COLS = ["date_event_begin_local", "date_event_end_local", "date_min_local", "date_max_local", "timezone",
+              "lon_min", "lon_max", "lat_min", "lat_max"]
+#asset type per item type, as in exploration/pull_satellite_imagery.ipynb
+ITEM_ASSETS = {
+    "PSScene": "ortho_visual",
+    "SkySatScene": "ortho_visual",
+    "Landsat8L1G": "visual",
+    "Sentinel2L1C": "visual",
+}
+
+log = logging.getLogger(__name__)
+
+
+def stage_search(locs, location, params, folders, inputs):
+    import satmobfusion.satellite_data as sat_data
+    search_request, geojson_geometry = sat_data.get_planet_api_request(locs, location, params["max_cloud_cover"], params["item_type"])
+    with sat_data.PlanetClient(params["api_key"], base_url=params["api_url"] or sat_data.PLANET_DATA_API) as client:
+        geojson = sat_data.check_image_availability(search_request, params["api_key"], client=client)
+    fn = os.path.join(folders["satellite"], "search.json")
+    with open(fn, "w") as f:
+        json.dump({"geojson": geojson, "geojson_geometry": geojson_geometry}, f)
+    return [fn], {}
+
+
+def stage_select(locs, location, params, folders, inputs):
+    import satmobfusion.satellite_data as sat_data
+    with open(inputs["search"][0]) as f:
+        search = json.load(f)
+    image_ids = [feature['id'] for feature in search["geojson"]['features']]
+    IDs = sat_data.get_suitable_image_IDs(locs, location, image_ids, search["geojson"], search["geojson_geometry"],
+                                          folders["satellite"]+"/")
+    fn = os.path.join(folders["satellite"], "image_ids.json")
+    with open(fn, "w") as f:
+        json.dump(IDs, f)
+    return [fn, os.path.join(folders["satellite"], "images_df.csv")], {}
+
+
+def stage_download(locs, location, params, folders, inputs):
+    import satmobfusion.satellite_data as sat_data
+    with open(inputs["select"][0]) as f:
+        IDs = json.load(f)
+    locs = locs.copy()
+    sat_data.download_suitable_images(locs, location, IDs, params["api_key"], params["asset_type"], params["item_type"],
+                                      folders["satellite"]+"/", base_url=params["api_url"] or sat_data.PLANET_DATA_API,
+                                      locations_file=None)
+    fns = locs.loc[location, ["fn_satellite_pre", "fn_satellite_post"]]
+    return [os.path.join(folders["satellite"], fn) for fn in fns], fns.to_dict()
+
+
+def stage_raster_diff(locs, location, params, folders, inputs):
+    import satmobfusion.satellite_data as sat_data
+    fn_pre, fn_post = inputs["download"]
+    paths = sat_data.compute_difference_rasters(fn_pre, fn_post, folders["satellite"],
+                                                bounds=locs.loc[location, ["lon_min", "lat_min", "lon_max", "lat_max"]].values,
+                                                block_size=params["block_size"], n_threads=params["n_threads"])
+    return list(paths.values()), {}
+
+
+def stage_mobile(locs, location, params, folders, inputs):
+    import geopandas as gpd
+    from shapely.geometry import box
+    from satmobfusion.mobile_data_processing import MOBILE_DTYPES, preprocess_mobile_data
+    fn_mobile = inputs["fn_mobile"]
+    df = pd.read_csv(fn_mobile, dtype=MOBILE_DTYPES)
+    #clip to the AOI of the event
+    aoi = gpd.GeoDataFrame(geometry=[box(*locs.loc[location, ["lon_min", "lat_min", "lon_max", "lat_max"]])], crs='EPSG:4269')
+    gdf = preprocess_mobile_data(df, state_df=aoi, max_speed_kmh=params["max_speed_kmh"], spatial_radius_km=params["spatial_radius_km"],
+                                 engine=params["engine"], n_jobs=params["n_jobs"])
+    fn = os.path.join(folders["mobile"], "preprocessed.parquet")
+    gdf.to_parquet(fn)
+    return [fn], {}
+
+
+def stage_metrics(locs, location, params, folders, inputs):
+    import geopandas as gpd
+    from satmobfusion.metrics import compute_metrics
+    gdf = gpd.read_parquet(inputs["mobile"][0])
+    metrics = compute_metrics(gdf, bin_width=params["bin_width"], locs=locs, location=location)
+    fn = os.path.join(folders["mobile"], "metrics.csv")
+    metrics.to_csv(fn)
+    return [fn], {}
+
+
+def stage_stays(locs, location, params, folders, inputs):
+    import geopandas as gpd
+    from satmobfusion.stays import compute_stays
+    gdf = gpd.read_parquet(inputs["mobile"][0])
+    stays = compute_stays(gdf, locs, location, spatial_radius_km=params["stay_radius_km"],
+                          minutes_for_a_stop=params["minutes_for_a_stop"], cluster_radius_km=params["cluster_radius_km"])
+    fn = os.path.join(folders["mobile"], "stays.parquet")
+    stays.to_parquet(fn)
+    return [fn], {}
+
+
+def stage_fusion(locs, location, params, folders, inputs):
+    import geopandas as gpd
+    from satmobfusion.fusion import fuse_event
+    gdf = gpd.read_parquet(inputs["mobile"][0])
+    products = [fn for fn in inputs["raster_diff"] if os.path.basename(fn) in ("gray.tif", "ndvi.tif")]
+    table = fuse_event(gdf, products, resolution=params["grid_resolution"], bin_width=params["bin_width"], locs=locs, location=location)
+    fn = os.path.join(folders["mobile"], "fusion.csv")
+    table.to_csv(fn)
+    return [fn], {}
+
+
+STAGE_FUNCS = {
+    "search": stage_search,
+    "select": stage_select,
+    "download": stage_download,
+    "raster_diff": stage_raster_diff,
+    "mobile": stage_mobile,
+    "metrics": stage_metrics,
+    "stays": stage_stays,
+    "fusion": stage_fusion,
+}
+
+
+def _record_path(workdir, location, stage):
+    return os.path.join(workdir, "runs", location, stage+".json")
+
+
+def _read_record(workdir, location, stage):
+    path = _record_path(workdir, location, stage)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def stage_key(locs, location, stage, params, workdir):
+    """
+    Content hash of everything a stage's result depends on.
+
+    Returns
+    -------
+    key : string
+    inputs : dict
+        Output paths of the upstream stages, and "fn_mobile" for the mobile stage.
+    """
+    content = {
+        "stage": stage,
+        "params": {name: params[name] for name in STAGE_PARAMS[stage]},
+        "event": locs.loc[location, EVENT_COLS].astype(str).to_dict(),
+    }
+    if stage == "search":
+        #new images keep arriving, so a search is repeated on a later day
+        content["date"] = dt.date.today().isoformat()
+    inputs = {}
+    for upstream in STAGES[stage]:
+        record = _read_record(workdir, location, upstream)
+        if record is None:
+            raise RuntimeError(f"{location}: stage {stage} needs {upstream}, which has not run yet")
+        content[upstream] = record["outputs"]
+        inputs[upstream] = list(record["outputs"].keys())
+    if stage == "mobile":
+        fn_mobile = locs.loc[location, "fn_mobile"] if "fn_mobile" in locs.columns else None
+        if pd.isna(fn_mobile) or fn_mobile == "":
+            raise RuntimeError(f"{location}: no fn_mobile given in the locations file")
+        inputs["fn_mobile"] = fn_mobile
+        content["fn_mobile"] = file_hash(fn_mobile)
+    key = hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+    return key, inputs
+
+
+def run_stage(locs, location, stage, params, workdir, force=False, trace_memory=False):
+    """
+    Runs one stage of one event unless it finished before with the same key.
+
+    Parameters
+    ----------
+    trace_memory : bool
+        Whether to measure the peak memory of the stage with tracemalloc.
+        This slows down allocation-heavy stages considerably.
+
+    Returns
+    -------
+    Report entry (dict) with status "done", "skipped" or "failed", wall time and,
+    with `trace_memory`, peak memory.
+    """
+    entry = {"location": location, "stage": stage}
+    t0 = time.perf_counter()
+    try:
+        key, inputs = stage_key(locs, location, stage, params, workdir)
+        entry["key"] = key
+        record = _read_record(workdir, location, stage)
+        if not force and record is not None and record["key"] == key and all(os.path.exists(fn) for fn in record["outputs"]):
+            entry.update(status="skipped", seconds=0., peak_mb=0., updates=record.get("updates", {}))
+            return entry
+
+        folders = {kind: os.path.join(workdir, kind, location) for kind in ["satellite", "mobile"]}
+        for folder in folders.values():
+            os.makedirs(folder, exist_ok=True)
+        if trace_memory:
+            tracemalloc.start()
+        try:
+            outputs, updates = STAGE_FUNCS[stage](locs, location, params, folders, inputs)
+            peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+        record = {"key": key, "outputs": {fn: file_hash(fn) for fn in outputs}, "updates": updates,
+                  "finished": dt.datetime.now().isoformat(timespec="seconds")}
+        os.makedirs(os.path.dirname(_record_path(workdir, location, stage)), exist_ok=True)
+        with open(_record_path(workdir, location, stage), "w") as f:
+            json.dump(record, f, indent=1)
+        entry.update(status="done", peak_mb=peak/2**20 if peak is not None else None, updates=updates)
+    except Exception as e:
+        entry.update(status="failed", error=f"{type(e).__name__}: {e}", traceback=traceback.format_exc())
+    entry["seconds"] = entry.get("seconds", time.perf_counter() - t0)
+    return entry
+
+
+def run(locs, locations, stages, params, workdir="data", n_workers=4, force=False, trace_memory=False):
+    """
+    Runs `stages` for all `locations`, every stage as soon as the stages it depends on are done.
+
+    Stages of the dependency graph that are not selected must have run
+    before. If a stage fails, the stages depending on it are not run.
+
+    Returns
+    -------
+    List of report entries (see run_stage()).
+    """
+    todo = {(location, stage): [(location, dep) for dep in STAGES[stage] if dep in stages]
+            for location in locations for stage in stages}
+    finished, report, running = set(), [], {}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        while todo or running:
+            for node, deps in list(todo.items()):
+                if any(dep in todo or dep in running.values() for dep in deps):
+                    continue
+                del todo[node]
+                if not all(dep in finished for dep in deps):
+                    report.append({"location": node[0], "stage": node[1], "status": "not run", "error": "an upstream stage failed"})
+                    continue
+                running[executor.submit(run_stage, locs, node[0], node[1], params, workdir, force, trace_memory)] = node
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                entry = future.result()
+                report.append(entry)
+                if entry["status"] != "failed":
+                    finished.add(node)
+                log.info("%15s %-12s %-8s %8.1f s%s", entry['location'], entry['stage'], entry['status'], entry.get('seconds', 0),
+                         f"  {entry['error']}" if "error" in entry else "")
+    return report
+
+
+def update_locations_file(filename, report):
+    """
+    Writes the file names of downloaded images back to the locations file.
+    """
+    updates = [(entry["location"], entry["updates"]) for entry in report if entry.get("updates")]
+    if not updates:
+        return
+    raw = pd.read_csv(filename, index_col="location", dtype=str, keep_default_na=False)
+    for location, columns in updates:
+        for column, value in columns.items():
+            raw.loc[location, column] = value
+    raw.to_csv(filename)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--locations", default="config/locations.csv", help="locations file")
+    parser.add_argument("--events", nargs="+", default=None, help="locations to process (default: all)")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=list(STAGES))
+    parser.add_argument("--workdir", default="data", help="root of the satellite/, mobile/ and runs/ folders")
+    parser.add_argument("--workers", type=int, default=4, help="number of stages run in parallel")
+    parser.add_argument("--force", action="store_true", help="rerun stages even if their key has not changed")
+    parser.add_argument("--report", default=None, help="path of the run report (default: <workdir>/runs/report_<time>.json)")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="report the peak memory of every stage (tracemalloc; slows down the stages)")
+    parser.add_argument("--api-key", default=None,
+                        help="Planet API key (default: $PL_API_KEY, $PLANET_API_KEY or api_keys.PLANET_API_KEY)")
+    parser.add_argument("--api-url", default=None, help="root of the Planet Data API (default: satellite_data.PLANET_DATA_API)")
+    parser.add_argument("--max-cloud-cover", type=float, default=0.2)
+    parser.add_argument("--item-type", default="PSScene", choices=list(ITEM_ASSETS))
+    parser.add_argument("--block-size", type=int, default=512)
+    parser.add_argument("--raster-threads", type=int, default=1)
+    parser.add_argument("--max-speed-kmh", type=float, default=400)
+    parser.add_argument("--spatial-radius-km", type=float, default=0.2)
+    parser.add_argument("--engine", default="numpy", choices=["numpy", "skmob"])
+    parser.add_argument("--n-jobs", type=int, default=1, help="processes per mobile preprocessing stage")
+    parser.add_argument("--bin-width", default="1h")
+    parser.add_argument("--stay-radius-km", type=float, default=0.2, help="radius of a stay location")
+    parser.add_argument("--minutes-for-a-stop", type=float, default=20.)
+    parser.add_argument("--cluster-radius-km", type=float, default=0.1, help="radius for clustering the stays of a user")
+    parser.add_argument("--grid-resolution", type=int, default=17, help="resolution of the grid cells of the fusion table")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    locs = c.read_locations(args.locations)
+    locations = args.events if args.events is not None else list(locs.index)
+    unknown = set(locations) - set(locs.index)
+    if unknown:
+        parser.error(f"unknown events: {sorted(unknown)}")
+    api_key = args.api_key
+    if any(stage in args.stages for stage in ["search", "download"]):
+        import satmobfusion.satellite_data as sat_data
+        try:
+            api_key = sat_data.planet_api_key(api_key)
+        except RuntimeError as e:
+            parser.error(str(e))
+    params = {
+        "api_key": api_key, "api_url": args.api_url, "max_cloud_cover": args.max_cloud_cover, "item_type": args.item_type,
+        "asset_type": ITEM_ASSETS[args.item_type], "block_size": args.block_size, "n_threads": args.raster_threads,
+        "max_speed_kmh": args.max_speed_kmh, "spatial_radius_km": args.spatial_radius_km, "engine": args.engine,
+        "n_jobs": args.n_jobs, "bin_width": args.bin_width, "grid_resolution": args.grid_resolution,
+        "stay_radius_km": args.stay_radius_km, "minutes_for_a_stop": args.minutes_for_a_stop,
+        "cluster_radius_km": args.cluster_radius_km,
+    }
+
+    t0 = time.perf_counter()
+    started = dt.datetime.now()
+    report = run(locs, locations, [stage for stage in STAGES if stage in args.stages], params,
+                 workdir=args.workdir, n_workers=args.workers, force=args.force, trace_memory=args.trace_memory)
+    update_locations_file(args.locations, report)
+
+    fn = args.report or os.path.join(args.workdir, "runs", f"report_{started:%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(fn) or ".", exist_ok=True)
+    with open(fn, "w") as f:
+        json.dump({"started": started.isoformat(timespec="seconds"), "seconds": time.perf_counter() - t0,
+                   "params": {k: v for k, v in params.items() if k != "api_key"}, "stages": report}, f, indent=1, default=str)
+    log.info("Run report written to %s", fn)
+    return 1 if any(entry["status"] in ("failed", "not run") for entry in report) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
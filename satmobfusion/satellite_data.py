@@ -1,16 +1,56 @@
+import contextlib
+import hashlib
+import json
+import logging
 import os
 import re
-import requests
-from requests.auth import HTTPBasicAuth
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+import rasterio
+import rasterio.enums
+import rasterio.shutil
+import rasterio.windows
 import time
-from shapely.geometry import Polygon
 
 import satmobfusion.convenience as c
+import satmobfusion.instrumentation as instrumentation
+import satmobfusion.projection as projection
 
-from api_keys import PLANET_API_KEY
+PLANET_DATA_API = "https://api.planet.com/data/v1"
+#environment variables holding the Planet API key, in order of precedence (PL_API_KEY is the one of Planet's own tools)
+PLANET_API_KEY_VARIABLES = ("PL_API_KEY", "PLANET_API_KEY")
 
+log = logging.getLogger(__name__)
 
+
+def planet_api_key(api_key=None):
+    """
+    Planet API key, resolved when it is needed: `api_key` if given, else the
+    environment variable PL_API_KEY or PLANET_API_KEY, else PLANET_API_KEY of
+    an `api_keys` module on the path (the configuration used by the notebooks).
+    """
+    if api_key:
+        return api_key
+    for variable in PLANET_API_KEY_VARIABLES:
+        if os.environ.get(variable):
+            return os.environ[variable]
+    try:
+        from api_keys import PLANET_API_KEY
+    except ImportError:
+        raise RuntimeError("No Planet API key: set the environment variable PL_API_KEY or PLANET_API_KEY, "
+                           "or define PLANET_API_KEY in an api_keys module") from None
+    return PLANET_API_KEY
+
+
+def __getattr__(name):
+    if name == "PLANET_API_KEY": #formerly imported from api_keys at import time
+        return planet_api_key()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@instrumentation.instrumented()
 def get_planet_api_request(locs, location, max_cloud_cover, item_type):
     geojson_geometry = {
         "type": "Polygon",
@@ -59,115 +99,668 @@ def get_planet_api_request(locs, location, max_cloud_cover, item_type):
     return search_request,geojson_geometry
 
 
-def check_image_availability(search_request, api_key):
-    # fire off the POST request
-    search_result = \
-        requests.post(
-            'https://api.planet.com/data/v1/quick-search',
-            auth=HTTPBasicAuth(PLANET_API_KEY, ''),
-            json=search_request)
+class PlanetClient():
+    """
+    Client for the Planet Data API.
+
+    Holds one requests.Session with connection pooling and retries (HTTP 429
+    and 5xx responses are retried with exponential backoff, honoring the
+    Retry-After header), follows the `_links._next` pages of search results
+    lazily, and caches search and asset-metadata responses on disk.
+
+    Parameters
+    ----------
+    api_key : string or None
+        Planet API key; None looks it up with planet_api_key().
+    base_url : string
+        Root of the Data API, e.g. a local stub server for testing.
+    cache_dir : string or None
+        Folder of the response cache, created on the first write. None disables caching.
+    ttl : float
+        Seconds for which cached search results are reused.
+    asset_ttl : float
+        Seconds for which cached asset metadata is reused. Every asset type
+        is cached on its own and only while it is active, as the status of
+        the others still changes.
+    max_retries : int
+        Number of retries per request.
+    backoff_factor : float
+        Retries wait backoff_factor * 2^(retry - 1) seconds unless the server sends Retry-After.
+    pool_maxsize : int
+        Number of pooled connections per host, i.e. of concurrent requests.
+    """
+    def __init__(self, api_key=None, base_url=PLANET_DATA_API, cache_dir="data/satellite/planet_cache",
+                 ttl=24*3600., asset_ttl=3600., max_retries=5, backoff_factor=1., pool_maxsize=10):
+        self.base_url = base_url.rstrip("/")
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.asset_ttl = asset_ttl
+
+        import requests
+        import requests.adapters
+        from requests.auth import HTTPBasicAuth
+        from urllib3.util.retry import Retry
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(planet_api_key(api_key), '')
+        retry = Retry(total=max_retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=None, respect_retry_after_header=True) #quick-search POSTs are safe to repeat
+        adapter = requests.adapters.HTTPAdapter(max_retries=retry, pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def _cache_path(self, kind, request):
+        key = hashlib.sha1(json.dumps([self.base_url, request], sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{kind}_{key}.json")
+
+    def _cache_get(self, kind, request, ttl):
+        if self.cache_dir is None:
+            return None
+        path = self._cache_path(kind, request)
+        if not os.path.isfile(path) or time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _cache_put(self, kind, request, result):
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._cache_path(kind, request)
+        with open(path+".tmp", "w") as f:
+            json.dump(result, f)
+        os.replace(path+".tmp", path)
+
+    def _json(self, method, url, **kwargs):
+        response = self.session.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    #search_pages() and search() are lazy generators and are not instrumented themselves;
+    #quick_search() and check_image_availability() report their results
+    def search_pages(self, search_request):
+        """
+        Yields the pages of a quick search, fetching (or reading from the
+        cache) the next page only when it is needed.
+
+        Parameters
+        ----------
+        search_request : dict
+            As built by get_planet_api_request().
+        """
+        page_no, next_url = 0, None
+        while True:
+            page = self._cache_get("search", [search_request, page_no], self.ttl)
+            if page is None:
+                if page_no == 0:
+                    page = self._json("POST", f"{self.base_url}/quick-search", json=search_request)
+                else:
+                    page = self._json("GET", next_url)
+                self._cache_put("search", [search_request, page_no], page)
+            yield page
+            next_url = page.get("_links", {}).get("_next")
+            if not next_url or not page.get("features"):
+                return
+            page_no += 1
+
+    def search(self, search_request):
+        """
+        Yields the features (images) of all pages of a quick search.
+        """
+        for page in self.search_pages(search_request):
+            yield from page["features"]
+
+    @instrumentation.instrumented("PlanetClient.quick_search")
+    def quick_search(self, search_request):
+        """
+        All results of a quick search as one GeoJSON FeatureCollection.
+        """
+        features = list(self.search(search_request))
+        instrumentation.current().record(rows_out=len(features))
+        return {"type": "FeatureCollection", "features": features}
+
+    @instrumentation.instrumented("PlanetClient.assets")
+    def assets(self, item_type, ID):
+        """
+        Metadata of all assets of an item; the active ones are cached for asset().
+        Learn more: planet.com/docs/reference/data-api/items-assets/#asset
+        """
+        assets = self._json("GET", f"{self.base_url}/item-types/{item_type}/items/{ID}/assets")
+        instrumentation.current().record(item=ID, n_active=sum(asset.get("status") == "active" for asset in assets.values()))
+        for asset_type, asset in assets.items():
+            if asset.get("status") == "active":
+                self._cache_put("asset", [item_type, ID, asset_type], asset)
+        return assets
+
+    def asset(self, item_type, ID, asset_type, refresh=False):
+        """
+        Metadata of one asset of an item, from the cache if it was active
+        less than `asset_ttl` seconds ago.
+        """
+        asset = None if refresh else self._cache_get("asset", [item_type, ID, asset_type], self.asset_ttl)
+        if asset is None:
+            assets = self.assets(item_type, ID)
+            if asset_type not in assets:
+                raise KeyError(f"Asset type {asset_type} is not available for {ID}, only {list(assets.keys())}")
+            asset = assets[asset_type]
+        return asset
 
-    geojson = search_result.json()
+    @instrumentation.instrumented("PlanetClient.activate")
+    def activate(self, item_type, ID, asset_type):
+        """
+        Requests the activation of an asset (if it is not active yet) and returns its metadata.
+        """
+        asset = self.asset(item_type, ID, asset_type)
+        if asset["status"] != "active":
+            self.session.get(asset["_links"]["activate"]).raise_for_status()
+        return asset
+
+    @instrumentation.instrumented("PlanetClient.wait_until_active")
+    def wait_until_active(self, asset, deadline, poll_interval=2., max_poll_interval=60., item=None):
+        """
+        Polls an asset until it is active, doubling the interval between polls up
+        to `max_poll_interval` seconds.
+
+        Parameters
+        ----------
+        asset : dict
+            Asset metadata as returned by activate().
+        deadline : float
+            time.monotonic() value after which a TimeoutError is raised.
+        item : tuple or None
+            (item_type, ID, asset_type) of the asset; if given, its metadata is
+            cached for asset() once it became active.
+
+        Returns
+        -------
+        Metadata of the active asset, including the download link in "location".
+        """
+        polled = False
+        stage = instrumentation.current().record(asset=asset["_links"]["_self"])
+        while asset["status"] != "active":
+            if time.monotonic() + poll_interval > deadline:
+                raise TimeoutError(f"Asset {asset['_links']['_self']} was not activated in time")
+            time.sleep(poll_interval)
+            stage.add(polls=1)
+            poll_interval = min(2*poll_interval, max_poll_interval)
+            asset = self._json("GET", asset["_links"]["_self"])
+            polled = True
+        if polled and item is not None:
+            self._cache_put("asset", list(item), asset)
+        return asset
+
+    @instrumentation.instrumented("PlanetClient.download")
+    def download(self, url, folder, chunk_size=1024*1024):
+        """
+        Streams a file to `folder` in chunks of `chunk_size` bytes.
+
+        The file name is taken from the Content-Disposition header. Data is
+        written to "<name>.part" first; if such a partial file exists from an
+        interrupted download, only the missing bytes are requested (HTTP Range).
+
+        Returns
+        -------
+        Name of the downloaded file.
+        """
+        response = self.session.get(url, stream=True)
+        response.raise_for_status()
+        fn = re.findall("filename=(.+)", response.headers['content-disposition'])[0][1:-1]
+        path = os.path.join(folder, fn)
+        stage = instrumentation.current().record(file=fn)
+        if os.path.isfile(path):
+            response.close()
+            log.info("%s already downloaded, skipping download.", fn)
+            stage.record(skipped=True)
+            return fn
+
+        part = path + ".part"
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        if offset > 0:
+            response.close()
+            response = self.session.get(url, stream=True, headers={"Range": f"bytes={offset}-"})
+            response.raise_for_status()
+            if response.status_code != 206: #server ignored the range, start over
+                offset = 0
+        expected = response.headers.get("content-length")
+        expected = offset + int(expected) if expected is not None else None
+        stage.record(resumed_from=offset)
+
+        with response, open(part, "ab" if offset > 0 else "wb") as fd:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                fd.write(chunk)
+                stage.add(bytes=len(chunk))
+        if expected is not None and os.path.getsize(part) != expected:
+            raise IOError(f"Download of {fn} incomplete ({os.path.getsize(part)} of {expected} bytes), call again to resume")
+        os.replace(part, path)
+        log.info("%s downloaded.", fn)
+        return fn
+
+
+@instrumentation.instrumented()
+def check_image_availability(search_request, api_key=None, client=None):
+    """
+    Runs a quick search over all result pages.
+
+    Parameters
+    ----------
+    search_request : dict
+        As built by get_planet_api_request().
+    api_key : string or None
+        Planet API key; None looks it up with planet_api_key().
+    client : PlanetClient or None
+        Client to use; a new one with default settings if None.
+
+    Returns
+    -------
+    GeoJSON FeatureCollection with all images found.
+    """
+    # a client created here is closed again; counts go on this stage, not on nested client stages
+    with PlanetClient(api_key) if client is None else contextlib.nullcontext(client) as client:
+        geojson = {"type": "FeatureCollection", "features": list(client.search(search_request))}
 
     # let's look at the first result
-    if len(list(geojson.items())[1][1]) > 0:
-        print(f"A total of {len(list(geojson.items())[1][1])} images were found in that AOI and date range.\n")
-        print("First image in that AOI and date range:")
-        print(list(geojson.items())[1][1][0])
+    instrumentation.current().record(n_images=len(geojson["features"]))
+    if len(geojson["features"]) > 0:
+        log.info("A total of %d images were found in that AOI and date range.", len(geojson["features"]))
+        log.debug("First image in that AOI and date range: %s", geojson["features"][0])
     else:
-        print("No images in that AOI and date range.")
+        log.info("No images in that AOI and date range.")
 
     return geojson
 
-def get_suitable_image_IDs(locs, location, image_ids, geojson, geojson_geometry, folder):
-    images_df = pd.DataFrame(index=image_ids, columns=["date_acquired", "is_pre", "is_post", "diff_to_date_event", "coverage_of_AOI", "combined_metric"])
-    date_event_begin = locs.loc[location, "date_event_begin"]
-    date_event_end = locs.loc[location, "date_event_end"]
+def _total_days(deltas):
+    # |Timedelta.total_seconds()|/60/60/24 for an array of timedelta64[ns], with the same rounding as the
+    # scalar method (which is microsecond based in pandas < 2)
+    ns = deltas.astype("int64")
+    seconds = (ns // 1000) / 1e6 if pd.Timedelta(1).total_seconds() == 0 else ns / 1e9
+    return np.abs(seconds/60/60/24)
+
+@instrumentation.instrumented()
+def rank_images(locs, location, image_ids, geojson, geojson_geometry):
+    """
+    Scores all images of a search result in one vectorized pass.
+
+    Parameters
+    ----------
+    image_ids : list
+        IDs of the images to score; each is looked up in `geojson`.
+    geojson : dict
+        Search result as returned by check_image_availability().
+    geojson_geometry : dict
+        AOI as returned by get_planet_api_request().
+
+    Returns
+    -------
+    DataFrame indexed by image ID with the columns
+    date_acquired, is_pre, is_post, diff_to_date_event, coverage_of_AOI and
+    combined_metric (lower is better).
+    """
+    instrumentation.current().record(rows_in=len(image_ids))
+    position = {}
+    for i, feature in enumerate(geojson['features']):
+        position.setdefault(feature['id'], i)
+    features = [geojson['features'][position[image_id]] for image_id in image_ids]
+
+    date_acquired = pd.to_datetime([feature['properties']['acquired'] for feature in features], utc=True).tz_convert(locs.loc[location, "timezone"])
+    is_pre = date_acquired < locs.loc[location, "date_event_begin"]
+    is_post = date_acquired > locs.loc[location, "date_event_end"]
+    diff_to_date_event = np.where(is_pre, (date_acquired - locs.loc[location, "date_event_begin"]).values,
+                                  np.where(is_post, (date_acquired - locs.loc[location, "date_event_end"]).values, np.timedelta64(0, "ns")))
+
+    #all footprints as one array of polygons, built from their flattened exterior rings
+    import shapely
+    from shapely.geometry import Polygon
+    rings = [feature['geometry']['coordinates'][0] for feature in features]
+    ring_index = np.repeat(np.arange(len(rings)), [len(ring) for ring in rings])
+    coords = np.array([point for ring in rings for point in ring], dtype=float).reshape(-1, 2)
+    footprints = shapely.polygons(shapely.linearrings(coords, indices=ring_index))
     AOI_polygon = Polygon(geojson_geometry['coordinates'][0])
-    for image_id in image_ids:
-        # print("\n"+image_id)
-        images_df.loc[image_id, "date_acquired"] = pd.to_datetime(geojson['features'][image_ids.index(image_id)]['properties']['acquired']).tz_convert(locs.loc[location, "timezone"])
-        images_df.loc[image_id, "is_pre"] = images_df.loc[image_id, "date_acquired"] < date_event_begin
-        images_df.loc[image_id, "is_post"] = images_df.loc[image_id, "date_acquired"] > date_event_end
-        if images_df.loc[image_id, "is_pre"]:
-            images_df.loc[image_id, "diff_to_date_event"] = images_df.loc[image_id, "date_acquired"] - date_event_begin
-        elif images_df.loc[image_id, "is_post"]:
-            images_df.loc[image_id, "diff_to_date_event"] = images_df.loc[image_id, "date_acquired"] - date_event_end
-        else: #image data acquired is during event
-            images_df.loc[image_id, "diff_to_date_event"] = pd.Timedelta(0)
-        satellite_polygon = Polygon(geojson['features'][image_ids.index(image_id)]['geometry']['coordinates'][0])
-        intersection = satellite_polygon.intersection(AOI_polygon)
-        images_df.loc[image_id, "coverage_of_AOI"] = intersection.area/AOI_polygon.area
-
-        #a low combined metric is more desirable
-        #25% (percentage points) more coverage of AOI is worth selecting an image that is 1 day further away from the event
-        images_df.loc[image_id, "combined_metric"] = abs(images_df.loc[image_id, "diff_to_date_event"].total_seconds()/60/60/24) - 4*images_df.loc[image_id, "coverage_of_AOI"]
-        # print(images_df.loc[image_id, ["diff_to_date_event", "coverage_of_AOI", "combined_metric"]].values)
-
-    images_df.sort_values(["is_post", "combined_metric"]).to_csv(folder+"images_df.csv")
-
-    image_id_pre = images_df[images_df["is_pre"]].sort_values("combined_metric", ascending=True).index[0]
-    image_id_post = images_df[images_df["is_post"]].sort_values("combined_metric", ascending=True).index[0]
-    IDs = [image_id_pre, image_id_post]
-
-    print(IDs)
+    coverage_of_AOI = shapely.area(shapely.intersection(footprints, AOI_polygon))/AOI_polygon.area
+
+    images_df = pd.DataFrame({
+        "date_acquired": date_acquired,
+        "is_pre": is_pre,
+        "is_post": is_post,
+        "diff_to_date_event": pd.to_timedelta(diff_to_date_event),
+        "coverage_of_AOI": coverage_of_AOI,
+    }, index=image_ids)
+    #a low combined metric is more desirable
+    #25% (percentage points) more coverage of AOI is worth selecting an image that is 1 day further away from the event
+    images_df["combined_metric"] = _total_days(diff_to_date_event) - 4*coverage_of_AOI
+    return images_df
+
+@instrumentation.instrumented()
+def top_images(images_df, k=1):
+    """
+    IDs of the `k` best pre- and post-event images of rank_images(), best first.
+
+    Returns
+    -------
+    pre_ids, post_ids : list
+    """
+    ranked = images_df.sort_values("combined_metric", ascending=True, kind="mergesort")
+    return ranked.index[ranked["is_pre"]][:k].tolist(), ranked.index[ranked["is_post"]][:k].tolist()
+
+@instrumentation.instrumented()
+def get_suitable_image_IDs(locs, location, image_ids, geojson, geojson_geometry, folder):
+    images_df = rank_images(locs, location, image_ids, geojson, geojson_geometry)
+    images_df.sort_values(["is_post", "combined_metric"], kind="mergesort").to_csv(folder+"images_df.csv")
+
+    pre_ids, post_ids = top_images(images_df, k=1)
+    IDs = [pre_ids[0], post_ids[0]]
+
+    log.info("Selected images: %s", IDs)
 
     return IDs
 
-def download_suitable_images(locs, location, IDs, api_key, asset_type, item_type, folder):
-    fn_suffix = {0: "pre", 1: "post"}
-    # fn_suffix = {"0_0": "pre", "0_1": "pre_meta", "1_0": "post", "1_1": "post_meta"}
-
-    for i,ID in enumerate(IDs):
-        print(ID)
-        id_url = 'https://api.planet.com/data/v1/item-types/{}/items/{}/assets'.format(item_type, ID)
-
-        # Returns JSON metadata for assets in this ID. Learn more: planet.com/docs/reference/data-api/items-assets/#asset
-        result = requests.get(id_url, auth=HTTPBasicAuth(PLANET_API_KEY, ''))
-
-        # List of asset types available for this particular satellite image
-        print("\tAvailable asset types for this satellite image:", result.json().keys())
-        print("\tAsset type we will use:", asset_type)
-
-        # This is "inactive" if the "ortho_analytic_4b" asset has not yet been activated; otherwise 'active'
-        # print(result.json()[asset_type]['status'])
-
-        # Parse out useful links
-        # for j,asset_typee in enumerate([asset_type,asset_type+"_xml"]):
-        links = result.json()[asset_type]["_links"]
-        self_link = links["_self"]
-        activation_link = links["activate"]
-
-        # Request activation of the asset
-        activate_result = requests.get(activation_link, auth=HTTPBasicAuth(PLANET_API_KEY, ''))
-        print("\tWaiting for activation...", end="")
-        while(True):
-            activation_status_result = requests.get(self_link, auth=HTTPBasicAuth(PLANET_API_KEY, ''))
-            if activation_status_result.json()["status"] != "active":
-                time.sleep(2)
-                print(".", end="")
+@instrumentation.instrumented()
+def download_suitable_images(locs, location, IDs, api_key, asset_type, item_type, folder,
+                             base_url=PLANET_DATA_API, n_workers=4, timeout=3600., chunk_size=1024*1024, client=None,
+                             locations_file="config/locations.csv", cog=False):
+    """
+    Activates, waits for and downloads the assets of the images in `IDs`.
+
+    All assets are activated at once; every image is then polled (with
+    exponential backoff) and downloaded in its own worker thread over one
+    pooled session, so images that are activated first are downloaded first.
+
+    Parameters
+    ----------
+    IDs : list
+        Image IDs, [pre, post] as returned by get_suitable_image_IDs().
+    api_key : string or None
+        Planet API key; None looks it up with planet_api_key().
+    base_url : string
+        Root of the Planet Data API, e.g. a local mock server for testing.
+        Ignored if `client` is given.
+    n_workers : int
+        Number of concurrent activations/downloads.
+    timeout : float
+        Seconds after which waiting for the activation of an asset is given up.
+    chunk_size : int
+        Bytes held in memory per download.
+    client : PlanetClient or None
+        Client to use; a new one if None.
+    locations_file : string or None
+        File to which `locs` (with the file names of the images) is written. None skips writing.
+    cog : bool
+        If True, every image is also converted into the COG cache (see convert_to_cog()).
+    """
+    # a client created here is closed again; counts go on this stage, not on nested client stages
+    with PlanetClient(api_key, base_url=base_url, pool_maxsize=n_workers) if client is None else contextlib.nullcontext(client) as client:
+        fn_suffix = {0: "pre", 1: "post"}
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        deadline = time.monotonic() + timeout
+
+        def fetch(ID, asset):
+            asset = client.wait_until_active(asset, deadline, item=(item_type, ID, asset_type))
+            log.info("%s active, downloading from %s", ID, asset['location'])
+            fn = client.download(asset["location"], folder, chunk_size=chunk_size)
+            if cog:
+                convert_to_cog(folder+fn)
+            return fn
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            assets = list(executor.map(lambda ID: client.activate(item_type, ID, asset_type), IDs))
+            log.info("Requested activation of %d %s assets, waiting...", len(IDs), asset_type)
+            futures = [executor.submit(fetch, ID, asset) for ID, asset in zip(IDs, assets)]
+            fns = [future.result() for future in futures]
+            for i, fn in enumerate(fns):
+                locs.loc[location, "fn_satellite_"+fn_suffix[i]] = fn
+        if instrumentation.enabled(): #the downloads themselves are reported by their worker threads
+            instrumentation.current().record(n_images=len(fns), bytes=sum(os.path.getsize(folder+fn) for fn in fns))
+        if locations_file is not None:
+            locs.to_csv(locations_file)
+
+
+RGBN_BANDS = (1, 2, 3, 4) #red, green, blue, near-infrared (Planet 4-band analytic)
+GRAY_WEIGHTS = (0.3, 0.59, 0.11)
+DIFF_NODATA = -32768
+
+
+def _grayscale(img, out, scratch):
+    # out = 0.3*R + 0.59*G + 0.11*B without allocating temporaries
+    np.multiply(img[0], GRAY_WEIGHTS[0], out=out)
+    for band, weight in zip((1, 2), GRAY_WEIGHTS[1:]):
+        np.multiply(img[band], weight, out=scratch)
+        out += scratch
+    return out
+
+
+def _ndvi(img, out, scratch):
+    # out = (NIR - R) / (NIR + R), NaN where both are zero
+    np.subtract(img[3], img[0], out=out)
+    np.add(img[3], img[0], out=scratch)
+    np.divide(out, scratch, out=out, where=scratch != 0)
+    out[scratch == 0] = np.nan
+    return out
+
+
+def _aligned_windows(src_pre, src_post, bounds):
+    # window of the AOI in the pre image, and the window covering the same pixels in the post image
+    if src_pre.crs != src_post.crs or not np.allclose(src_pre.res, src_post.res):
+        raise ValueError("pre and post image need the same CRS and resolution; reproject one of them first")
+    if bounds is None:
+        bounds = (max(src_pre.bounds.left, src_post.bounds.left), max(src_pre.bounds.bottom, src_post.bounds.bottom),
+                  min(src_pre.bounds.right, src_post.bounds.right), min(src_pre.bounds.top, src_post.bounds.top))
+    window_pre = rasterio.windows.from_bounds(*bounds, transform=src_pre.transform).round_offsets().round_lengths()
+    x0, y0 = rasterio.windows.transform(window_pre, src_pre.transform) * (0, 0)
+    col, row = ~src_post.transform * (x0, y0)
+    window_post = rasterio.windows.Window(int(round(col)), int(round(row)), window_pre.width, window_pre.height)
+    return window_pre, window_post
+
+
+@instrumentation.instrumented()
+def compute_difference_rasters(fn_pre, fn_post, folder, bounds=None, bounds_crs="EPSG:4326",
+                               products=("diff", "gray", "ndvi"), block_size=512, n_threads=1, compress="deflate"):
+    """
+    Computes the difference, grayscale and NDVI rasters of a pre/post image pair tile by tile.
+
+    Instead of reading the whole AOI of both images into memory, the AOI is
+    processed in aligned block windows of `block_size` x `block_size` pixels,
+    and every product is written to a tiled, compressed GeoTIFF as it is
+    computed, so only a few tiles per thread are in memory at any time.
+    Products are computed in float32 with in-place operations.
+
+    Parameters
+    ----------
+    fn_pre, fn_post : string
+        Paths to the 4-band (R, G, B, NIR) GeoTIFFs before and after the event.
+        Both need the same CRS and resolution.
+    folder : string
+        Output folder for "diff.tif", "gray.tif" and "ndvi.tif".
+    bounds : tuple or None
+        AOI as (left, bottom, right, top) in `bounds_crs`, e.g.
+        locs.loc[location, ["lon_min", "lat_min", "lon_max", "lat_max"]].
+        If None, the overlap of both images is used.
+    bounds_crs : string
+        CRS of `bounds`. Default is "EPSG:4326" (lon/lat).
+    products : iterable of string
+        Subset of
+        "diff" : post - pre of all four bands (int16, nodata -32768; differences
+            beyond +-32767, possible with uint16 bands, are saturated)
+        "gray" : grayscale 0.3*R + 0.59*G + 0.11*B of pre, post and post - pre (float32, nodata NaN)
+        "ndvi" : (NIR - R) / (NIR + R) of pre, post and post - pre (float32, nodata NaN)
+    block_size : int
+        Tile size in pixels (multiple of 16), also used as the block size of the outputs.
+    n_threads : int
+        Number of threads working on different tiles.
+
+    Returns
+    -------
+    Dictionary product -> path of the written raster.
+    """
+    products = list(products)
+    unknown = set(products) - {"diff", "gray", "ndvi"}
+    if unknown:
+        raise ValueError(f"Unknown products: {sorted(unknown)}")
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    with rasterio.open(fn_pre) as src_pre, rasterio.open(fn_post) as src_post:
+        if bounds is not None:
+            bounds = projection.transform_bounds(bounds, bounds_crs, src_pre.crs)
+        window_pre, window_post = _aligned_windows(src_pre, src_post, bounds)
+        profile = {
+            "driver": "GTiff", "crs": src_pre.crs, "transform": rasterio.windows.transform(window_pre, src_pre.transform),
+            "width": window_pre.width, "height": window_pre.height,
+            "tiled": True, "blockxsize": block_size, "blockysize": block_size, "compress": compress, "BIGTIFF": "IF_SAFER",
+        }
+        layouts = {
+            "diff": dict(count=4, dtype="int16", nodata=DIFF_NODATA, predictor=2),
+            "gray": dict(count=3, dtype="float32", nodata=np.nan, predictor=3),
+            "ndvi": dict(count=3, dtype="float32", nodata=np.nan, predictor=3),
+        }
+        paths = {product: os.path.join(folder, product+".tif") for product in products}
+        dsts = {product: rasterio.open(paths[product], "w", **profile, **layouts[product]) for product in products}
+        read_lock, write_lock = threading.Lock(), threading.Lock()
+
+        def process(tile):
+            pre_tile = rasterio.windows.Window(window_pre.col_off + tile.col_off, window_pre.row_off + tile.row_off, tile.width, tile.height)
+            post_tile = rasterio.windows.Window(window_post.col_off + tile.col_off, window_post.row_off + tile.row_off, tile.width, tile.height)
+            with read_lock:
+                pre = src_pre.read(RGBN_BANDS, window=pre_tile, out_dtype="float32", boundless=True)
+                post = src_post.read(RGBN_BANDS, window=post_tile, out_dtype="float32", boundless=True)
+                valid = src_pre.read_masks(RGBN_BANDS, window=pre_tile, boundless=True).all(axis=0)
+                valid &= src_post.read_masks(RGBN_BANDS, window=post_tile, boundless=True).all(axis=0)
+            invalid = ~valid
+            scratch = np.empty(pre.shape[1:], dtype="float32")
+            out = {}
+            for product, func in (("gray", _grayscale), ("ndvi", _ndvi)):
+                if product in dsts:
+                    result = np.empty((3,) + pre.shape[1:], dtype="float32")
+                    func(pre, result[0], scratch)
+                    func(post, result[1], scratch)
+                    np.subtract(result[1], result[0], out=result[2])
+                    result[:, invalid] = np.nan
+                    out[product] = result
+            if "diff" in dsts:
+                post -= pre #pre and post are not needed anymore
+                #saturate instead of wrapping around; -32768 is left for nodata
+                np.clip(post, -32767, 32767, out=post)
+                diff = post.astype("int16")
+                diff[:, invalid] = DIFF_NODATA
+                out["diff"] = diff
+            with write_lock:
+                for product, result in out.items():
+                    dsts[product].write(result, window=tile)
+
+        tiles = [rasterio.windows.Window(col, row, min(block_size, window_pre.width - col), min(block_size, window_pre.height - row))
+                 for row in range(0, window_pre.height, block_size) for col in range(0, window_pre.width, block_size)]
+        instrumentation.current().record(pixels=int(window_pre.width * window_pre.height), tiles=len(tiles), n_threads=n_threads)
+        try:
+            if n_threads > 1:
+                with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                    list(executor.map(process, tiles))
             else:
-                print(activation_status_result.json()["status"])
-                break
-
-        # Image can be downloaded by making a GET with your Planet API key, from here:
-        download_link = activation_status_result.json()["location"]
-        print("\tDownload link:", download_link)
-
-        # Download the image
-        response = requests.get(download_link, stream=True)
-        print("\tStatus code:", response.status_code)
-        # print("full url:", response.url)
-        # print("text:", response.text)
-        fn = re.findall("filename=(.+)", response.headers['content-disposition'])[0][1:-1]
-        # locs.loc[location, "fn_satellite_"+fn_suffix[f"{i}_{j}"]] = fn
-        locs.loc[location, "fn_satellite_"+fn_suffix[i]] = fn
-        if os.path.isfile(folder+fn):
-            print("\tImage already downloaded, skipping download.")
+                for tile in tiles:
+                    process(tile)
+            for product, dst in dsts.items():
+                dst.descriptions = ("red", "green", "blue", "nir") if product == "diff" else ("pre", "post", "diff")
+        finally:
+            for dst in dsts.values():
+                dst.close()
+    if instrumentation.enabled():
+        instrumentation.current().record(bytes=sum(os.path.getsize(path) for path in paths.values()))
+    return paths
+
+
+@instrumentation.instrumented()
+def convert_to_cog(fn, cache_folder=None, block_size=512, compress="deflate", resampling="average"):
+    """
+    Converts a GeoTIFF into a Cloud-Optimized GeoTIFF (tiled, with internal overviews).
+
+    The COG is written once to `cache_folder` and reused as long as it is
+    newer than the source file.
+
+    Parameters
+    ----------
+    fn : string
+        Path of the source image, e.g. a downloaded scene.
+    cache_folder : string or None
+        Folder of the COG cache. Default is a "cog" folder next to `fn`.
+    block_size : int
+        Tile size of the COG and its overviews.
+    resampling : string
+        Resampling method for the overviews.
+
+    Returns
+    -------
+    Path of the COG.
+    """
+    if cache_folder is None:
+        cache_folder = os.path.join(os.path.dirname(fn), "cog")
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder)
+    cog = os.path.join(cache_folder, os.path.basename(fn))
+    if os.path.isfile(cog) and os.path.getmtime(cog) >= os.path.getmtime(fn):
+        instrumentation.current().record(cache="hit")
+        return cog
+    rasterio.shutil.copy(fn, cog+".tmp", driver="COG", BLOCKSIZE=block_size, COMPRESS=compress,
+                         OVERVIEWS="AUTO", OVERVIEW_RESAMPLING=resampling, BIGTIFF="IF_SAFER")
+    os.replace(cog+".tmp", cog)
+    instrumentation.current().record(bytes=os.path.getsize(fn), bytes_out=os.path.getsize(cog))
+    return cog
+
+
+def overview_factor(src, width, height, max_size):
+    """
+    Decimation factor for reading a `width` x `height` window with at most
+    `max_size` pixels along its longer side, and the internal overview
+    factor GDAL will serve such a read from (1 if none fits).
+    """
+    factor = max(1., max(width, height) / max_size)
+    overviews = [f for f in src.overviews(1) if f <= factor]
+    return factor, max(overviews, default=1)
+
+
+@instrumentation.instrumented()
+def read_decimated(fn, bands=(1, 2, 3), bounds=None, bounds_crs="EPSG:4326", max_size=1024, masked=True, resampling="average"):
+    """
+    Reads an image (or a part of it) at a resolution just fine enough for
+    an output of `max_size` pixels, e.g. for quick-look maps and histograms.
+
+    The read is decimated with `out_shape`, so GDAL serves it from the closest
+    internal overview (see convert_to_cog()) and only reads the bytes of that
+    level; images without overviews are decimated on the fly.
+
+    Parameters
+    ----------
+    bands : int or tuple
+        Band(s) to read.
+    bounds : tuple or None
+        Window (left, bottom, right, top) in `bounds_crs`; the whole image if None.
+    max_size : int
+        Maximum number of pixels along the longer side of the result.
+
+    Returns
+    -------
+    img : (masked) ndarray
+    transform : Affine
+        Transform of `img`, e.g. for rasterio.plot.plotting_extent(img, transform).
+    """
+    with rasterio.open(fn) as src:
+        if bounds is None:
+            window = rasterio.windows.Window(0, 0, src.width, src.height)
         else:
-            with open(folder+fn, "wb") as fd:
-                fd.write(response.content)
-                for chunk in response.iter_content(chunk_size=1024*1024):
-                    fd.write(chunk)
-        print("\n")
-    locs.to_csv("config/locations.csv")
+            bounds = projection.transform_bounds(bounds, bounds_crs, src.crs)
+            window = rasterio.windows.from_bounds(*bounds, transform=src.transform)
+            window = window.intersection(rasterio.windows.Window(0, 0, src.width, src.height))
+        factor, _ = overview_factor(src, window.width, window.height, max_size)
+        out_shape = (max(1, int(round(window.height / factor))), max(1, int(round(window.width / factor))))
+        if not isinstance(bands, int):
+            out_shape = (len(bands),) + out_shape
+        img = src.read(bands, window=window, out_shape=out_shape, masked=masked,
+                       resampling=rasterio.enums.Resampling[resampling])
+        instrumentation.current().record(decimation=factor, pixels=int(img.size))
+        transform = rasterio.windows.transform(window, src.transform) * rasterio.Affine.scale(window.width / out_shape[-1], window.height / out_shape[-2])
+    return img, transform
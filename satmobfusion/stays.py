@@ -0,0 +1,289 @@
+import numpy as np
+import pandas as pd
+
+import satmobfusion.instrumentation as instrumentation
+import satmobfusion.trajectory as trajectory
+
+# as skmob.preprocessing.clustering.kms_per_radian, the DBSCAN radius conversion of skmob
+KMS_PER_RADIAN = 6371.0088
+
+
+def stay_groups(lat, lng, t, starts, ends, spatial_radius_km=0.2, minutes_for_a_stop=20.):
+    """
+    Stay points on uid-sorted arrays.
+
+    Reproduces skmob.preprocessing.detection.stay_locations() (with its default
+    `no_data_for_minutes` and `min_speed_kmh`): points are segmented as in
+    compression (see trajectory.group_anchors()), and a segment is a stay if
+    more than `minutes_for_a_stop` minutes pass between its anchor and the
+    first point after it (the leaving time). In the last segment of a user,
+    the last point is the leaving point.
+
+    Parameters
+    ----------
+    lat, lng : array-like
+        Coordinates in decimal degrees, sorted by user and time.
+    t : array-like
+        Timestamps in nanoseconds (int64), same order.
+    starts, ends : array-like
+        Row bounds of every user, see trajectory.group_bounds().
+
+    Returns
+    -------
+    first, leave : ndarray
+        Row of the anchor and of the leaving point of every stay; the stay
+        consists of the rows first..leave-1.
+    median_lat, median_lng : ndarray
+        Median coordinates of every stay.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lng = np.asarray(lng, dtype=float)
+    t = np.asarray(t, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    anchors = trajectory.group_anchors(lat, lng, starts, ends, spatial_radius_km=spatial_radius_km)
+
+    # a segment runs up to the next anchor, which is the first point of the next user after the last segment
+    seg_end = np.append(anchors[1:], len(lat))
+    user_end = ends[np.searchsorted(ends, anchors, side="right")]
+    leave = np.where(seg_end == user_end, seg_end - 1, seg_end)
+    minutes = (t[leave] - t[anchors]) / 1e9 / 60.
+    is_stay = (leave > anchors) & (minutes > minutes_for_a_stop)
+    first, leave = anchors[is_stay], leave[is_stay]
+
+    lengths = leave - first
+    gid = np.repeat(np.arange(len(first)), lengths)
+    rows = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - first, lengths)
+    return (first, leave, trajectory._group_median(lat[rows], gid, len(first)),
+            trajectory._group_median(lng[rows], gid, len(first)))
+
+
+def _unit_vectors(lat, lng):
+    # points on the unit sphere; chord distances are monotonic in great-circle distances
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lng = np.radians(np.asarray(lng, dtype=float))
+    return np.column_stack([np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)])
+
+
+def _chord(distance_km):
+    return 2 * np.sin(distance_km / KMS_PER_RADIAN / 2)
+
+
+def _keyed_tree_points(lat, lng, codes):
+    # a 4th coordinate per key (e.g. user) that is further apart than any chord (at most 2), so that
+    # radius queries never match points of different keys
+    return np.column_stack([_unit_vectors(lat, lng), 4. * np.asarray(codes, dtype=float)])
+
+
+def cluster_labels(lat, lng, codes, cluster_radius_km=0.1, min_samples=1):
+    """
+    DBSCAN clustering of the stays of every user at once.
+
+    Reproduces skmob.preprocessing.clustering.cluster(): DBSCAN with a haversine
+    radius of `cluster_radius_km`, run per user, and clusters labeled by their
+    rank in number of stays (0 is the most visited location of a user).
+    Neighbours are found with one KD-tree for all users; clusters are the
+    connected components of the core points. With `min_samples` > 1, border
+    points join the cluster of the earliest adjacent core point, and noise
+    is labeled -1.
+
+    Parameters
+    ----------
+    lat, lng : array-like
+        Coordinates of the stays, sorted by user (and time).
+    codes : array-like
+        Integer user code of every stay.
+
+    Returns
+    -------
+    ndarray of int64 cluster labels.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from scipy.spatial import cKDTree
+
+    codes = np.asarray(codes)
+    n = len(codes)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    pairs = cKDTree(_keyed_tree_points(lat, lng, codes)).query_pairs(_chord(cluster_radius_km), output_type="ndarray")
+    degree = 1 + np.bincount(pairs.ravel(), minlength=n)
+    core = degree >= min_samples
+
+    both_core = core[pairs[:, 0]] & core[pairs[:, 1]]
+    graph = coo_matrix((np.ones(both_core.sum()), (pairs[both_core, 0], pairs[both_core, 1])), shape=(n, n))
+    _, component = connected_components(graph, directed=False)
+    component = np.where(core, component, -1)
+
+    # border points: cluster of the earliest core neighbour
+    border = ~core
+    if border.any() and len(pairs) > 0:
+        ends = np.concatenate([pairs, pairs[:, ::-1]])
+        ends = ends[border[ends[:, 0]] & core[ends[:, 1]]]
+        ends = ends[np.lexsort((ends[:, 1], ends[:, 0]))]
+        point, first = np.unique(ends[:, 0], return_index=True)
+        component[point] = component[ends[first, 1]]
+
+    # rank the clusters of every user by size, ties broken like skmob (later first visit first)
+    clustered = component >= 0
+    ids, inverse = np.unique(component[clustered], return_inverse=True)
+    size = np.bincount(inverse)
+    first_row = np.full(len(ids), n)
+    np.minimum.at(first_row, inverse, np.flatnonzero(clustered))
+    user = codes[first_row]
+    order = np.lexsort((-first_row, -size, user))
+    user_start = np.searchsorted(user[order], user[order], side="left")
+    rank = np.empty(len(ids), dtype=np.int64)
+    rank[order] = np.arange(len(ids)) - user_start
+
+    labels = np.full(n, -1, dtype=np.int64)
+    labels[clustered] = rank[inverse]
+    return labels
+
+
+def _sorted_groups(df, keys, datetime):
+    df = df.sort_values(keys + [datetime], kind="mergesort")
+    codes = df.groupby(keys, sort=False, observed=True).ngroup().values if len(keys) > 1 else pd.factorize(df[keys[0]])[0]
+    return df, codes
+
+
+@instrumentation.instrumented()
+def stay_locations(tdf, spatial_radius_km=0.2, minutes_for_a_stop=20., by=None, uid="uid", lat="lat", lng="lng",
+                   datetime="datetime"):
+    """
+    NumPy engine for skmob.preprocessing.detection.stay_locations(tdf, spatial_radius_km=..., minutes_for_a_stop=...).
+
+    Parameters
+    ----------
+    tdf : DataFrame or TrajDataFrame
+        Points, e.g. the output of preprocess_mobile_data().
+    by : list of string or None
+        Further columns whose groups are treated separately, e.g. ["period"]
+        to detect the stays of every event period on its own (as running
+        skmob on every period's TrajDataFrame).
+
+    Returns
+    -------
+    DataFrame with one row per stay, sorted by `by`, user and time: the user,
+    `by` columns, median "lat"/"lng", arrival "datetime", "leaving_datetime"
+    and "n_points" (points within the stay).
+    """
+    keys = list(by or []) + [uid]
+    df, codes = _sorted_groups(tdf, keys, datetime)
+    starts, ends = trajectory.group_bounds(codes)
+    t = df[datetime].values.astype("datetime64[ns]").astype(np.int64)
+    first, leave, median_lat, median_lng = stay_groups(df[lat].values, df[lng].values, t, starts, ends,
+                                                       spatial_radius_km=spatial_radius_km, minutes_for_a_stop=minutes_for_a_stop)
+
+    stays = df[keys].iloc[first].reset_index(drop=True)
+    stays["lat"] = median_lat
+    stays["lng"] = median_lng
+    stays["datetime"] = df[datetime].values[first]
+    stays["leaving_datetime"] = df[datetime].values[leave]
+    stays["n_points"] = (leave - first).astype(np.int32)
+    instrumentation.current().record(rows_in=len(df), rows_out=len(stays))
+    return stays.rename(columns={uid: "uid"})
+
+
+@instrumentation.instrumented()
+def cluster(stays, cluster_radius_km=0.1, min_samples=1, by=None):
+    """
+    NumPy/SciPy engine for skmob.preprocessing.clustering.cluster(stays, cluster_radius_km, min_samples),
+    see cluster_labels().
+
+    Parameters
+    ----------
+    stays : DataFrame
+        Output of stay_locations().
+    by : list of string or None
+        Further columns whose groups are clustered separately, e.g. ["period"].
+
+    Returns
+    -------
+    Copy of `stays` with the column "cluster".
+    """
+    keys = list(by or []) + ["uid"]
+    stays, codes = _sorted_groups(stays, keys, "datetime")
+    stays = stays.reset_index(drop=True)
+    stays["cluster"] = cluster_labels(stays["lat"].values, stays["lng"].values, codes,
+                                      cluster_radius_km=cluster_radius_km, min_samples=min_samples)
+    return stays
+
+
+def cluster_locations(stays, by=None):
+    """
+    One row per (`by`, user, cluster) of clustered stays: median coordinates,
+    number of stays, total dwell time in minutes and first arrival.
+    Noise (cluster -1) is left out.
+    """
+    keys = list(by or []) + ["uid", "cluster"]
+    stays = stays[stays["cluster"] >= 0]
+    dwell = (stays["leaving_datetime"] - stays["datetime"]).dt.total_seconds() / 60.
+    grouped = stays.assign(dwell_minutes=dwell).groupby(keys, sort=True, observed=True)
+    return grouped.agg(lat=("lat", "median"), lng=("lng", "median"), n_stays=("lat", "size"),
+                       dwell_minutes=("dwell_minutes", "sum"), first_arrival=("datetime", "min")).reset_index()
+
+
+def match_locations(locations_a, locations_b, radius_km=0.1, same_user=True):
+    """
+    Matches the locations of two periods (e.g. the "pre" and "during" output
+    of cluster_locations()): every location of `locations_a` is paired with
+    the nearest location of `locations_b` within `radius_km`, of the same user
+    if `same_user`. Uses a KD-tree over all locations instead of comparing
+    all pairs.
+
+    Returns
+    -------
+    DataFrame with the columns of both inputs (suffixes "_a" and "_b", NaN if
+    there is no match within the radius) and "distance_km".
+    """
+    from scipy.spatial import cKDTree
+
+    locations_a = locations_a.reset_index(drop=True)
+    locations_b = locations_b.reset_index(drop=True)
+    if same_user:
+        codes_a, uniques = pd.factorize(locations_a["uid"])
+        codes_b = pd.Index(uniques).get_indexer(locations_b["uid"])
+        codes_b = np.where(codes_b < 0, -1 - np.arange(len(codes_b)), codes_b) #users missing in a match nothing
+    else:
+        codes_a, codes_b = np.zeros(len(locations_a)), np.zeros(len(locations_b))
+    points_a = _keyed_tree_points(locations_a["lat"].values, locations_a["lng"].values, codes_a)
+    points_b = _keyed_tree_points(locations_b["lat"].values, locations_b["lng"].values, codes_b)
+
+    match = np.full(len(locations_a), -1, dtype=np.int64)
+    distance = np.full(len(locations_a), np.nan)
+    if len(locations_a) > 0 and len(locations_b) > 0:
+        chord, nearest = cKDTree(points_b).query(points_a, k=1, distance_upper_bound=_chord(radius_km))
+        found = np.isfinite(chord)
+        match[found] = nearest[found]
+        distance[found] = trajectory.haversine(locations_a["lat"].values[found], locations_a["lng"].values[found],
+                                               locations_b["lat"].values[nearest[found]], locations_b["lng"].values[nearest[found]])
+
+    matched_b = locations_b.reindex(match).reset_index(drop=True) #-1 is not in the index: all NaN
+    matched = locations_a.add_suffix("_a").join(matched_b.add_suffix("_b"))
+    matched["distance_km"] = distance
+    return matched
+
+
+@instrumentation.instrumented()
+def compute_stays(gdf, locs=None, location=None, spatial_radius_km=0.2, minutes_for_a_stop=20., cluster_radius_km=0.1,
+                  min_samples=1, period_resolution="D"):
+    """
+    Clustered stays of all users, the compact table downstream metrics start from.
+
+    If the event configuration `locs`, `location` is given, the points are
+    labeled with their event period (see metrics.label_event_periods()) and
+    stays are detected and clustered per period, as in the Tulsa analysis.
+
+    Returns
+    -------
+    DataFrame of stay_locations() with the columns "cluster" (and "period").
+    """
+    by = None
+    if locs is not None:
+        from satmobfusion.metrics import label_event_periods
+        gdf = pd.DataFrame({"uid": gdf["uid"].values, "lat": gdf["lat"].values, "lng": gdf["lng"].values,
+                            "datetime": gdf["datetime"].values})
+        gdf["period"] = label_event_periods(gdf["datetime"], locs, location, resolution=period_resolution)
+        by = ["period"]
+    stays = stay_locations(gdf, spatial_radius_km=spatial_radius_km, minutes_for_a_stop=minutes_for_a_stop, by=by)
+    return cluster(stays, cluster_radius_km=cluster_radius_km, min_samples=min_samples, by=by)
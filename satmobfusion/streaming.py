@@ -0,0 +1,329 @@
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from satmobfusion.mobile_data_processing import MOBILE_DTYPES
+
+log = logging.getLogger(__name__)
+
+
+class BaselineStore():
+    """
+    Running baselines (mean and variance) of a metric for every (slot, key),
+    e.g. (hour of the week, cell), held in arrays of shape (n_slots, n_keys).
+    An update is O(1) per value and vectorized over the keys.
+
+    Parameters
+    ----------
+    method : string
+        "welford" for the running mean/variance of the full history, or
+        "ewma" for exponentially weighted ones that follow slow drifts.
+    alpha : float
+        Weight of the newest value if method is "ewma".
+    n_slots : int
+        Number of slots, e.g. 168 hours of the week.
+    """
+    def __init__(self, method="welford", alpha=0.1, n_slots=168):
+        if method not in ("welford", "ewma"):
+            raise ValueError(f"method must be 'welford' or 'ewma', got {method!r}")
+        self.method = method
+        self.alpha = alpha
+        self.n = np.zeros((n_slots, 0), dtype=np.int64)
+        self.mean = np.zeros((n_slots, 0))
+        self.m = np.zeros((n_slots, 0)) #M2 (welford) or variance (ewma)
+
+    def resize(self, n_keys):
+        """
+        Makes room for at least `n_keys` keys; new keys have no history.
+        """
+        extra = n_keys - self.n.shape[1]
+        if extra > 0:
+            extra = max(extra, self.n.shape[1]) #doubling, so that adding keys one by one stays cheap
+            self.n = np.pad(self.n, ((0, 0), (0, extra)))
+            self.mean = np.pad(self.mean, ((0, 0), (0, extra)))
+            self.m = np.pad(self.m, ((0, 0), (0, extra)))
+
+    def get(self, slot, keys=slice(None)):
+        """
+        (n, mean, std) arrays of the keys in a slot; mean and std are NaN for keys without history.
+        """
+        n, mean, m = self.n[slot, keys], self.mean[slot, keys], self.m[slot, keys]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if self.method == "welford":
+                std = np.where(n > 1, np.sqrt(m / (n - 1)), np.nan)
+            else:
+                std = np.where(n > 0, np.sqrt(m), np.nan)
+        return n, np.where(n > 0, mean, np.nan), std
+
+    def update(self, slot, values, keys=slice(None)):
+        n, mean, m = self.n[slot, keys], self.mean[slot, keys], self.m[slot, keys]
+        delta = values - mean
+        if self.method == "welford":
+            #starts from mean 0 and M2 0, so the first value needs no special case
+            mean = mean + delta / (n + 1)
+            m = m + delta * (values - mean)
+        else:
+            first = n == 0
+            mean = np.where(first, values, mean + self.alpha * delta)
+            m = np.where(first, 0., (1 - self.alpha) * (m + self.alpha * delta**2))
+        self.n[slot, keys], self.mean[slot, keys], self.m[slot, keys] = n + 1, mean, m
+
+
+class StreamingAnomalyDetector():
+    """
+    Detects anomalies in visits and unique users per cell while pings stream in.
+
+    Pings are counted into (time bin, cell) accumulators. All bins that end
+    before the latest ping time minus `allowed_lateness` (the watermark) are
+    closed, including bins without any ping. The values of every cell seen
+    so far are then compared against the baseline of the same cell and hour
+    of the week, reported if they deviate by more than `threshold` standard
+    deviations, and added to the baseline. Pings of bins that are already
+    closed are dropped and counted in `n_late`.
+
+    Parameters
+    ----------
+    bin_width : string
+        pandas frequency of the time bins.
+    cell_col : string or None
+        Column of the pings holding a cell/region id.
+    cell_func : callable or None
+        Alternatively, a function (lon, lat) -> array of cell ids, e.g.
+        functools.partial(grid.cell_ids, resolution=16).
+        If neither is given, all pings fall into one cell.
+    threshold : float
+        Absolute z-score above which a value is reported.
+    min_history : int
+        Number of earlier bins with the same (cell, hour of week) needed before reporting.
+    method, alpha :
+        See BaselineStore.
+    allowed_lateness : string
+        How long a bin is kept open after its end for late pings.
+    timezone : string or None
+        Timezone used for the hour of the week; bins are in UTC if None.
+    time_col, unit :
+        Column with the ping times and its unit, as in mobiledatamodule.add_datetime().
+    """
+    metrics = ["n_visits", "n_users"]
+    event_columns = ["bin", "cell", "metric", "value", "baseline_mean", "baseline_std", "z", "n_history"]
+
+    def __init__(self, bin_width="1h", cell_col=None, cell_func=None, threshold=3., min_history=3,
+                 method="welford", alpha=0.1, allowed_lateness="0s", timezone=None,
+                 time_col="timestamp", unit="s", lat="lat", lng="lon", uid="uid"):
+        self.bin_width = pd.tseries.frequencies.to_offset(bin_width)
+        self.cell_col = cell_col
+        self.cell_func = cell_func
+        self.threshold = threshold
+        self.min_history = min_history
+        self.allowed_lateness = pd.Timedelta(allowed_lateness)
+        self.timezone = timezone
+        self.time_col, self.unit = time_col, unit
+        self.lat, self.lng, self.uid = lat, lng, uid
+
+        self.baselines = {metric: BaselineStore(method, alpha) for metric in self.metrics}
+        self._unit_ns = pd.Timedelta(1, unit).value if unit else None
+        self._width_ns = self.bin_width.nanos if isinstance(self.bin_width, pd.offsets.Tick) else None
+        self.cells = [] #cell ids by cell code, the position in the accumulators and baselines
+        self.cell_codes = {}
+        self.uid_codes = {}
+        self.first_bin = np.zeros(0, dtype=np.int64) #first bin (ns) with a ping of every cell
+        self.open_bins = {} #bin start -> list of (visits per cell code, distinct cell code << 32 | uid code)
+        self.next_bin = None #start of the first bin that is not closed yet
+        self.watermark = None
+        self.n_late = 0
+        self._no_events = pd.DataFrame([], columns=self.event_columns) #copied for batches without anomalies, which is cheaper than building it
+
+    def _cells(self, batch):
+        if self.cell_col is not None:
+            return batch[self.cell_col].values
+        if self.cell_func is not None:
+            return np.asarray(self.cell_func(batch[self.lng].values, batch[self.lat].values))
+        return np.zeros(len(batch), dtype=np.int64)
+
+    def _codes(self, values, mapping):
+        # consecutive integer codes of the values, new values get the next free codes
+        uniques, inverse = np.unique(np.asarray(values), return_inverse=True)
+        codes = np.fromiter((mapping.setdefault(v, len(mapping)) for v in uniques.tolist()), dtype=np.int64, count=len(uniques))
+        return codes[inverse.ravel()]
+
+    def _times(self, batch):
+        # ping times in ns since the epoch (UTC)
+        values = batch[self.time_col].values
+        if self._unit_ns is None:
+            return pd.DatetimeIndex(values).asi8
+        if np.issubdtype(values.dtype, np.integer):
+            return values.astype(np.int64) * self._unit_ns
+        return (values * self._unit_ns).astype(np.int64)
+
+    def _timestamp(self, t_ns):
+        t = pd.Timestamp(int(t_ns))
+        return t if self.timezone is None else t.tz_localize("UTC").tz_convert(self.timezone)
+
+    def _bins(self, t_ns):
+        # start of every bin in the batch and the bin of every ping
+        if self._width_ns is not None and self.timezone is None:
+            starts, inverse = np.unique(t_ns - t_ns % self._width_ns, return_inverse=True)
+            return [pd.Timestamp(start) for start in starts], inverse.ravel()
+        times = pd.DatetimeIndex(t_ns)
+        if self.timezone is not None:
+            times = times.tz_localize("UTC").tz_convert(self.timezone)
+        inverse, starts = pd.factorize(times.floor(self.bin_width))
+        return list(starts), inverse
+
+    def ingest(self, batch):
+        """
+        Adds a micro-batch of pings and closes all bins that are complete.
+
+        Returns
+        -------
+        DataFrame of the anomalies found in the bins closed by this batch (possibly empty).
+        """
+        if len(batch) > 0:
+            t_ns = self._times(batch)
+            bin_starts, bin_codes = self._bins(t_ns)
+            open_bin = np.array([self.next_bin is None or start >= self.next_bin for start in bin_starts])
+            keep = open_bin[bin_codes]
+            self.n_late += int(len(keep) - keep.sum())
+            if keep.any():
+                cells = self._cell_codes(self._cells(batch)[keep])
+                pairs = (cells << 32) | self._codes(batch[self.uid].values[keep], self.uid_codes)
+                bin_codes = bin_codes[keep]
+                for i in np.flatnonzero(open_bin):
+                    in_bin = bin_codes == i
+                    bin_cells = cells[in_bin]
+                    self.open_bins.setdefault(bin_starts[i], []).append((np.bincount(bin_cells), np.unique(pairs[in_bin])))
+                    np.minimum.at(self.first_bin, bin_cells, bin_starts[i].value)
+            latest = self._timestamp(t_ns.max())
+            self.watermark = latest if self.watermark is None else max(self.watermark, latest)
+        return self._close_bins(self.watermark - self.allowed_lateness if self.watermark is not None else None)
+
+    def _cell_codes(self, cells):
+        codes = self._codes(cells, self.cell_codes)
+        if len(self.cell_codes) > len(self.cells):
+            self.cells.extend(list(self.cell_codes)[len(self.cells):])
+            if len(self.cells) > len(self.first_bin):
+                #doubling; unused entries never become active
+                extra = max(len(self.cells) - len(self.first_bin), len(self.first_bin))
+                self.first_bin = np.append(self.first_bin, np.full(extra, np.iinfo(np.int64).max))
+            for baseline in self.baselines.values():
+                baseline.resize(len(self.cells))
+        return codes
+
+    def flush(self):
+        """
+        Closes all open bins, e.g. at the end of a replay.
+        """
+        if not self.open_bins:
+            return self._close_bins(None)
+        return self._close_bins(max(self.open_bins) + self.bin_width)
+
+    def _close_bins(self, until):
+        events = []
+        if until is not None and self.next_bin is None and self.open_bins:
+            self.next_bin = min(self.open_bins)
+        while until is not None and self.next_bin is not None and self.next_bin + self.bin_width <= until:
+            bin_start = self.next_bin
+            events.extend(self._close_bin(bin_start, self.open_bins.pop(bin_start, [])))
+            self.next_bin = bin_start + self.bin_width
+        return pd.DataFrame(events, columns=self.event_columns) if events else self._no_events.copy()
+
+    def _close_bin(self, bin_start, parts):
+        n_cells = len(self.first_bin)
+        visits = np.zeros(n_cells, dtype=np.int64)
+        users = np.zeros(n_cells, dtype=np.int64)
+        for counts, _ in parts:
+            visits[:len(counts)] += counts
+        if parts:
+            pairs = np.unique(np.concatenate([pairs for _, pairs in parts])) if len(parts) > 1 else parts[0][1]
+            users += np.bincount(pairs >> 32, minlength=n_cells)
+        #cells seen in this or an earlier bin; the silent ones count with zero visits
+        active = np.flatnonzero(self.first_bin <= bin_start.value)
+        how = bin_start.dayofweek * 24 + bin_start.hour
+        events = []
+        for metric, values in zip(self.metrics, (visits[active], users[active])):
+            baseline = self.baselines[metric]
+            n, mean, std = baseline.get(how, active)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                z = (values - mean) / std
+                report = (n >= self.min_history) & (std > 0) & (np.abs(z) >= self.threshold)
+            for i in np.flatnonzero(report):
+                events.append((bin_start, self.cells[active[i]], metric, values[i], mean[i], std[i], z[i], n[i]))
+            baseline.update(how, values, active)
+        return events
+
+
+def replay(source, batch_seconds=60, speedup=None, time_col="timestamp", dtype=MOBILE_DTYPES):
+    """
+    Streams a Spectus export as micro-batches in time order.
+
+    Parameters
+    ----------
+    source : string or DataFrame
+        Path to the CSV file or the pings themselves; `time_col` holds unix seconds.
+    batch_seconds : float
+        Span of data time covered by every micro-batch.
+    speedup : float or None
+        Data time runs `speedup` times faster than wall-clock time, e.g. 3600
+        replays one hour of data per second. None replays as fast as possible.
+
+    Yields
+    ------
+    DataFrame with the pings of every micro-batch.
+    """
+    df = pd.read_csv(source, dtype=dtype) if isinstance(source, str) else source
+    df = df.sort_values(time_col, kind="mergesort")
+    times = df[time_col].values
+    if len(times) == 0:
+        return
+    t0 = times[0]
+    edges = np.searchsorted(times, np.arange(t0, times[-1] + batch_seconds, batch_seconds), side="left")
+    edges = np.append(edges[1:], len(times))
+    wall_start = time.perf_counter()
+    lo = 0
+    for i, hi in enumerate(edges):
+        if speedup is not None:
+            wait = wall_start + (i + 1) * batch_seconds / speedup - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        yield df.iloc[lo:hi]
+        lo = hi
+
+
+def run_replay(detector, source, batch_seconds=60, speedup=None, **replay_kwargs):
+    """
+    Feeds a replay of `source` into `detector` and measures per-batch latency.
+    A summary (anomalies, late pings, latency, throughput) is logged at INFO level.
+
+    Returns
+    -------
+    events : DataFrame
+        All anomalies, with the wall-clock second (since start) at which they were emitted.
+    stats : DataFrame
+        Per batch: number of pings, processing latency in seconds and throughput in pings/s.
+    """
+    events, stats = [], []
+    wall_start = time.perf_counter()
+    for i, batch in enumerate(replay(source, batch_seconds=batch_seconds, speedup=speedup, **replay_kwargs)):
+        t0 = time.perf_counter()
+        found = detector.ingest(batch)
+        latency = time.perf_counter() - t0
+        if len(found) > 0:
+            found["emitted_after_s"] = time.perf_counter() - wall_start
+            events.append(found)
+        stats.append((i, len(batch), latency, len(batch) / latency if latency > 0 else np.inf))
+    found = detector.flush()
+    if len(found) > 0:
+        found["emitted_after_s"] = time.perf_counter() - wall_start
+        events.append(found)
+
+    stats = pd.DataFrame(stats, columns=["batch", "n_pings", "latency_s", "pings_per_s"])
+    events = pd.concat(events, ignore_index=True) if events else pd.DataFrame()
+    if len(stats) > 0:
+        log.info("%d batches, %d pings, %d anomalies, %d late pings dropped",
+                 len(stats), stats['n_pings'].sum(), len(events), detector.n_late)
+        log.info("latency per batch: median %.2f ms, p99 %.2f ms",
+                 stats['latency_s'].median()*1e3, stats['latency_s'].quantile(0.99)*1e3)
+        log.info("throughput: %.0f pings/s", stats['n_pings'].sum() / stats['latency_s'].sum())
+    return events, stats
@@ -0,0 +1,340 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+# same earth radius as skmob.utils.gislib, so that distances match to the last digit
+EARTH_RADIUS_KM = 6371.0
+
+# number of points looked ahead per user and round in the batched scans below
+SCAN_WINDOW = 32
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Vectorized haversine distance in km (same formula as skmob.utils.gislib.getDistanceByHaversine).
+
+    Parameters
+    ----------
+    lat1, lng1, lat2, lng2 : array-like
+        Coordinates in decimal degrees; broadcast against each other.
+    """
+    lat1 = np.asarray(lat1, dtype=float) * np.pi / 180.0
+    lng1 = np.asarray(lng1, dtype=float) * np.pi / 180.0
+    lat2 = np.asarray(lat2, dtype=float) * np.pi / 180.0
+    lng2 = np.asarray(lng2, dtype=float) * np.pi / 180.0
+
+    dlng = lng2 - lng1
+    dlat = lat2 - lat1
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng/2.0)**2
+    return EARTH_RADIUS_KM * 2.0 * np.arctan2(np.sqrt(a), np.sqrt(1.0-a))
+
+
+def group_bounds(codes):
+    """
+    Start and end (exclusive) row of every run of equal values in a sorted key array.
+    """
+    codes = np.asarray(codes)
+    if len(codes) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    breaks = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+    starts = np.concatenate([[0], breaks]).astype(np.int64)
+    ends = np.concatenate([breaks, [len(codes)]]).astype(np.int64)
+    return starts, ends
+
+
+def filter_mask(lat, lng, t, starts, ends, max_speed_kmh=500., window=SCAN_WINDOW):
+    """
+    Speed filter on uid-sorted arrays; returns a boolean mask of the points to keep.
+
+    Reproduces skmob.preprocessing.filtering.filter(include_loops=False): a point is
+    dropped if the speed from the last kept point exceeds `max_speed_kmh` (or if no
+    time has passed), and the last point of every trajectory is never tested.
+    Users are processed together in batched rounds; runs of points whose consecutive
+    speeds are fine are skipped in one step, so the number of rounds is driven by
+    the number of outliers per user, not by the number of points.
+
+    Parameters
+    ----------
+    lat, lng : array-like
+        Coordinates in decimal degrees, sorted by uid and time.
+    t : array-like
+        Timestamps in seconds (float), same order.
+    starts, ends : array-like
+        Row bounds of every user, see group_bounds().
+    """
+    lat = np.asarray(lat, dtype=float)
+    lng = np.asarray(lng, dtype=float)
+    t = np.asarray(t, dtype=float)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    keep = np.ones(len(lat), dtype=bool)
+    if len(lat) < 3:
+        return keep
+
+    def passes(a, k):
+        dt = t[k] - t[a]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (dt > 0) & (haversine(lat[a], lng[a], lat[k], lng[k]) / dt * 3600. <= max_speed_kmh)
+
+    # consecutive violations that are subject to testing (never the first or last point of a user)
+    ok = np.ones(len(lat), dtype=bool)
+    ok[1:] = passes(np.arange(len(lat)-1), np.arange(1, len(lat)))
+    is_last = np.zeros(len(lat), dtype=bool)
+    is_last[ends-1] = True
+    ok[starts] = True
+    ok[is_last] = True
+    violations = np.flatnonzero(~ok)
+
+    active = (ends - starts) >= 3
+    anchor, cand, end = starts[active], starts[active] + 1, ends[active]
+    offsets = np.arange(window)
+    while len(anchor) > 0:
+        # users whose candidate directly follows the anchor can jump to their next violation
+        jump = cand == anchor + 1
+        pos = np.searchsorted(violations, cand[jump])
+        nxt = np.append(violations, len(lat))[pos]
+        found = nxt < end[jump] - 1
+        jump_idx = np.flatnonzero(jump)
+        anchor[jump_idx[found]] = nxt[found] - 1
+        cand[jump_idx[found]] = nxt[found]
+        done = np.zeros(len(anchor), dtype=bool)
+        done[jump_idx[~found]] = True
+        done |= cand >= end - 1
+        anchor, cand, end = anchor[~done], cand[~done], end[~done]
+        if len(anchor) == 0:
+            break
+
+        # test the next `window` candidates against the anchor; the last point of a user always passes
+        k = cand[:, None] + offsets
+        valid = k < end[:, None]
+        k = np.minimum(k, end[:, None] - 1)
+        ok_k = (passes(anchor[:, None], k) | (k == end[:, None] - 1)) & valid
+        any_ok = ok_k.any(axis=1)
+        first = np.where(any_ok, ok_k.argmax(axis=1), window)
+        dropped = (offsets < first[:, None]) & valid
+        keep[k[dropped]] = False
+
+        anchor = np.where(any_ok, cand + first, anchor)
+        cand = np.where(any_ok, anchor + 1, cand + window)
+
+        done = cand >= end - 1
+        anchor, cand, end = anchor[~done], cand[~done], end[~done]
+
+    return keep
+
+
+def group_anchors(lat, lng, starts, ends, spatial_radius_km=0.2, window=SCAN_WINDOW):
+    """
+    Anchor-based segmentation of uid-sorted arrays: a group starts at an anchor
+    point and holds all following points within `spatial_radius_km` of it; the
+    first point further away becomes the next anchor. The first point of every
+    user is an anchor.
+
+    Returns
+    -------
+    Sorted rows of all anchors; every group runs up to the next anchor.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lng = np.asarray(lng, dtype=float)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    is_anchor = np.zeros(len(lat), dtype=bool)
+    is_anchor[starts] = True
+
+    anchor, scan, end = starts.copy(), starts + 1, ends.copy()
+    live = scan < end
+    anchor, scan, end = anchor[live], scan[live], end[live]
+    offsets = np.arange(window)
+    while len(anchor) > 0:
+        k = scan[:, None] + offsets
+        valid = k < end[:, None]
+        k = np.minimum(k, end[:, None] - 1)
+        far = (haversine(lat[anchor, None], lng[anchor, None], lat[k], lng[k]) > spatial_radius_km) & valid
+        any_far = far.any(axis=1)
+        first = far.argmax(axis=1)
+
+        new_anchor = scan[any_far] + first[any_far]
+        is_anchor[new_anchor] = True
+        anchor[any_far] = new_anchor
+        scan = np.where(any_far, anchor + 1, scan + window)
+
+        live = scan < end
+        anchor, scan, end = anchor[live], scan[live], end[live]
+
+    return np.flatnonzero(is_anchor)
+
+
+def compress_groups(lat, lng, starts, ends, spatial_radius_km=0.2, window=SCAN_WINDOW):
+    """
+    Compression groups on uid-sorted arrays.
+
+    Reproduces skmob.preprocessing.compression.compress() with the groups of
+    group_anchors().
+
+    Returns
+    -------
+    anchors : ndarray
+        Row of the anchor of every group.
+    median_lat, median_lng : ndarray
+        Median coordinates of every group.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lng = np.asarray(lng, dtype=float)
+    anchors = group_anchors(lat, lng, starts, ends, spatial_radius_km=spatial_radius_km, window=window)
+    gid = np.zeros(len(lat), dtype=np.int64)
+    gid[anchors[1:]] = 1
+    gid = np.cumsum(gid)
+    return anchors, _group_median(lat, gid, len(anchors)), _group_median(lng, gid, len(anchors))
+
+
+def _group_median(values, gid, n_groups):
+    # sort values within groups and average the two middle elements (identical to np.median per group)
+    order = np.lexsort((values, gid))
+    sorted_values = values[order]
+    counts = np.bincount(gid, minlength=n_groups)
+    offsets = np.cumsum(counts) - counts
+    return (sorted_values[offsets + (counts-1)//2] + sorted_values[offsets + counts//2]) / 2
+
+
+def balanced_batches(starts, ends, n_batches):
+    """
+    Splits uid-sorted rows into at most `n_batches` contiguous row ranges of similar point count.
+
+    Batches are cut at user boundaries only, so every user ends up in exactly one batch.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if len(ends) == 0:
+        return []
+    targets = ends[-1] * np.arange(1, n_batches) / n_batches
+    cuts = np.unique(np.concatenate([[0], np.searchsorted(ends, targets) + 1, [len(ends)]]).clip(0, len(ends)))
+    return [(int(starts[lo]), int(ends[hi-1])) for lo, hi in zip(cuts[:-1], cuts[1:])]
+
+
+def _to_shared_memory(arrays):
+    blocks, specs = [], []
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+        blocks.append(shm)
+        specs.append((shm.name, arr.shape, arr.dtype.str))
+    return blocks, specs
+
+
+def _filter_compress_batch(specs, row_lo, row_hi, max_speed_kmh, spatial_radius_km):
+    #runs in a worker process: attach to the shared arrays and work on rows [row_lo, row_hi) only
+    blocks = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+    try:
+        lat, lng, t, codes = [np.ndarray(shape, dtype=dtype, buffer=shm.buf)[row_lo:row_hi]
+                              for shm, (_, shape, dtype) in zip(blocks, specs)]
+        starts, ends = group_bounds(codes)
+        kept = np.flatnonzero(filter_mask(lat, lng, t, starts, ends, max_speed_kmh=max_speed_kmh))
+        starts, ends = group_bounds(codes[kept])
+        anchors, median_lat, median_lng = compress_groups(lat[kept], lng[kept], starts, ends,
+                                                          spatial_radius_km=spatial_radius_km)
+        result = row_lo + kept[anchors], median_lat, median_lng, len(kept)
+        #views into the shared buffers have to be gone before the blocks can be closed
+        del lat, lng, t, codes
+        return result
+    finally:
+        for shm in blocks:
+            shm.close()
+
+
+def parallel_filter_compress(lat, lng, t, codes, max_speed_kmh=500., spatial_radius_km=0.2, n_jobs=-1, batches_per_job=4):
+    """
+    Runs filter_mask() and compress_groups() on uid batches in a process pool.
+
+    The input arrays are placed in shared memory once; workers only receive the
+    block names and their row range, and send back the (small) compressed result.
+    Batches are balanced by point count and results are concatenated in row
+    order, so the output does not depend on scheduling or `n_jobs`.
+
+    Parameters
+    ----------
+    lat, lng, t : array-like
+        Coordinates and timestamps in seconds, sorted by uid and time.
+    codes : array-like
+        Integer uid codes in the same order.
+    n_jobs : int
+        Number of worker processes; -1 (or None) uses all cores.
+    batches_per_job : int
+        Batches per worker; more batches even out differences in user activity.
+
+    Returns
+    -------
+    anchors, median_lat, median_lng : ndarray
+        Same as compress_groups(), with anchors indexing the input rows.
+    n_filtered : int
+        Number of points left after filtering.
+    """
+    if n_jobs is None or n_jobs < 0:
+        n_jobs = os.cpu_count()
+    lat = np.asarray(lat, dtype=float)
+    lng = np.asarray(lng, dtype=float)
+    t = np.asarray(t, dtype=float)
+    codes = np.asarray(codes, dtype=np.int64)
+    starts, ends = group_bounds(codes)
+    batches = balanced_batches(starts, ends, n_jobs*batches_per_job)
+
+    blocks, specs = _to_shared_memory([lat, lng, t, codes])
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_filter_compress_batch, specs, row_lo, row_hi, max_speed_kmh, spatial_radius_km)
+                       for row_lo, row_hi in batches]
+            results = [future.result() for future in futures]
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    if len(results) == 0:
+        empty = np.zeros(0)
+        return empty.astype(np.int64), empty, empty, 0
+    anchors, median_lat, median_lng, n_filtered = zip(*results)
+    return np.concatenate(anchors), np.concatenate(median_lat), np.concatenate(median_lng), sum(n_filtered)
+
+
+def _sorted_arrays(tdf):
+    tdf = tdf.sort_values(['uid', 'datetime'], kind='mergesort')
+    starts, ends = group_bounds(pd.factorize(tdf['uid'])[0])
+    return tdf, starts, ends
+
+
+def filter_trajectories(tdf, max_speed_kmh=500.):
+    """
+    NumPy engine for skmob.preprocessing.filtering.filter(tdf, max_speed_kmh, include_loops=False).
+
+    Parameters
+    ----------
+    tdf : DataFrame or TrajDataFrame
+        Points with columns 'lat', 'lng', 'datetime' and 'uid'.
+
+    Returns
+    -------
+    The kept points sorted by uid and datetime, with a fresh index.
+    """
+    tdf, starts, ends = _sorted_arrays(tdf)
+    t = tdf['datetime'].values.astype('datetime64[ns]').astype(np.int64) / 1e9
+    keep = filter_mask(tdf['lat'].values, tdf['lng'].values, t, starts, ends, max_speed_kmh=max_speed_kmh)
+    return tdf[keep].reset_index(drop=True)
+
+
+def compress_trajectories(tdf, spatial_radius_km=0.2):
+    """
+    NumPy engine for skmob.preprocessing.compression.compress(tdf, spatial_radius_km).
+
+    Every group is represented by its anchor row (time and extra columns) with the
+    median coordinates of the group.
+    """
+    tdf, starts, ends = _sorted_arrays(tdf)
+    anchors, median_lat, median_lng = compress_groups(tdf['lat'].values, tdf['lng'].values, starts, ends,
+                                                      spatial_radius_km=spatial_radius_km)
+    ctdf = tdf.iloc[anchors].reset_index(drop=True)
+    ctdf['lat'] = median_lat
+    ctdf['lng'] = median_lng
+    return ctdf
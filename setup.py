@@ -17,13 +17,14 @@ requires = [
   'rasterio',
   'geojson',
    'rasterio',
-   'rasterstats'
+   'rasterstats',
+   'pyarrow'
 ]
 
 with open('README.md') as f:
     readme = f.read()
 
-with open('LICENSE.md') as f:
+with open('LICENSE') as f:
     license = f.read()
 
 setup(
@@ -38,5 +39,8 @@ setup(
     license=license,
     packages=find_packages(),
     #package_data=package_data,
-    install_requires=requires
+    install_requires=requires,
+    entry_points={
+        'console_scripts': ['satmobfusion=satmobfusion.runner:main'],
+    },
 )